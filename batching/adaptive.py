@@ -0,0 +1,168 @@
+import logging
+import math
+from collections import deque
+from typing import List, Dict, Any, Deque, Tuple
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+def _percentile(values, pct: float) -> float:
+    """Nearest-rank percentile of a collection of numbers (0 when empty)."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[rank]
+
+class _QueueState:
+    """Observations and current decision for one task type."""
+    
+    def __init__(self):
+        self.samples: Deque[Tuple[int, float]] = deque(maxlen=settings.ADAPTIVE_WINDOW)
+        self.waits: Dict[str, Deque[float]] = {
+            priority: deque(maxlen=settings.ADAPTIVE_WINDOW) for priority in settings.PRIORITY_LEVELS
+        }
+        self.latencies: Dict[str, Deque[float]] = {
+            priority: deque(maxlen=settings.ADAPTIVE_WINDOW) for priority in settings.PRIORITY_LEVELS
+        }
+        self.fixed_cost = 0.0
+        self.per_item_cost = 0.0
+        self.depths: Dict[str, int] = {}
+        self.batch_size = settings.BATCH_SIZE
+        self.linger = float(settings.BATCH_TIMEOUT)
+
+class AdaptiveBatchController:
+    """
+    Tunes batch size and linger time per task type.
+    
+    GPU batch latency is modelled as fixed_cost + per_item_cost * size, fitted
+    by least squares over the last ADAPTIVE_WINDOW batches. Each decision uses
+    the current queue depth and the tightest p95 latency target among the
+    priorities that have work queued:
+    
+    - Deep queues get full batches (throughput), shallow ones only what is
+      waiting (latency).
+    - The size is capped so that the predicted GPU latency of one batch
+      stays within the target. Queue wait already incurred is not charged
+      against the cap: once p95 wait exceeds the target the queue is
+      overloaded, and only full batches can drain it.
+    - The linger window is a fraction of the latency slack left after p95
+      queue wait, so batches only wait to fill when there is time to spare.
+    """
+    
+    def __init__(self, task_types: List[str]):
+        self.states: Dict[str, _QueueState] = {task_type: _QueueState() for task_type in task_types}
+    
+    def _target(self, depths: Dict[str, int]) -> float:
+        """Tightest p95 target among priorities with queued work."""
+        waiting = [p for p, depth in depths.items() if depth > 0] or list(settings.TARGET_P95_LATENCY)
+        return min(settings.TARGET_P95_LATENCY.get(p, max(settings.TARGET_P95_LATENCY.values())) for p in waiting)
+    
+    def _fit(self, state: _QueueState):
+        """Fit the fixed and per-item GPU cost from recent batches."""
+        n = len(state.samples)
+        if n == 0:
+            return
+        mean_size = sum(size for size, _ in state.samples) / n
+        mean_latency = sum(latency for _, latency in state.samples) / n
+        variance = sum((size - mean_size) ** 2 for size, _ in state.samples)
+        if variance > 0:
+            covariance = sum((size - mean_size) * (latency - mean_latency) for size, latency in state.samples)
+            state.per_item_cost = max(0.0, covariance / variance)
+        else:
+            # Only one batch size observed so far: attribute the cost per item
+            state.per_item_cost = mean_latency / max(mean_size, 1)
+        state.fixed_cost = max(0.0, mean_latency - state.per_item_cost * mean_size)
+    
+    def _predict(self, state: _QueueState, size: int) -> float:
+        """Predicted GPU latency for a batch of the given size."""
+        return state.fixed_cost + state.per_item_cost * size
+    
+    def update(self, task_type: str, depths: Dict[str, int], in_batch: int = 0):
+        """
+        Recompute batch size and linger for a task type.
+        
+        Args:
+            task_type: Task type whose queues were inspected
+            depths: Mapping of priority -> queued tasks
+            in_batch: Tasks already taken into the batch being formed
+        """
+        state = self.states[task_type]
+        state.depths = dict(depths)
+        if not settings.ADAPTIVE_BATCHING:
+            state.batch_size = settings.BATCH_SIZE
+            state.linger = float(settings.BATCH_TIMEOUT)
+            return
+        
+        depth = sum(depths.values()) + in_batch
+        target = self._target(depths)
+        wait_p95 = max((_percentile(waits, 95) for waits in state.waits.values()), default=0.0)
+        budget = max(0.0, target - wait_p95)
+        
+        # Throughput when deep or already behind target, latency when shallow
+        if depth >= settings.BATCH_MAX_SIZE or wait_p95 >= target:
+            size = settings.BATCH_MAX_SIZE
+        else:
+            size = max(settings.BATCH_MIN_SIZE, depth)
+        
+        # Largest batch whose predicted GPU latency alone still fits the target
+        if wait_p95 < target and state.samples and state.per_item_cost > 0:
+            fits = int((target - state.fixed_cost) / state.per_item_cost)
+            size = min(size, max(settings.BATCH_MIN_SIZE, fits))
+        
+        state.batch_size = max(settings.BATCH_MIN_SIZE, min(size, settings.BATCH_MAX_SIZE))
+        slack = budget - self._predict(state, state.batch_size)
+        state.linger = min(float(settings.BATCH_TIMEOUT), max(0.0, slack * settings.ADAPTIVE_LINGER_FRACTION))
+    
+    def batch_size(self, task_type: str) -> int:
+        """Current batch size for a task type."""
+        return self.states[task_type].batch_size
+    
+    def linger(self, task_type: str) -> float:
+        """Current linger window (seconds after the first task) for a task type."""
+        return self.states[task_type].linger
+    
+    def observe_batch(self, task_type: str, batch: List[Dict[str, Any]], gpu_latency: float, dequeued_at: float):
+        """
+        Record a processed batch.
+        
+        Args:
+            task_type: Task type of the batch
+            batch: Tasks in the batch
+            gpu_latency: Seconds the GPU call took
+            dequeued_at: Epoch time the batch was formed
+        """
+        state = self.states[task_type]
+        state.samples.append((len(batch), gpu_latency))
+        self._fit(state)
+        
+        for task in batch:
+            priority = task.get("priority")
+            if priority not in state.waits:
+                continue
+            wait = max(0.0, dequeued_at - task.get("timestamp", dequeued_at))
+            state.waits[priority].append(wait)
+            state.latencies[priority].append(wait + gpu_latency)
+    
+    def get_state(self) -> Dict[str, Dict[str, Any]]:
+        """Current and target values per task type for inspection."""
+        return {
+            task_type: {
+                "batch_size": state.batch_size,
+                "linger": state.linger,
+                "queue_depth": state.depths,
+                "fixed_cost": state.fixed_cost,
+                "per_item_cost": state.per_item_cost,
+                "target_p95_latency": {
+                    priority: settings.TARGET_P95_LATENCY.get(priority) for priority in settings.PRIORITY_LEVELS
+                },
+                "observed_p95_latency": {
+                    priority: _percentile(latencies, 95) for priority, latencies in state.latencies.items()
+                },
+                "observed_p95_wait": {
+                    priority: _percentile(waits, 95) for priority, waits in state.waits.items()
+                }
+            }
+            for task_type, state in self.states.items()
+        }
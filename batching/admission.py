@@ -0,0 +1,278 @@
+import logging
+import time
+from typing import TYPE_CHECKING, List, Dict, Any, Optional, Tuple, Union
+import redis.asyncio as redis
+
+import metrics
+from config import settings
+from redis_pool import get_redis_client
+from batching.queue_backend import ListQueueBackend, StreamQueueBackend
+
+if TYPE_CHECKING:
+    # Only for annotations: the story queue sits above the batching package
+    from queues.task_queue import StoryQueue
+
+logger = logging.getLogger(__name__)
+
+# Token buckets checked and charged together: KEYS are buckets, ARGV holds a
+# (refill rate per second, burst, cost) triple per bucket. Either every
+# bucket is charged or none is; returns "0" on success, otherwise the
+# seconds until the emptiest bucket could pay (as a string, since Lua
+# numbers are truncated to integers in replies).
+TOKEN_BUCKET_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate, burst, cost = tonumber(ARGV[3 * i - 2]), tonumber(ARGV[3 * i - 1]), tonumber(ARGV[3 * i])
+    local state = redis.call('HMGET', key, 'tokens', 'at')
+    local tokens = tonumber(state[1]) or burst
+    local elapsed = math.max(0, now - (tonumber(state[2]) or now))
+    levels[i] = math.min(burst, tokens + elapsed * rate)
+    if levels[i] < cost then
+        wait = math.max(wait, (cost - levels[i]) / rate)
+    end
+end
+if wait > 0 then
+    return tostring(wait)
+end
+for i, key in ipairs(KEYS) do
+    local rate, burst, cost = tonumber(ARGV[3 * i - 2]), tonumber(ARGV[3 * i - 1]), tonumber(ARGV[3 * i])
+    redis.call('HSET', key, 'tokens', levels[i] - cost, 'at', now)
+    -- A bucket left alone this long is full again, the same as a missing one
+    redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+end
+return '0'
+"""
+
+class ThroughputMeter:
+    """
+    Cluster-wide rate at which tasks leave the batching queues.
+    
+    Batchers add their finished task counts to per-BUCKET_SECONDS counters;
+    the rate is averaged over the complete buckets of the last
+    ADMISSION_THROUGHPUT_WINDOW seconds.
+    
+    Keys:
+        admission:completed:{bucket}  STRING tasks finished during that bucket
+    """
+    
+    PREFIX = "admission:completed"
+    BUCKET_SECONDS = 5
+    
+    def __init__(self, redis_client: Optional[redis.Redis] = None):
+        self.redis_client = redis_client or get_redis_client()
+    
+    def _key(self, bucket: int) -> str:
+        return f"{self.PREFIX}:{bucket}"
+    
+    async def record(self, count: int):
+        """Count tasks that just finished."""
+        if not count:
+            return
+        key = self._key(int(time.time() // self.BUCKET_SECONDS))
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            pipe.incrby(key, count)
+            pipe.expire(key, settings.ADMISSION_THROUGHPUT_WINDOW + 2 * self.BUCKET_SECONDS)
+            await pipe.execute()
+    
+    async def rate(self) -> Optional[float]:
+        """Tasks finished per second over the recent window, or None if none finished."""
+        current = int(time.time() // self.BUCKET_SECONDS)
+        buckets = max(1, settings.ADMISSION_THROUGHPUT_WINDOW // self.BUCKET_SECONDS)
+        counts = await self.redis_client.mget([self._key(current - i) for i in range(1, buckets + 1)])
+        total = sum(int(count or 0) for count in counts)
+        return total / (buckets * self.BUCKET_SECONDS) if total else None
+
+class AdmissionController:
+    """
+    Decides which story submissions to accept.
+    
+    A submission is turned away (HTTP 429 with Retry-After) when:
+    
+    - its priority's backlog would exceed ADMISSION_MAX_QUEUE_DEPTH tasks, or
+    - its estimated wait would exceed the priority's TARGET_P95_LATENCY. The
+      estimate is the backlog ahead of it divided by the priority's share of
+      recent GPU throughput (ThroughputMeter), with shares split by
+      PRIORITY_RATIO among priorities that have work queued, or
+    - the user's or the priority's token bucket is empty
+      (ADMISSION_USER_RATE/BURST and ADMISSION_PRIORITY_RATE/BURST, in
+      stories per minute).
+    
+    Load is checked first, so rejected submissions are not charged. Stories
+    not yet split into tasks count as ADMISSION_TASKS_PER_STORY tasks. With
+    ADMISSION_DEFER, a story that would miss its priority's target is
+    accepted at the next lower priority instead, if that one can still meet
+    its own target. The backlog and throughput behind the estimate are read
+    at most every ADMISSION_ESTIMATE_TTL seconds per process, so a burst of
+    submissions costs one token bucket call each.
+    
+    Keys:
+        admission:user:{priority}:{user_id}  HASH tokens, at
+        admission:priority:{priority}        HASH tokens, at
+    """
+    
+    def __init__(
+        self,
+        queue_backend: Union[ListQueueBackend, StreamQueueBackend],
+        story_queue: "StoryQueue",
+        throughput: Optional[ThroughputMeter] = None,
+        redis_client: Optional[redis.Redis] = None
+    ):
+        self.redis_client = redis_client or get_redis_client()
+        self.queue_backend = queue_backend
+        self.story_queue = story_queue
+        self.throughput = throughput or ThroughputMeter(self.redis_client)
+        self.bucket_script = self.redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+        self.load: Optional[Dict[str, Any]] = None
+        self.load_at = 0.0
+    
+    @staticmethod
+    def _tier(priority: str) -> str:
+        """Priority level a submitted priority is admitted under."""
+        if priority in settings.PRIORITY_LEVELS:
+            return priority
+        # StoryQueue also accepts "paid" for premium stories
+        return "premium" if priority == "paid" else settings.PRIORITY_LEVELS[-1]
+    
+    async def _get_load(self) -> Dict[str, Any]:
+        """Backlog per priority in tasks and recent GPU throughput, reused for ADMISSION_ESTIMATE_TTL."""
+        now = time.monotonic()
+        if self.load is not None and now - self.load_at < settings.ADMISSION_ESTIMATE_TTL:
+            return self.load
+        
+        queue_priorities = {
+            queue_name: priority
+            for queues in settings.QUEUE_NAMES.values() for priority, queue_name in queues.items()
+        }
+        depths, _ = await self.queue_backend.inspect(list(queue_priorities))
+        backlog = {priority: 0 for priority in settings.PRIORITY_LEVELS}
+        for queue_name, depth in depths.items():
+            backlog[queue_priorities[queue_name]] += depth
+        for priority, depth in (await self.story_queue.get_queue_lengths()).items():
+            backlog[self._tier(priority)] += depth * settings.ADMISSION_TASKS_PER_STORY
+        
+        self.load = {"backlog": backlog, "throughput": await self.throughput.rate()}
+        self.load_at = now
+        return self.load
+    
+    def _estimate_wait(self, load: Dict[str, Any], priority: str, extra: int = 0) -> Optional[float]:
+        """Seconds until `extra` more tasks of a priority would be done, or None without a throughput sample."""
+        if not load["throughput"]:
+            return None
+        backlog = load["backlog"]
+        busy = [p for p in settings.PRIORITY_LEVELS if backlog[p] > 0 or p == priority]
+        share = settings.PRIORITY_RATIO[priority] / sum(settings.PRIORITY_RATIO[p] for p in busy)
+        return (backlog[priority] + extra) / (load["throughput"] * share)
+    
+    def _check_load(self, load: Dict[str, Any], priority: str, extra: int) -> Tuple[Optional[str], Optional[float]]:
+        """Why `extra` more tasks of a priority can't be accepted (None if they can), and when to retry."""
+        wait = self._estimate_wait(load, priority, extra)
+        target = settings.TARGET_P95_LATENCY[priority]
+        depth = load["backlog"][priority] + extra
+        limit = settings.ADMISSION_MAX_QUEUE_DEPTH[priority]
+        if depth > limit:
+            # Until enough of the backlog drains to make room
+            retry_after = wait * (depth - limit) / depth if wait is not None else settings.ADMISSION_RETRY_AFTER
+            return f"The {priority} queue is full ({load['backlog'][priority]} tasks waiting)", retry_after
+        if wait is not None and wait > target:
+            return f"Estimated wait of {wait:.0f}s exceeds the {target:.0f}s target for {priority} stories", wait - target
+        return None, None
+    
+    def _count(self, priorities: List[str], outcome: str):
+        """Record admission decisions per priority."""
+        for priority in priorities:
+            metrics.ADMISSIONS.labels(self._tier(priority), outcome).inc()
+    
+    async def admit(self, stories: List[Tuple[str, str]]) -> Dict[str, Any]:
+        """
+        Decide whether to accept a submission of one or more stories.
+        
+        Either every story is accepted or none is.
+        
+        Args:
+            stories: (user_id, priority) of each story
+        
+        Returns:
+            Dict with "admitted" and "priorities" (the priority each story is
+            queued at, lowered for deferred stories), plus "reason" and
+            "retry_after" (seconds, or None if retrying the same submission
+            can't succeed) when rejected
+        """
+        priorities = [priority for _, priority in stories]
+        if not settings.ADMISSION_ENABLED or not stories:
+            return {"admitted": True, "priorities": priorities}
+        
+        load = await self._get_load()
+        extra = {priority: 0 for priority in settings.PRIORITY_LEVELS}
+        for position, priority in enumerate(settings.PRIORITY_LEVELS):
+            indexes = [i for i, requested in enumerate(priorities) if self._tier(requested) == priority]
+            if not indexes:
+                continue
+            tasks = len(indexes) * settings.ADMISSION_TASKS_PER_STORY
+            reason, retry_after = self._check_load(load, priority, extra[priority] + tasks)
+            if reason is None:
+                extra[priority] += tasks
+                continue
+            
+            lower = settings.PRIORITY_LEVELS[position + 1] if position + 1 < len(settings.PRIORITY_LEVELS) else None
+            if settings.ADMISSION_DEFER and lower and self._check_load(load, lower, extra[lower] + tasks)[0] is None:
+                extra[lower] += tasks
+                for i in indexes:
+                    priorities[i] = lower
+                continue
+            
+            self._count(priorities, "overloaded")
+            return {"admitted": False, "priorities": priorities, "reason": reason, "retry_after": retry_after}
+        
+        # Users are charged at the priority they asked for, priorities for the work they take on
+        buckets: Dict[str, List[float]] = {}
+        for (user_id, requested), priority in zip(stories, priorities):
+            requested, priority = self._tier(requested), self._tier(priority)
+            for key, rate, burst in (
+                (f"admission:user:{requested}:{user_id}", settings.ADMISSION_USER_RATE[requested], settings.ADMISSION_USER_BURST[requested]),
+                (f"admission:priority:{priority}", settings.ADMISSION_PRIORITY_RATE[priority], settings.ADMISSION_PRIORITY_BURST[priority])
+            ):
+                buckets.setdefault(key, [rate / 60, burst, 0])[2] += 1
+        
+        for key, (_, burst, cost) in buckets.items():
+            if cost > burst:
+                self._count(priorities, "rate_limited")
+                return {
+                    "admitted": False,
+                    "priorities": priorities,
+                    "reason": f"{cost} stories exceed the burst limit of {burst} for {key.split(':', 1)[1]}",
+                    "retry_after": None
+                }
+        wait = float(await self.bucket_script(
+            keys=list(buckets), args=[value for bucket in buckets.values() for value in bucket]
+        ))
+        if wait > 0:
+            self._count(priorities, "rate_limited")
+            return {"admitted": False, "priorities": priorities, "reason": "Rate limit exceeded", "retry_after": wait}
+        
+        # Submissions decided on the same estimate see this one's tasks
+        for priority, tasks in extra.items():
+            load["backlog"][priority] += tasks
+        deferred = [i for i, (_, requested) in enumerate(stories) if priorities[i] != requested]
+        self._count([priorities[i] for i in deferred], "deferred")
+        self._count([priorities[i] for i in range(len(stories)) if i not in deferred], "admitted")
+        return {"admitted": True, "priorities": priorities}
+    
+    async def get_state(self) -> Dict[str, Any]:
+        """Backlog, throughput and estimated wait per priority, as admission decisions see them."""
+        load = await self._get_load()
+        return {
+            "enabled": settings.ADMISSION_ENABLED,
+            "throughput": load["throughput"],
+            "priorities": {
+                priority: {
+                    "backlog": load["backlog"][priority],
+                    "max_backlog": settings.ADMISSION_MAX_QUEUE_DEPTH[priority],
+                    "estimated_wait": self._estimate_wait(load, priority),
+                    "target": settings.TARGET_P95_LATENCY[priority]
+                }
+                for priority in settings.PRIORITY_LEVELS
+            }
+        }
@@ -0,0 +1,151 @@
+import logging
+import time
+from typing import List, Dict, Any, Tuple
+
+import metrics
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+def _affinity_hits(tasks: List[Dict[str, Any]]) -> Tuple[int, int]:
+    """Tasks sharing a reference image, and a story, with an earlier task of the same batch."""
+    references = set()
+    stories = set()
+    reference_hits = 0
+    story_hits = 0
+    for task in tasks:
+        reference = task.get("reference_image")
+        if reference:
+            if reference in references:
+                reference_hits += 1
+            references.add(reference)
+        if task["story_id"] in stories:
+            story_hits += 1
+        stories.add(task["story_id"])
+    return reference_hits, story_hits
+
+class _PackerState:
+    """Held-over tasks and counters of one task type."""
+    
+    def __init__(self):
+        # (task, monotonic time it was first held back), oldest first
+        self.held: List[Tuple[Dict[str, Any], float]] = []
+        self.batches = 0
+        self.tasks = 0
+        self.reference_hits = 0
+        self.story_hits = 0
+        self.fifo_reference_hits = 0
+        self.fifo_story_hits = 0
+        self.held_back = 0
+        self.forced = 0
+        self.max_delay = 0.0
+
+class AffinityPacker:
+    """
+    Packs batches so that tasks sharing a character reference or a story run together.
+    
+    Batches are formed from up to AFFINITY_LOOKAHEAD more tasks than they
+    hold. The packer starts a batch from the oldest task, then keeps adding
+    the oldest task that shares a reference image with a task already in the
+    batch, then one that shares a story, and only when there is none the
+    oldest remaining task. The GPU then encodes each reference once per
+    batch instead of once per task.
+    
+    Tasks left out are held in memory and offered first to the next batch of
+    their task type. A task held back for AFFINITY_MAX_DELAY seconds goes
+    into the next batch unconditionally, so reordering never delays any task
+    by more than that. Held tasks stay unacknowledged, so a crashed
+    batcher's held tasks are reclaimed like in-flight ones. List queues
+    have no such recovery and would lose them, so packing is only used with
+    the stream backend.
+    
+    Every batch is also scored as plain FIFO packing of the same tasks would
+    have been, so the gain is reported next to the hit rates.
+    """
+    
+    def __init__(self, task_types: List[str]):
+        self.states: Dict[str, _PackerState] = {task_type: _PackerState() for task_type in task_types}
+    
+    def take_held(self, task_type: str) -> List[Dict[str, Any]]:
+        """Tasks held over from the previous batch, oldest first; they are offered again to pack()."""
+        return [task for task, _ in self.states[task_type].held]
+    
+    def pack(self, task_type: str, candidates: List[Dict[str, Any]], size: int) -> List[Dict[str, Any]]:
+        """
+        Choose a batch of at most size tasks and hold the rest.
+        
+        Args:
+            task_type: Task type of the batch
+            candidates: take_held() tasks followed by newly popped ones, in queue order
+            size: Target batch size
+        
+        Returns:
+            The batch
+        """
+        state = self.states[task_type]
+        now = time.monotonic()
+        held_since = {id(task): since for task, since in state.held}
+        
+        if len(candidates) <= size:
+            batch = candidates
+            remaining: List[Dict[str, Any]] = []
+        else:
+            overdue = [
+                task for task in candidates
+                if id(task) in held_since and now - held_since[id(task)] >= settings.AFFINITY_MAX_DELAY
+            ]
+            batch = overdue[:size]
+            chosen = {id(task) for task in batch}
+            remaining = [task for task in candidates if id(task) not in chosen]
+            references = {task.get("reference_image") for task in batch} - {None}
+            stories = {task["story_id"] for task in batch}
+            state.forced += len(batch)
+            
+            while len(batch) < size and remaining:
+                pick = next((task for task in remaining if task.get("reference_image") in references), None)
+                if pick is None:
+                    pick = next((task for task in remaining if task["story_id"] in stories), remaining[0])
+                remaining.remove(pick)
+                batch.append(pick)
+                if pick.get("reference_image"):
+                    references.add(pick["reference_image"])
+                stories.add(pick["story_id"])
+        
+        for task in batch:
+            if id(task) in held_since:
+                state.max_delay = max(state.max_delay, now - held_since[id(task)])
+        state.held_back += sum(1 for task in remaining if id(task) not in held_since)
+        state.held = [(task, held_since.get(id(task), now)) for task in remaining]
+        
+        reference_hits, story_hits = _affinity_hits(batch)
+        fifo_reference_hits, fifo_story_hits = _affinity_hits(candidates[:size])
+        state.batches += 1
+        state.tasks += len(batch)
+        state.reference_hits += reference_hits
+        state.story_hits += story_hits
+        state.fifo_reference_hits += fifo_reference_hits
+        state.fifo_story_hits += fifo_story_hits
+        metrics.BATCH_AFFINITY_HITS.labels(task_type, "reference", "affinity").inc(reference_hits)
+        metrics.BATCH_AFFINITY_HITS.labels(task_type, "story", "affinity").inc(story_hits)
+        metrics.BATCH_AFFINITY_HITS.labels(task_type, "reference", "fifo").inc(fifo_reference_hits)
+        metrics.BATCH_AFFINITY_HITS.labels(task_type, "story", "fifo").inc(fifo_story_hits)
+        return batch
+    
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Affinity hit rates per task type, next to what FIFO packing would have achieved."""
+        stats = {}
+        for task_type, state in self.states.items():
+            tasks = state.tasks or 1
+            stats[task_type] = {
+                "batches": state.batches,
+                "tasks": state.tasks,
+                "reference_hit_rate": state.reference_hits / tasks,
+                "story_hit_rate": state.story_hits / tasks,
+                "fifo_reference_hit_rate": state.fifo_reference_hits / tasks,
+                "fifo_story_hit_rate": state.fifo_story_hits / tasks,
+                "held": len(state.held),
+                "held_back": state.held_back,
+                "forced": state.forced,
+                "max_delay": state.max_delay
+            }
+        return stats
@@ -1,90 +1,401 @@
 import asyncio
-import json
 import logging
 import time
 import uuid
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 import redis.asyncio as redis
 from datetime import datetime
 
+import metrics
 from config import settings
+from redis_pool import get_redis_client
+from batching.scheduler import WeightedFairScheduler
+from batching.task_graph import TaskGraph
+from batching.adaptive import AdaptiveBatchController
+from batching.queue_backend import get_queue_backend
+from batching.task_codec import TaskCodec
+from batching.result_cache import ResultCache
+from batching.story_progress import StoryProgress
+from batching.cancellation import StoryCancellation
+from batching.admission import ThroughputMeter
+from batching.affinity import AffinityPacker
+from ingestion.character_cache import CharacterReferenceCache
+from gpu_workers.worker_interface import GPUWorkerInterface, get_gpu_worker
+from composer.video_composer import VideoComposer, get_video_composer
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class BatchingService:
-    def __init__(self):
-        self.redis_client = redis.Redis(
-            host=settings.REDIS_HOST,
-            port=settings.REDIS_PORT,
-            password=settings.REDIS_PASSWORD,
-            decode_responses=True
-        )
+    def __init__(
+        self,
+        redis_client: Optional[redis.Redis] = None,
+        gpu_worker: Optional[GPUWorkerInterface] = None,
+        composer: Optional[VideoComposer] = None
+    ):
+        self.redis_client = redis_client or get_redis_client()
+        self.gpu_worker = gpu_worker or get_gpu_worker()
+        self.composer = composer or (get_video_composer() if settings.COMPOSER_ENABLED else None)
+        self.result_cache = ResultCache(self.redis_client) if settings.RESULT_CACHE_ENABLED else None
         self.batches: Dict[str, List[Dict[str, Any]]] = {}
         self.batch_timestamps: Dict[str, float] = {}
-        
+        self.codec = TaskCodec(self.redis_client)
+        self.queue_backend = get_queue_backend(self.redis_client, self.codec)
+        self.task_graph = TaskGraph(self.redis_client, self.queue_backend)
+        self.character_cache = CharacterReferenceCache(self.redis_client)
+        self.progress = StoryProgress(self.redis_client)
+        self.cancellation = StoryCancellation(self.redis_client)
+        self.throughput = ThroughputMeter(self.redis_client)
+        self.adaptive = AdaptiveBatchController(settings.TASK_TYPES)
+        # Packing holds tasks back in memory, where only the stream backend can recover them from a crash
+        self.packer = None
+        if settings.AFFINITY_PACKING_ENABLED:
+            if self.queue_backend.name == "stream":
+                self.packer = AffinityPacker(settings.TASK_TYPES)
+            else:
+                logger.warning(f"Affinity packing needs QUEUE_BACKEND=stream; disabled on the {self.queue_backend.name} backend")
+        self.schedulers: Dict[str, WeightedFairScheduler] = {
+            task_type: WeightedFairScheduler(
+                self.queue_backend,
+                queues={priority: settings.QUEUE_NAMES[task_type][priority] for priority in settings.PRIORITY_LEVELS},
+                weights=settings.PRIORITY_RATIO,
+                max_wait=settings.SCHEDULER_MAX_WAIT
+            )
+            for task_type in settings.TASK_TYPES
+        }
+    
     async def start(self):
-        """Start all batching loops concurrently."""
-        tasks = []
-        for task_type in settings.TASK_TYPES:
-            for priority in settings.PRIORITY_LEVELS:
-                queue_name = settings.QUEUE_NAMES[task_type][priority]
-                tasks.append(self.batch_loop(queue_name))
-        
+        """Start one batching loop (and one reclaim loop) per task type concurrently, and follow cancellations."""
+        await self.queue_backend.setup([
+            queue_name for queues in settings.QUEUE_NAMES.values() for queue_name in queues.values()
+        ])
+        tasks = [self.batch_loop(task_type) for task_type in settings.TASK_TYPES]
+        tasks += [self.reclaim_loop(task_type) for task_type in settings.TASK_TYPES]
+        tasks.append(self.cancellation.listen(self._interrupt_cancelled))
         await asyncio.gather(*tasks)
     
-    async def batch_loop(self, queue_name: str):
-        """Main batching loop for a specific queue."""
-        logger.info(f"Starting batch loop for {queue_name}")
+    async def batch_loop(self, task_type: str):
+        """Main batching loop for a task type, fed by its weighted fair scheduler."""
+        logger.info(f"Starting batch loop for {task_type}")
         
         while True:
             try:
-                batch = []
-                start_time = time.time()
+                # Don't pull work off the queues while the GPU service is down
+                await self.gpu_worker.circuit_breaker.wait_until_available()
                 
-                # Try to form a batch
-                while len(batch) < settings.BATCH_SIZE:
-                    # Check if we've exceeded the timeout
-                    if time.time() - start_time > settings.BATCH_TIMEOUT:
-                        break
-                    
-                    # Try to get a task from the queue
-                    task_data = await self.redis_client.rpop(queue_name)
-                    if task_data:
-                        task = json.loads(task_data)
-                        batch.append(task)
-                    else:
-                        # No tasks available, wait a bit
-                        await asyncio.sleep(0.1)
+                batch = await self._form_batch(task_type)
                 
                 # Process the batch if we have any tasks
                 if batch:
-                    await self.process_batch(queue_name, batch)
-                
+                    await self.process_batch(task_type, batch)
+            
             except Exception as e:
-                logger.error(f"Error in batch loop for {queue_name}: {str(e)}")
+                logger.error(f"Error in batch loop for {task_type}: {str(e)}")
                 await asyncio.sleep(1)  # Wait before retrying
     
-    async def process_batch(self, queue_name: str, batch: List[Dict[str, Any]]):
-        """Process a batch of tasks by sending it to the GPU service."""
+    async def reclaim_loop(self, task_type: str):
+        """Periodically reprocess in-flight tasks abandoned by crashed or failed batchers."""
+        if self.queue_backend.name != "stream":
+            return
+        queue_names = list(settings.QUEUE_NAMES[task_type].values())
+        
+        while True:
+            try:
+                await asyncio.sleep(settings.STREAM_CLAIM_INTERVAL)
+                await self.gpu_worker.circuit_breaker.wait_until_available()
+                
+                claimed, dead = await self.queue_backend.reclaim(queue_names)
+                if dead:
+                    await self._fail(task_type, dead, "Task exceeded the maximum number of deliveries")
+                for start in range(0, len(claimed), settings.BATCH_MAX_SIZE):
+                    await self.process_batch(task_type, claimed[start:start + settings.BATCH_MAX_SIZE])
+            
+            except Exception as e:
+                logger.error(f"Error in reclaim loop for {task_type}: {str(e)}")
+    
+    async def _interrupt_cancelled(self, story_id: str):
+        """Stop GPU work in flight for a story cancelled from any process."""
+        try:
+            stopped = await self.gpu_worker.interrupt(set(self.cancellation.cancelled))
+            if stopped:
+                logger.info(f"Interrupted {stopped} GPU jobs after story {story_id} was cancelled")
+        except Exception as e:
+            logger.error(f"Error interrupting GPU work of cancelled story {story_id}: {str(e)}")
+    
+    async def _form_batch(self, task_type: str) -> List[Dict[str, Any]]:
+        """
+        Form a batch for a task type without client-side polling.
+        
+        Blocks server-side (BRPOP or XREADGROUP across the priority queues,
+        depending on QUEUE_BACKEND) until the first
+        task arrives, then fills the batch with pipelined multi-pops split
+        between priorities by the task type's WeightedFairScheduler. Batch size
+        and linger window come from the AdaptiveBatchController, re-planned from
+        the queue depths seen on every pop; a short batch lingers with further
+        blocking pops until the linger window since the first task has elapsed.
+        
+        With affinity packing, up to AFFINITY_LOOKAHEAD queued tasks beyond the
+        batch size are taken as well and the AffinityPacker picks the batch
+        from them; the tasks it holds back start the next batch without waiting.
+        
+        Returns:
+            List of decoded tasks, empty if nothing arrived within BATCH_BLOCK_TIMEOUT
+        """
+        scheduler = self.schedulers[task_type]
+        batch = self.packer.take_held(task_type) if self.packer is not None else []
+        if not batch:
+            batch = await scheduler.wait_for_task(settings.BATCH_BLOCK_TIMEOUT)
+        if not batch:
+            return []
+        
+        first_at = time.monotonic()
+        reason = "timeout"
+        
+        while True:
+            # Drain whatever is already queued, split by weighted fair share
+            batch.extend(await scheduler.pop(lambda depths: self._plan_batch(task_type, depths, len(batch))))
+            if len(batch) >= self.adaptive.batch_size(task_type):
+                reason = "full"
+                break
+            
+            remaining = first_at + self.adaptive.linger(task_type) - time.monotonic()
+            if remaining <= 0:
+                break
+            
+            # Queues are empty: wait server-side for the rest of the linger window
+            tasks = await scheduler.wait_for_task(max(remaining, 0.01))
+            if not tasks:
+                break
+            batch.extend(tasks)
+        
+        if self.packer is not None:
+            batch = self.packer.pack(task_type, batch, self.adaptive.batch_size(task_type))
+        metrics.BATCH_FORMATION.labels(task_type).observe(time.monotonic() - first_at)
+        metrics.BATCH_FLUSHES.labels(task_type, reason).inc()
+        metrics.BATCH_FILL_RATIO.labels(task_type).observe(min(1.0, len(batch) / self.adaptive.batch_size(task_type)))
+        return batch
+    
+    def _plan_batch(self, task_type: str, depths: Dict[str, int], in_batch: int) -> int:
+        """Re-plan the batch from current queue depths and return how many more tasks to take."""
+        self.adaptive.update(task_type, depths, in_batch)
+        lookahead = settings.AFFINITY_LOOKAHEAD if self.packer is not None else 0
+        return max(0, self.adaptive.batch_size(task_type) + lookahead - in_batch)
+    
+    def get_scheduler_stats(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        """Get achieved share and queue wait per priority for every task type."""
+        return {
+            task_type: scheduler.get_stats()
+            for task_type, scheduler in self.schedulers.items()
+        }
+    
+    async def process_batch(self, task_type: str, batch: List[Dict[str, Any]]):
+        """Process a batch of tasks by sending it to the GPU service; tasks of cancelled stories are dropped first."""
+        claimed: List[str] = []
+        settled = False
         try:
+            batch, cancelled = await self.cancellation.split(batch)
+            if cancelled:
+                await self.queue_backend.ack(cancelled)
+                await self.character_cache.unpin(cancelled)
+                metrics.BATCH_TASKS.labels(task_type, "cancelled").inc(len(cancelled))
+                logger.info(f"Dropped {len(cancelled)} {task_type} tasks of cancelled stories")
+            if not batch:
+                return
+            
             batch_id = str(uuid.uuid4())
-            logger.info(f"Processing batch {batch_id} with {len(batch)} tasks from {queue_name}")
+            logger.debug(f"Processing batch {batch_id} with {len(batch)} {task_type} tasks")
             
-            # TODO: Implement actual GPU service call
-            # For now, just log the batch
+            # Only the GPU request and callbacks need the full task records
+            dequeued_at = datetime.utcnow().timestamp()
             for task in batch:
-                logger.info(f"Processing task {task['task_id']} in batch {batch_id}")
+                metrics.QUEUE_WAIT.labels(task_type, task["priority"]).observe(max(0.0, dequeued_at - task["timestamp"]))
+            inflated, orphaned = await self.codec.inflate(batch)
+            if orphaned:
+                # Tasks whose story metadata expired can't be run or reported back, so they fail
+                orphans = [batch[index] for index in orphaned]
+                await self._complete(
+                    task_type,
+                    orphans,
+                    [inflated[index] for index in orphaned],
+                    {"task_results": [{"status": "failed", "error": "Task metadata expired"}] * len(orphans)}
+                )
+                await self.queue_backend.ack(orphans)
+                metrics.BATCH_TASKS.labels(task_type, "expired").inc(len(orphans))
+                kept = [index for index in range(len(batch)) if index not in set(orphaned)]
+                batch = [batch[index] for index in kept]
+                inflated = [inflated[index] for index in kept]
+                if not batch:
+                    return
+            
+            # Cached and duplicate tasks are answered without the GPU, and
+            # tasks identical to one running elsewhere wait for its result
+            hits: Dict[int, Dict[str, Any]] = {}
+            duplicates: Dict[int, int] = {}
+            parked: set = set()
+            if self.result_cache is not None:
+                hits, duplicates, parked_indexes, keys = await self.result_cache.claim(inflated)
+                parked = set(parked_indexes)
+            run = [index for index in range(len(batch)) if index not in hits and index not in duplicates and index not in parked]
+            if self.result_cache is not None:
+                claimed = [keys[index] for index in run]
             
-            # Simulate processing time
-            await asyncio.sleep(1)
+            task_results: List[Optional[Dict[str, Any]]] = [None] * len(batch)
+            if run:
+                # Sends the batch over the shared GPU client and queues callbacks
+                started = time.monotonic()
+                metrics.GPU_BATCHES_IN_FLIGHT.inc()
+                try:
+                    results = await self.gpu_worker.process_batch([inflated[index] for index in run])
+                finally:
+                    metrics.GPU_BATCHES_IN_FLIGHT.inc(-1)
+                gpu_latency = time.monotonic() - started
+                metrics.GPU_BATCH_LATENCY.labels(task_type).observe(gpu_latency)
+                self.adaptive.observe_batch(task_type, [batch[index] for index in run], gpu_latency, dequeued_at)
+                for index, result in zip(run, results.get("task_results", [])):
+                    task_results[index] = result
+            for index, result in hits.items():
+                task_results[index] = result
+            for index, lead in duplicates.items():
+                task_results[index] = task_results[lead]
+            answered = list(hits) + list(duplicates)
+            if answered:
+                await self.gpu_worker.deliver(
+                    [inflated[index] for index in answered],
+                    {"task_results": [task_results[index] for index in answered]}
+                )
             
-            # TODO: Implement callback to notify task completion
-            logger.info(f"Completed batch {batch_id}")
+            done = [index for index in range(len(batch)) if index not in parked]
+            released = await self._complete(
+                task_type,
+                [batch[index] for index in done],
+                [inflated[index] for index in done],
+                {"task_results": [task_results[index] for index in done]}
+            )
+            settled = True
             
+            # Acknowledge the batch so it is never redelivered; parked tasks
+            # are held by the result cache until their key is finished
+            await self.queue_backend.ack(batch)
+            released += await self._finish_claims(task_type, claimed, [task_results[index] for index in run])
+            claimed = []
+            metrics.BATCH_TASKS.labels(task_type, "gpu").inc(len(run))
+            metrics.BATCH_TASKS.labels(task_type, "cached").inc(len(answered))
+            metrics.BATCH_TASKS.labels(task_type, "merged").inc(len(parked))
+            logger.info(
+                f"Completed batch {batch_id}: {len(run)} run, {len(answered)} cached or shared, "
+                f"{len(parked)} waiting on identical tasks; released {released} dependent tasks"
+            )
+        
         except Exception as e:
-            logger.error(f"Error processing batch from {queue_name}: {str(e)}")
-            # TODO: Implement retry logic or dead letter queue
+            logger.error(f"Error processing {task_type} batch: {str(e)}")
+            if claimed:
+                # Let tasks parked behind this batch run on their own
+                await self._finish_claims(task_type, claimed, [None] * len(claimed))
+            # A settled batch already handed out its results; running it again would repeat them
+            if not settled and not self.gpu_worker.circuit_breaker.allow_request():
+                # The GPU service is down: keep the tasks for when it recovers
+                await self._requeue(batch)
+            elif not settled and self.queue_backend.name != "stream":
+                # Unacknowledged stream entries are reclaimed and retried until dead-lettered;
+                # list tasks fail, along with the tasks depending on them
+                await self._fail(task_type, batch, str(e))
+    
+    async def _fail(self, task_type: str, batch: List[Dict[str, Any]], error: str):
+        """Settle tasks that will not be retried as failed, along with the tasks depending on them."""
+        inflated, _ = await self.codec.inflate(batch)
+        failed = {"task_results": [{"status": "failed", "error": error}] * len(batch)}
+        # Tasks whose story metadata expired have nowhere to report to
+        await self.gpu_worker.notify_failed([task for task in inflated if task.get("callback_url")], error)
+        await self._complete(task_type, batch, inflated, failed)
+    
+    async def _complete(
+        self,
+        task_type: str,
+        tasks: List[Dict[str, Any]],
+        inflated: List[Dict[str, Any]],
+        results: Dict[str, Any]
+    ) -> int:
+        """
+        Run the post-result steps for finished tasks.
+        
+        Dependents of completed tasks are released; dependents of failed
+        ones can never run, so they fail too, down the whole chain.
+        
+        Returns:
+            Number of dependents released
+        """
+        if not tasks:
+            return 0
+        
+        # Finished clips go straight to the video composer, which runs in the background
+        if task_type == "clip" and self.composer is not None:
+            self.composer.on_clips_completed(inflated, results)
+        
+        # Index character references written by this batch, and release the ones scenes were holding
+        if task_type == "character":
+            await self.character_cache.register_results(tasks)
+        elif task_type == "scene":
+            await self.character_cache.unpin(tasks)
+        
+        # Dependents are keyed by these outputs, so they are recorded before the dependents run
+        if self.result_cache is not None:
+            await self.result_cache.record_outputs(inflated, results)
+        
+        await self.progress.record(inflated, results)
+        await self.throughput.record(len(tasks))
+        await self.cancellation.untrack(tasks)
+        
+        task_results = results.get("task_results", [])
+        completed = [
+            index < len(task_results) and isinstance(task_results[index], dict)
+            and task_results[index].get("status") == "completed"
+            for index in range(len(tasks))
+        ]
+        
+        # Make tasks waiting on completed ones visible to the batch loops
+        released = await self.task_graph.complete([task for task, ok in zip(tasks, completed) if ok])
+        dependents = await self.task_graph.fail([task for task, ok in zip(tasks, completed) if not ok])
+        by_type: Dict[str, List[Dict[str, Any]]] = {}
+        for task_data in dependents:
+            by_type.setdefault(task_data["task_type"], []).append(task_data)
+        for dependent_type, group in by_type.items():
+            await self._fail(dependent_type, group, "A task it depends on failed")
+        return released
+    
+    async def _finish_claims(self, task_type: str, keys: List[str], results: List[Optional[Dict[str, Any]]]) -> int:
+        """
+        Record results for claimed cache keys and settle the tasks parked behind them.
+        
+        Parked tasks get the result of a successful run; after a failure they
+        are queued again to run on their own.
+        
+        Returns:
+            Number of dependent tasks released
+        """
+        released = 0
+        for key, result in zip(keys, results):
+            try:
+                parked = await self.result_cache.finish(key, result)
+                if not parked:
+                    continue
+                if result is not None and result.get("status") == "completed":
+                    shared = {"task_results": [{**result, "cached": True}] * len(parked)}
+                    await self.gpu_worker.deliver(parked, shared)
+                    released += await self._complete(task_type, parked, parked, shared)
+                else:
+                    async with self.redis_client.pipeline(transaction=True) as pipe:
+                        for task_data in parked:
+                            queue_name = settings.QUEUE_NAMES[task_data["task_type"]][task_data["priority"]]
+                            self.queue_backend.push(pipe, queue_name, [self.codec.encode(task_data)])
+                        await pipe.execute()
+            except Exception as e:
+                logger.error(f"Error settling tasks waiting on result {key}: {str(e)}")
+        return released
+    
+    async def _requeue(self, batch: List[Dict[str, Any]]):
+        """Return tasks to their queues for a later attempt."""
+        await self.queue_backend.requeue(batch)
+        logger.info(f"Requeued {len(batch)} tasks while the GPU service is unavailable")
     
     async def add_task(self, task_type: str, priority: str, task_data: Dict[str, Any]):
         """Add a new task to the appropriate queue."""
@@ -92,11 +403,87 @@ class BatchingService:
         task_data["timestamp"] = datetime.utcnow().timestamp()
         
         try:
-            await self.redis_client.lpush(queue_name, json.dumps(task_data))
-            logger.info(f"Added task {task_data['task_id']} to {queue_name}")
+            async with self.redis_client.pipeline(transaction=True) as pipe:
+                self.codec.stage_metadata(pipe, [task_data])
+                self.queue_backend.push(pipe, queue_name, [self.codec.encode(task_data)])
+                await pipe.execute()
+            logger.debug(f"Added task {task_data['task_id']} to {queue_name}")
         except Exception as e:
             logger.error(f"Error adding task to {queue_name}: {str(e)}")
             raise
+    
+    async def add_tasks(self, tasks: List[Dict[str, Any]], final: bool = True):
+        """
+        Add many tasks atomically in a single round-trip.
+        
+        Runnable tasks are grouped by target queue and pushed through the queue
+        backend (one LPUSH per queue for lists), and tasks listing "depends_on" are parked in their story's
+        TaskGraph, all inside a MULTI/EXEC transaction so either the whole set
+        is recorded or none of it is. Tasks are stored in the compact
+        TaskCodec format, with their story-level fields written once per story.
+        
+        A story may be enqueued in several calls (streamed submissions): every
+        call but the last passes final=False, and tasks in later calls may
+        depend on tasks from earlier ones.
+        
+        Args:
+            tasks: Task dictionaries, each with task_type and priority and
+                optionally depends_on (IDs of tasks in the same or an earlier call)
+            final: Whether these are the last tasks of their stories
+        """
+        timestamp = datetime.utcnow().timestamp()
+        for task_data in tasks:
+            task_data["timestamp"] = timestamp
+        
+        if not tasks:
+            return
+        
+        # Stories cancelled while they were being split get no further tasks
+        tasks, cancelled = await self.cancellation.split(tasks)
+        if cancelled:
+            logger.info(f"Skipped {len(cancelled)} tasks of cancelled stories")
+        if not tasks:
+            return
+        
+        try:
+            async with self.redis_client.pipeline(transaction=True) as pipe:
+                self.codec.stage_metadata(pipe, tasks)
+                if self.composer is not None:
+                    self.composer.stage_scenes(pipe, tasks, sealed=final)
+                await self.progress.stage(pipe, tasks, sealed=final)
+                self.cancellation.track(pipe, tasks)
+                self.character_cache.pin(pipe, tasks)
+                # Tasks with dependencies are parked in their story's graph
+                runnable = await self.task_graph.stage(pipe, tasks, open_ended=not final)
+                for queue_name, payloads in runnable.items():
+                    self.queue_backend.push(pipe, queue_name, payloads)
+                await pipe.execute()
+        except Exception as e:
+            logger.error(f"Error adding {len(tasks)} tasks: {str(e)}")
+            raise
+    
+    async def cancel_story(self, story_id: str) -> int:
+        """
+        Cancel a story's remaining work.
+        
+        Its tasks waiting on dependencies are discarded and its progress is
+        marked cancelled in one transaction. Queued tasks stay where they are
+        and are dropped when a batch picks them up, and every batcher is told
+        to interrupt GPU work running only for cancelled stories.
+        
+        Args:
+            story_id: Story to cancel
+        
+        Returns:
+            Number of the story's tasks that had not finished
+        """
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            await self.cancellation.cancel(pipe, story_id)
+            self.task_graph.discard(pipe, story_id)
+            await self.progress.cancel(pipe, story_id)
+            replies = await pipe.execute()
+        logger.info(f"Cancelled story {story_id} with {replies[0]} unfinished tasks")
+        return replies[0]
 
 async def start_batching_service():
     """Entry point to start the batching service."""
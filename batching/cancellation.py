@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import List, Dict, Any, Tuple, Callable, Awaitable
+import redis.asyncio as redis
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Marks a story cancelled (KEYS[1], expiring after ARGV[3] seconds), drops
+# its task index (KEYS[2]) and announces the story ID ARGV[2] on channel
+# ARGV[1]. Returns how many of its tasks were still queued or in flight.
+CANCEL_SCRIPT = """
+redis.call('SET', KEYS[1], ARGV[4], 'EX', ARGV[3])
+local tracked = redis.call('SCARD', KEYS[2])
+redis.call('DEL', KEYS[2])
+redis.call('PUBLISH', ARGV[1], ARGV[2])
+return tracked
+"""
+
+class StoryCancellation:
+    """
+    Cancelled-story markers and a per-story index of unfinished tasks.
+    
+    Queued tasks are never searched for: removing them from list queues
+    would take an LREM scan per queue. Instead a cancelled story gets a
+    marker key, and batches are checked against the markers of their
+    stories with one MGET right before dispatch, so cancelled tasks are
+    dropped when they reach the front of their queue.
+    Stories known to be cancelled are remembered in-process and not looked
+    up again.
+    
+    Every batcher also follows cancellations on STORY_CANCEL_CHANNEL so it
+    can stop GPU work already in flight for them.
+    
+    Keys:
+        story_cancelled:{story_id}  STRING cancellation time, expires after STORY_CANCEL_TTL
+        story_tasks:{story_id}      SET task IDs enqueued and not yet finished
+    """
+    
+    CANCELLED_PREFIX = "story_cancelled"
+    TASKS_PREFIX = "story_tasks"
+    
+    def __init__(self, redis_client: redis.Redis):
+        self.redis_client = redis_client
+        self.cancel_script = redis_client.register_script(CANCEL_SCRIPT)
+        self.cancelled: "OrderedDict[str, None]" = OrderedDict()
+    
+    def cancelled_key(self, story_id: str) -> str:
+        """Marker of a cancelled story."""
+        return f"{self.CANCELLED_PREFIX}:{story_id}"
+    
+    def tasks_key(self, story_id: str) -> str:
+        """Index of a story's unfinished tasks."""
+        return f"{self.TASKS_PREFIX}:{story_id}"
+    
+    def _remember(self, story_id: str):
+        """Add a story to this process's cancelled stories, forgetting the oldest beyond the cache size."""
+        self.cancelled[story_id] = None
+        self.cancelled.move_to_end(story_id)
+        if len(self.cancelled) > settings.STORY_CANCEL_CACHE_SIZE:
+            self.cancelled.popitem(last=False)
+    
+    def track(self, pipe: redis.client.Pipeline, tasks: List[Dict[str, Any]]):
+        """Queue the indexing of newly enqueued tasks on the pipeline that enqueues them."""
+        stories: Dict[str, List[str]] = {}
+        for task in tasks:
+            stories.setdefault(task["story_id"], []).append(task["task_id"])
+        for story_id, task_ids in stories.items():
+            pipe.sadd(self.tasks_key(story_id), *task_ids)
+            pipe.expire(self.tasks_key(story_id), settings.TASK_GRAPH_TTL)
+    
+    async def untrack(self, tasks: List[Dict[str, Any]]):
+        """Remove finished tasks from their stories' indexes."""
+        if not tasks:
+            return
+        stories: Dict[str, List[str]] = {}
+        for task in tasks:
+            stories.setdefault(task["story_id"], []).append(task["task_id"])
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for story_id, task_ids in stories.items():
+                pipe.srem(self.tasks_key(story_id), *task_ids)
+            await pipe.execute()
+    
+    async def cancel(self, pipe: redis.client.Pipeline, story_id: str):
+        """Queue a story's cancellation on a pipeline; its reply is the number of unfinished tasks."""
+        await self.cancel_script(
+            keys=[self.cancelled_key(story_id), self.tasks_key(story_id)],
+            args=[settings.STORY_CANCEL_CHANNEL, story_id, settings.STORY_CANCEL_TTL, time.time()],
+            client=pipe
+        )
+    
+    async def split(self, tasks: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """
+        Separate tasks of cancelled stories from the rest.
+        
+        Args:
+            tasks: Tasks about to be enqueued or dispatched
+        
+        Returns:
+            (tasks to keep, tasks of cancelled stories), each in their original order
+        """
+        unknown = list({task["story_id"] for task in tasks} - self.cancelled.keys())
+        if unknown:
+            markers = await self.redis_client.mget([self.cancelled_key(story_id) for story_id in unknown])
+            for story_id, marker in zip(unknown, markers):
+                if marker is not None:
+                    self._remember(story_id)
+        
+        if not self.cancelled:
+            return tasks, []
+        kept = [task for task in tasks if task["story_id"] not in self.cancelled]
+        dropped = [task for task in tasks if task["story_id"] in self.cancelled]
+        return kept, dropped
+    
+    async def listen(self, on_cancel: Callable[[str], Awaitable[None]]):
+        """Hand every story cancelled from any process to on_cancel."""
+        while True:
+            pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(settings.STORY_CANCEL_CHANNEL)
+                async for message in pubsub.listen():
+                    self._remember(message["data"])
+                    await on_cancel(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Story cancellation subscription failed: {str(e)}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
@@ -0,0 +1,315 @@
+import json
+import logging
+import os
+import socket
+from typing import List, Dict, Any, Optional, Tuple
+import redis.asyncio as redis
+from redis.client import NEVER_DECODE
+from redis.exceptions import ResponseError
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Task payloads may be binary, so commands returning them skip the client's
+# response decoding
+RAW = {NEVER_DECODE: []}
+
+class JsonCodec:
+    """Plain JSON payloads, used for queues of story requests."""
+    
+    def encode(self, task_data: Dict[str, Any]) -> str:
+        """Serialize a task."""
+        return json.dumps(task_data)
+    
+    def decode(self, payload: bytes) -> Dict[str, Any]:
+        """Deserialize a task."""
+        return json.loads(payload)
+    
+    def timestamp(self, payload: bytes) -> Optional[float]:
+        """Read a payload's enqueue time."""
+        return json.loads(payload).get("timestamp")
+
+def _text(value) -> str:
+    """Decode a raw reply value that is always text (key names, stream IDs)."""
+    return value.decode() if isinstance(value, bytes) else value
+
+class ListQueueBackend:
+    """
+    Task queues on plain Redis lists.
+    
+    Tasks are LPUSHed and RPOPed, so dequeueing is destructive: a task popped
+    by a batcher that crashes before processing it is lost. Suitable for a
+    single BatchingService instance.
+    
+    Payloads are serialized with the given codec (JSON by default).
+    """
+    
+    name = "list"
+    
+    def __init__(self, redis_client: redis.Redis, codec=None):
+        self.redis_client = redis_client
+        self.codec = codec or JsonCodec()
+    
+    async def setup(self, queue_names: List[str]):
+        """Prepare queues for consuming (nothing to do for lists)."""
+    
+    def push(self, pipe: redis.client.Pipeline, queue_name: str, payloads: List):
+        """Queue serialized tasks on a pipeline."""
+        pipe.lpush(queue_name, *payloads)
+    
+    async def block_pop(self, queue_names: List[str], timeout: float) -> List[Tuple[str, Dict[str, Any]]]:
+        """Block server-side until one of the queues has a task, preferring earlier queues."""
+        item = await self.redis_client.execute_command("BRPOP", *queue_names, timeout, **RAW)
+        if not item:
+            return []
+        queue_name, payload = item
+        return [(_text(queue_name), self.codec.decode(payload))]
+    
+    async def inspect(self, queue_names: List[str]) -> Tuple[Dict[str, int], Dict[str, Optional[float]]]:
+        """
+        Read queue depths and the enqueue time of each queue's oldest task.
+        
+        Returns:
+            (queue name -> depth, queue name -> oldest task timestamp or None)
+        """
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for queue_name in queue_names:
+                pipe.llen(queue_name)
+                pipe.execute_command("LINDEX", queue_name, -1, **RAW)
+            replies = await pipe.execute()
+        
+        depths = {}
+        oldest = {}
+        for i, queue_name in enumerate(queue_names):
+            depths[queue_name] = replies[2 * i]
+            oldest[queue_name] = self.codec.timestamp(replies[2 * i + 1]) if replies[2 * i + 1] else None
+        return depths, oldest
+    
+    async def pop(self, counts: Dict[str, int]) -> Dict[str, List[Dict[str, Any]]]:
+        """Pop the given number of tasks from each queue in one round-trip."""
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for queue_name, count in counts.items():
+                pipe.execute_command("RPOP", queue_name, count, **RAW)
+            popped = await pipe.execute()
+        
+        return {
+            queue_name: [self.codec.decode(payload) for payload in items or []]
+            for queue_name, items in zip(counts, popped)
+        }
+    
+    async def ack(self, tasks: List[Dict[str, Any]]):
+        """Acknowledge processed tasks (nothing to do for lists)."""
+    
+    async def requeue(self, tasks: List[Dict[str, Any]]):
+        """Put tasks back at the consuming end of their queues."""
+        by_queue: Dict[str, List] = {}
+        for task_data in tasks:
+            queue_name = settings.QUEUE_NAMES[task_data["task_type"]][task_data["priority"]]
+            by_queue.setdefault(queue_name, []).append(self.codec.encode(task_data))
+        
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            for queue_name, payloads in by_queue.items():
+                pipe.rpush(queue_name, *reversed(payloads))
+            await pipe.execute()
+    
+    async def reclaim(self, queue_names: List[str]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """Claim abandoned in-flight tasks (lists keep no in-flight state)."""
+        return [], []
+
+class StreamQueueBackend:
+    """
+    Task queues on Redis Streams consumer groups.
+    
+    Each queue is a stream ("<queue name>:stream") read by the STREAM_GROUP
+    consumer group, so any number of BatchingService instances can share the
+    work. Delivered tasks stay in the reading consumer's pending list until
+    they are acknowledged after successful GPU processing; entries idle for
+    longer than STREAM_CLAIM_IDLE (their consumer crashed or failed) are
+    claimed by another consumer, and entries delivered STREAM_MAX_DELIVERIES
+    times are moved to the STREAM_DEAD_LETTER stream.
+    
+    Tasks read from a stream carry "_stream" and "_stream_id" so they can be
+    acknowledged. Payloads are serialized with the given codec (JSON by
+    default).
+    """
+    
+    name = "stream"
+    
+    def __init__(self, redis_client: redis.Redis, codec=None, consumer: Optional[str] = None):
+        self.redis_client = redis_client
+        self.codec = codec or JsonCodec()
+        self.group = settings.STREAM_GROUP
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+    
+    @staticmethod
+    def stream_key(queue_name: str) -> str:
+        """Stream backing a queue (mirrored by the task graph's release script)."""
+        return f"{queue_name}:stream"
+    
+    def _decode(self, stream: str, entries) -> List[Dict[str, Any]]:
+        """Decode stream entries into tasks tagged with their stream position."""
+        tasks = []
+        for entry_id, fields in entries:
+            if not fields:
+                # Entry was deleted while pending
+                continue
+            task = self.codec.decode(fields[b"task"])
+            task["_stream"] = stream
+            task["_stream_id"] = _text(entry_id)
+            tasks.append(task)
+        return tasks
+    
+    async def setup(self, queue_names: List[str]):
+        """Create the consumer group on every queue's stream."""
+        for queue_name in queue_names:
+            try:
+                await self.redis_client.xgroup_create(self.stream_key(queue_name), self.group, id="0", mkstream=True)
+            except ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+    
+    def push(self, pipe: redis.client.Pipeline, queue_name: str, payloads: List):
+        """Queue serialized tasks on a pipeline."""
+        for payload in payloads:
+            pipe.xadd(self.stream_key(queue_name), {"task": payload})
+    
+    async def block_pop(self, queue_names: List[str], timeout: float) -> List[Tuple[str, Dict[str, Any]]]:
+        """Block server-side until one of the streams has a new entry."""
+        streams = {self.stream_key(queue_name): ">" for queue_name in queue_names}
+        reply = await self.redis_client.execute_command(
+            "XREADGROUP", "GROUP", self.group, self.consumer, "COUNT", 1, "BLOCK", max(1, int(timeout * 1000)),
+            "STREAMS", *streams, *streams.values(), **RAW
+        )
+        by_stream = {self.stream_key(queue_name): queue_name for queue_name in queue_names}
+        items = []
+        for stream, entries in reply or []:
+            stream = _text(stream)
+            items.extend((by_stream[stream], task) for task in self._decode(stream, entries))
+        return items
+    
+    async def inspect(self, queue_names: List[str]) -> Tuple[Dict[str, int], Dict[str, Optional[float]]]:
+        """
+        Read undelivered depths and the enqueue time of each stream's oldest undelivered task.
+        
+        Acknowledged entries are deleted, so the undelivered depth is the stream
+        length minus the group's pending count.
+        """
+        streams = [self.stream_key(queue_name) for queue_name in queue_names]
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for stream in streams:
+                pipe.xlen(stream)
+                pipe.xinfo_groups(stream)
+            # XINFO GROUPS fails on streams that setup() has not created yet
+            replies = await pipe.execute(raise_on_error=False)
+        
+        depths = {}
+        last_delivered = {}
+        for i, queue_name in enumerate(queue_names):
+            groups = replies[2 * i + 1] if not isinstance(replies[2 * i + 1], ResponseError) else []
+            group = next((g for g in groups if g["name"] == self.group), None)
+            pending = group["pending"] if group else 0
+            depths[queue_name] = max(0, replies[2 * i] - pending)
+            last_delivered[queue_name] = group["last-delivered-id"] if group else "0-0"
+        
+        oldest: Dict[str, Optional[float]] = {queue_name: None for queue_name in queue_names}
+        waiting = [queue_name for queue_name in queue_names if depths[queue_name]]
+        if waiting:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                for queue_name in waiting:
+                    pipe.execute_command(
+                        "XRANGE", self.stream_key(queue_name), f"({last_delivered[queue_name]}", "+", "COUNT", 1, **RAW
+                    )
+                replies = await pipe.execute()
+            for queue_name, entries in zip(waiting, replies):
+                if entries:
+                    # Stream IDs start with the millisecond they were added at
+                    oldest[queue_name] = int(_text(entries[0][0]).split("-")[0]) / 1000
+        return depths, oldest
+    
+    async def pop(self, counts: Dict[str, int]) -> Dict[str, List[Dict[str, Any]]]:
+        """Read the given number of new entries from each stream in one round-trip."""
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for queue_name, count in counts.items():
+                pipe.execute_command(
+                    "XREADGROUP", "GROUP", self.group, self.consumer, "COUNT", count,
+                    "STREAMS", self.stream_key(queue_name), ">", **RAW
+                )
+            replies = await pipe.execute()
+        
+        popped = {}
+        for queue_name, reply in zip(counts, replies):
+            popped[queue_name] = []
+            for stream, entries in reply or []:
+                popped[queue_name].extend(self._decode(_text(stream), entries))
+        return popped
+    
+    async def ack(self, tasks: List[Dict[str, Any]]):
+        """Acknowledge and delete processed entries."""
+        by_stream: Dict[str, List[str]] = {}
+        for task in tasks:
+            if task.get("_stream_id"):
+                by_stream.setdefault(task["_stream"], []).append(task["_stream_id"])
+        if not by_stream:
+            return
+        
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for stream, entry_ids in by_stream.items():
+                pipe.xack(stream, self.group, *entry_ids)
+                pipe.xdel(stream, *entry_ids)
+            await pipe.execute()
+    
+    async def requeue(self, tasks: List[Dict[str, Any]]):
+        """Leave tasks pending; they are claimed again once idle for STREAM_CLAIM_IDLE."""
+    
+    async def reclaim(self, queue_names: List[str]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """
+        Claim entries abandoned by other consumers and dead-letter poison entries.
+        
+        Returns:
+            (tasks now owned by this consumer that should be processed again,
+            dead-lettered tasks that should be settled as failed)
+        """
+        min_idle = int(settings.STREAM_CLAIM_IDLE * 1000)
+        claimed = []
+        dead = []
+        for queue_name in queue_names:
+            stream = self.stream_key(queue_name)
+            pending = await self.redis_client.xpending_range(
+                stream, self.group, min="-", max="+", count=settings.STREAM_CLAIM_BATCH, idle=min_idle
+            )
+            if not pending:
+                continue
+            
+            exhausted = [p["message_id"] for p in pending if p["times_delivered"] >= settings.STREAM_MAX_DELIVERIES]
+            retry = [p["message_id"] for p in pending if p["times_delivered"] < settings.STREAM_MAX_DELIVERIES]
+            
+            if exhausted:
+                exhausted_ids = set(exhausted)
+                raw_entries = await self.redis_client.execute_command("XRANGE", stream, exhausted[0], exhausted[-1], **RAW)
+                entries = [
+                    (_text(entry_id), fields)
+                    for entry_id, fields in raw_entries
+                    if _text(entry_id) in exhausted_ids
+                ]
+                async with self.redis_client.pipeline(transaction=True) as pipe:
+                    for entry_id, fields in entries:
+                        pipe.xadd(settings.STREAM_DEAD_LETTER, {"stream": stream, "entry_id": entry_id, **fields})
+                    pipe.xack(stream, self.group, *exhausted)
+                    pipe.xdel(stream, *exhausted)
+                    await pipe.execute()
+                dead.extend(self._decode(stream, entries))
+                logger.error(f"Moved {len(exhausted)} tasks from {stream} to {settings.STREAM_DEAD_LETTER}")
+            
+            if retry:
+                entries = await self.redis_client.execute_command(
+                    "XCLAIM", stream, self.group, self.consumer, min_idle, *retry, **RAW
+                )
+                claimed.extend(self._decode(stream, entries))
+        return claimed, dead
+
+def get_queue_backend(redis_client: redis.Redis, codec=None):
+    """Create the task queue backend selected by QUEUE_BACKEND."""
+    if settings.QUEUE_BACKEND == "stream":
+        return StreamQueueBackend(redis_client, codec)
+    return ListQueueBackend(redis_client, codec)
@@ -0,0 +1,342 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import List, Dict, Any, Optional, Tuple
+import redis.asyncio as redis
+
+from config import settings
+from gpu_workers.artifact_store import ArtifactStore, get_artifact_store
+from gpu_workers.workflow_templates import SAMPLER_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+def _digest(inputs: Dict[str, Any]) -> str:
+    """SHA-256 of canonical JSON."""
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, separators=(",", ":"), default=str).encode()).hexdigest()
+
+# Task fields that determine a GPU result, besides the reference image
+KEY_FIELDS = ("task_type", "prompt", "negative_prompt", "seed", "checkpoint", "width", "height", *SAMPLER_SETTINGS)
+
+# Looks a key up and, on a miss, claims it for task ARGV[4]. Returns
+# {"hit", result} (refreshing the entry's TTL and recency), {"lead"} when the
+# caller should run the task and later call FINISH_SCRIPT, or {"wait"} after
+# parking ARGV[5..] behind the task already running for the key. A task
+# redelivered after its batcher died re-claims its own key. Parked tasks
+# outlive an expired claim, so the next claimant picks them up.
+CLAIM_SCRIPT = """
+local result = redis.call('GET', KEYS[1])
+if result then
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    redis.call('ZADD', KEYS[4], ARGV[1], KEYS[1])
+    return {'hit', result}
+end
+if redis.call('SET', KEYS[2], ARGV[4], 'NX', 'EX', ARGV[2]) or redis.call('GET', KEYS[2]) == ARGV[4] then
+    return {'lead'}
+end
+for i = 5, #ARGV do
+    redis.call('RPUSH', KEYS[3], ARGV[i])
+end
+redis.call('EXPIRE', KEYS[3], ARGV[3])
+return {'wait'}
+"""
+
+# Stores a key's result (unless ARGV[1] is empty, i.e. the task failed),
+# releases the claim and hands back the tasks parked behind it. Returns
+# {total cached bytes, parked task...}.
+FINISH_SCRIPT = """
+if ARGV[1] ~= '' then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    redis.call('ZADD', KEYS[4], ARGV[3], KEYS[1])
+    local previous = tonumber(redis.call('HGET', KEYS[5], KEYS[1]) or '0')
+    redis.call('HSET', KEYS[5], KEYS[1], string.len(ARGV[1]))
+    redis.call('INCRBY', KEYS[6], string.len(ARGV[1]) - previous)
+end
+redis.call('DEL', KEYS[2])
+local parked = redis.call('LRANGE', KEYS[3], 0, -1)
+redis.call('DEL', KEYS[3])
+local reply = {tonumber(redis.call('GET', KEYS[6]) or '0')}
+for _, task in ipairs(parked) do
+    table.insert(reply, task)
+end
+return reply
+"""
+
+class ResultCache:
+    """
+    Memoizes GPU results by the inputs that determine them.
+    
+    Tasks are keyed by a SHA-256 over their effective workflow inputs
+    (KEY_FIELDS, the workflow template and the reference image's file
+    identity), so identical requests from different users and stories
+    share one result. A task without a reference image that depends on
+    other tasks (a clip animating its scene image) takes their outputs as
+    input, so their artifact IDs, recorded by record_outputs(), are part of
+    its key. Tasks without an explicit seed get one derived from that key,
+    which makes their output reproducible and therefore reusable.
+    
+    claim() splits a batch three ways: hits are answered from Redis,
+    duplicates within the batch ride on their first occurrence, and of the
+    remaining misses only one per key, cluster-wide, runs on the GPU; the
+    others are parked in Redis until finish() hands them the result.
+    Results (artifact references, not content) are kept for RESULT_CACHE_TTL
+    after their last use, and the least recently used ones are evicted while
+    their total size exceeds RESULT_CACHE_MAX_BYTES.
+    
+    Keys:
+        result_cache:{key}           STRING JSON result
+        result_cache:{key}:inflight  STRING set while one task for the key runs
+        result_cache:{key}:waiters   LIST JSON tasks parked behind it
+        result_cache:lru             ZSET result key -> last use
+        result_cache:sizes           HASH result key -> size in bytes
+        result_cache:bytes           STRING total size in bytes
+        result_cache:output:{id}     STRING artifact ID of a finished task's output
+    """
+    
+    PREFIX = "result_cache"
+    LRU_KEY = "result_cache:lru"
+    SIZES_KEY = "result_cache:sizes"
+    TOTAL_KEY = "result_cache:bytes"
+    OUTPUT_PREFIX = "result_cache:output"
+    
+    def __init__(self, redis_client: redis.Redis, artifact_store: Optional[ArtifactStore] = None):
+        self.redis_client = redis_client
+        self.artifact_store = artifact_store or get_artifact_store()
+        self.claim_script = redis_client.register_script(CLAIM_SCRIPT)
+        self.finish_script = redis_client.register_script(FINISH_SCRIPT)
+        self.hits = 0
+        self.misses = 0
+        self.merged = 0
+    
+    def _keys(self, key: str) -> List[str]:
+        """Redis keys of a cache key, in the order the scripts expect."""
+        entry = f"{self.PREFIX}:{key}"
+        return [entry, f"{entry}:inflight", f"{entry}:waiters", self.LRU_KEY, self.SIZES_KEY, self.TOTAL_KEY]
+    
+    def key_for(self, task: Dict[str, Any], parents: Optional[List[str]] = None) -> Tuple[str, int]:
+        """
+        Canonical hash of the inputs that determine a task's result.
+        
+        Args:
+            task: Inflated task
+            parents: Identities of the outputs of the tasks it depends on,
+                for tasks that take them as input
+        
+        Returns:
+            (key, seed): the cache key and the task's seed, derived from its
+            inputs when the task has none
+        """
+        inputs = {field: task.get(field) for field in KEY_FIELDS}
+        inputs["workflow"] = settings.WORKFLOW_TEMPLATES.get(task.get("task_type"))
+        reference = task.get("reference_image")
+        if reference:
+            # References are hard links into the artifact store, so identical
+            # images share an inode even when their paths differ per story
+            try:
+                stat = os.stat(reference)
+                inputs["reference_image"] = [stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns]
+            except OSError:
+                inputs["reference_image"] = reference
+        if parents:
+            inputs["parents"] = parents
+        
+        if inputs["seed"] is None:
+            inputs["seed"] = int(_digest(inputs)[:12], 16)
+        return _digest(inputs), inputs["seed"]
+    
+    async def record_outputs(self, tasks: List[Dict[str, Any]], results: Dict[str, Any]):
+        """Remember the artifacts of finished tasks for the keys of the tasks depending on them."""
+        outputs = {
+            task["task_id"]: result["artifact"]["artifact"]
+            for task, result in zip(tasks, results.get("task_results", []))
+            if isinstance(result, dict) and result.get("status") == "completed" and result.get("artifact")
+        }
+        if not outputs:
+            return
+        
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for task_id, artifact_id in outputs.items():
+                pipe.set(f"{self.OUTPUT_PREFIX}:{task_id}", artifact_id, ex=settings.TASK_GRAPH_TTL)
+            await pipe.execute()
+    
+    async def _parents(self, tasks: List[Dict[str, Any]]) -> List[Optional[List[str]]]:
+        """
+        Output identities of the dependencies each task takes as input.
+        
+        Tasks with a reference image are keyed by its file instead. A
+        dependency whose output is unknown is identified by its task ID, so
+        the task is never confused with one built on a different output.
+        """
+        parent_ids = [
+            list(task.get("depends_on") or []) if not task.get("reference_image") else []
+            for task in tasks
+        ]
+        wanted = list(dict.fromkeys(parent_id for ids in parent_ids for parent_id in ids))
+        if not wanted:
+            return [None] * len(tasks)
+        
+        outputs = await self.redis_client.mget([f"{self.OUTPUT_PREFIX}:{parent_id}" for parent_id in wanted])
+        known = dict(zip(wanted, outputs))
+        return [
+            [known[parent_id] or f"task:{parent_id}" for parent_id in ids] if ids else None
+            for ids in parent_ids
+        ]
+    
+    def _usable(self, result: Dict[str, Any]) -> bool:
+        """Whether a cached result's artifact is still on the volume."""
+        artifact = result.get("artifact")
+        return not artifact or os.path.exists(artifact["path"])
+    
+    async def _claim_groups(self, tasks: List[Dict[str, Any]], groups: Dict[str, List[int]]) -> Dict[str, List]:
+        """Run CLAIM_SCRIPT for several keys in one round-trip."""
+        now = time.time()
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for key, members in groups.items():
+                await self.claim_script(
+                    keys=self._keys(key),
+                    args=[
+                        now,
+                        settings.RESULT_CACHE_INFLIGHT_TTL,
+                        settings.RESULT_CACHE_TTL,
+                        tasks[members[0]]["task_id"],
+                        *(json.dumps(tasks[index]) for index in members)
+                    ],
+                    client=pipe
+                )
+            replies = await pipe.execute()
+        return dict(zip(groups, replies))
+    
+    async def claim(self, tasks: List[Dict[str, Any]]) -> Tuple[Dict[int, Dict[str, Any]], Dict[int, int], List[int], List[str]]:
+        """
+        Look up a batch and claim its misses.
+        
+        Args:
+            tasks: Inflated tasks of one batch
+        
+        Returns:
+            (hits, duplicates, parked, keys): cached results by batch index;
+            batch index -> index of the identical earlier task whose result
+            it shares; indexes of tasks parked behind a task running
+            elsewhere; and each task's cache key. Every other task must be
+            run and its key passed to finish().
+        """
+        keys = []
+        for task, parents in zip(tasks, await self._parents(tasks)):
+            key, seed = self.key_for(task, parents)
+            if task.get("seed") is None:
+                # A derived seed makes the output reproducible and therefore reusable
+                task["seed"] = seed
+            keys.append(key)
+        groups: Dict[str, List[int]] = {}
+        for index, key in enumerate(keys):
+            groups.setdefault(key, []).append(index)
+        
+        replies = await self._claim_groups(tasks, groups)
+        stale = [key for key, reply in replies.items() if reply[0] == "hit" and not self._usable(json.loads(reply[1]))]
+        if stale:
+            # Artifacts were garbage collected: forget those entries and claim again
+            for key in stale:
+                await self._remove(f"{self.PREFIX}:{key}")
+            replies.update(await self._claim_groups(tasks, {key: groups[key] for key in stale}))
+        
+        hits: Dict[int, Dict[str, Any]] = {}
+        duplicates: Dict[int, int] = {}
+        parked: List[int] = []
+        for key, members in groups.items():
+            reply = replies[key]
+            if reply[0] == "wait":
+                parked.extend(members)
+                continue
+            if reply[0] == "hit":
+                hits[members[0]] = {**json.loads(reply[1]), "cached": True}
+            for index in members[1:]:
+                duplicates[index] = members[0]
+        
+        artifacts = [result["artifact"] for result in hits.values() if result.get("artifact")]
+        if artifacts:
+            await self.artifact_store.touch(artifacts)
+        
+        run = sum(1 for reply in replies.values() if reply[0] == "lead")
+        answered = len(hits) + sum(1 for lead in duplicates.values() if lead in hits)
+        self.hits += answered
+        self.misses += run
+        self.merged += len(tasks) - answered - run
+        return hits, duplicates, parked, keys
+    
+    async def finish(self, key: str, result: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Record the result of a claimed key and release the claim.
+        
+        Args:
+            key: Cache key returned by claim()
+            result: The task's result, or None if it failed (nothing is cached)
+        
+        Returns:
+            Tasks that were parked behind the key
+        """
+        cacheable = (
+            result is not None and result.get("status") == "completed"
+            and self._usable(result)
+        )
+        payload = json.dumps({k: v for k, v in result.items() if k != "cached"}) if cacheable else ""
+        reply = await self.finish_script(
+            keys=self._keys(key),
+            args=[payload, settings.RESULT_CACHE_TTL, time.time()]
+        )
+        total, parked = int(reply[0]), [json.loads(task) for task in reply[1:]]
+        if total > settings.RESULT_CACHE_MAX_BYTES:
+            await self.evict()
+        return parked
+    
+    async def evict(self) -> int:
+        """
+        Drop expired entries from the index, then least recently used ones over the size bound.
+        
+        Returns:
+            Number of entries removed
+        """
+        expired = await self.redis_client.zrangebyscore(self.LRU_KEY, "-inf", time.time() - settings.RESULT_CACHE_TTL)
+        removed = 0
+        for entry in expired:
+            await self._remove(entry)
+            removed += 1
+        
+        total = int(await self.redis_client.get(self.TOTAL_KEY) or 0)
+        while total > settings.RESULT_CACHE_MAX_BYTES:
+            oldest = await self.redis_client.zrange(self.LRU_KEY, 0, 0)
+            if not oldest:
+                break
+            total = await self._remove(oldest[0])
+            removed += 1
+        
+        if removed:
+            logger.info(f"Result cache evicted {removed} entries, {total} bytes remain")
+        return removed
+    
+    async def _remove(self, entry: str) -> int:
+        """Drop one cached result; returns the new total size."""
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.hget(self.SIZES_KEY, entry)
+            pipe.delete(entry)
+            pipe.zrem(self.LRU_KEY, entry)
+            pipe.hdel(self.SIZES_KEY, entry)
+            size, _, _, _ = await pipe.execute()
+        return await self.redis_client.decrby(self.TOTAL_KEY, int(size or 0))
+    
+    async def get_stats(self) -> Dict[str, Any]:
+        """Hit, miss and merge counts of this process and the shared cache size."""
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            pipe.zcard(self.LRU_KEY)
+            pipe.get(self.TOTAL_KEY)
+            entries, total = await pipe.execute()
+        lookups = self.hits + self.misses + self.merged
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "merged": self.merged,
+            "hit_ratio": (self.hits + self.merged) / lookups if lookups else 0.0,
+            "entries": entries,
+            "bytes": int(total or 0),
+            "max_bytes": settings.RESULT_CACHE_MAX_BYTES
+        }
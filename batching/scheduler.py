@@ -0,0 +1,203 @@
+import logging
+import math
+from typing import List, Dict, Any, Union, Callable
+from datetime import datetime
+
+from batching.queue_backend import ListQueueBackend, StreamQueueBackend
+
+logger = logging.getLogger(__name__)
+
+class WeightedFairScheduler:
+    """
+    Deficit round-robin scheduler over the priority queues of one task type.
+    
+    Each backlogged priority earns its weight in credit per round and spends one
+    credit per task taken, so under contention the achieved share converges to
+    the configured ratio. A priority whose oldest task has waited longer than
+    max_wait is served first regardless of its credit, which bounds the wait of
+    low-weight priorities.
+    """
+    
+    def __init__(
+        self,
+        backend: Union[ListQueueBackend, StreamQueueBackend],
+        queues: Dict[str, str],
+        weights: Dict[str, int],
+        max_wait: float = 0
+    ):
+        """
+        Args:
+            backend: Queue backend the queues live on
+            queues: Mapping of priority -> queue name
+            weights: Mapping of priority -> relative weight (e.g. PRIORITY_RATIO)
+            max_wait: Seconds after which a waiting task is served first (0 disables aging)
+        """
+        self.backend = backend
+        self.queues = queues
+        self.priorities = list(queues.keys())
+        self.weights = {p: max(1, int(weights.get(p, 1))) for p in self.priorities}
+        self.max_wait = max_wait
+        self.deficits: Dict[str, float] = {p: 0 for p in self.priorities}
+        self.next_index = 0
+        self.mid_turn = False
+        
+        # Counters exported through get_stats()
+        self.served: Dict[str, int] = {p: 0 for p in self.priorities}
+        self.aged: Dict[str, int] = {p: 0 for p in self.priorities}
+        self.wait_total: Dict[str, float] = {p: 0.0 for p in self.priorities}
+        self.wait_max: Dict[str, float] = {p: 0.0 for p in self.priorities}
+        self.last_wait: Dict[str, float] = {p: 0.0 for p in self.priorities}
+    
+    def _end_turn(self):
+        """Move the round-robin pointer to the next priority."""
+        self.mid_turn = False
+        self.next_index = (self.next_index + 1) % len(self.priorities)
+    
+    def _round_order(self) -> List[str]:
+        """Priorities in the order the current round visits them."""
+        return self.priorities[self.next_index:] + self.priorities[:self.next_index]
+    
+    def allocate(self, slots: int, backlogs: Dict[str, int], overdue: List[str]) -> Dict[str, int]:
+        """
+        Split a number of batch slots between priorities.
+        
+        Args:
+            slots: Number of tasks to take
+            backlogs: Mapping of priority -> number of queued tasks
+            overdue: Priorities whose oldest task exceeded max_wait
+        
+        Returns:
+            Mapping of priority -> number of tasks to pop
+        """
+        allocation = {p: 0 for p in self.priorities}
+        backlog = {p: backlogs.get(p, 0) for p in self.priorities}
+        
+        # Aging: overdue priorities go first with an even share of the batch,
+        # charged against their credit (at most one round of debt). When every
+        # backlogged priority is overdue the service is simply saturated and
+        # plain weighted sharing applies.
+        backlogged = [p for p in self.priorities if backlog[p] > 0]
+        if overdue and set(backlogged) - set(overdue):
+            aging_share = max(1, math.ceil(slots / len(self.priorities)))
+            for priority in overdue:
+                take = min(aging_share, backlog[priority], slots)
+                allocation[priority] += take
+                backlog[priority] -= take
+                self.deficits[priority] = max(self.deficits[priority] - take, -self.weights[priority])
+                self.aged[priority] += take
+                slots -= take
+        
+        # Deficit round-robin over the remaining slots
+        while slots > 0 and any(backlog[p] > 0 for p in self.priorities):
+            priority = self.priorities[self.next_index]
+            if backlog[priority] <= 0:
+                # Idle queues do not bank credit
+                self.deficits[priority] = 0
+                self._end_turn()
+                continue
+            
+            if not self.mid_turn:
+                self.deficits[priority] += self.weights[priority]
+            take = min(max(0, int(self.deficits[priority])), backlog[priority], slots)
+            allocation[priority] += take
+            backlog[priority] -= take
+            self.deficits[priority] -= take
+            slots -= take
+            
+            if backlog[priority] == 0:
+                self.deficits[priority] = 0
+            if backlog[priority] > 0 and self.deficits[priority] >= 1:
+                # The batch filled before this priority spent its credit;
+                # the next batch resumes its turn
+                self.mid_turn = True
+            else:
+                self._end_turn()
+        
+        return allocation
+    
+    def _record(self, priority: str, tasks: List[Dict[str, Any]]):
+        """Record achieved share and queue wait for popped tasks."""
+        now = datetime.utcnow().timestamp()
+        for task in tasks:
+            wait = max(0.0, now - task.get("timestamp", now))
+            self.wait_total[priority] += wait
+            self.wait_max[priority] = max(self.wait_max[priority], wait)
+            self.last_wait[priority] = wait
+        self.served[priority] += len(tasks)
+    
+    async def wait_for_task(self, timeout: float) -> List[Dict[str, Any]]:
+        """
+        Block server-side until any priority queue has a task and pop it.
+        
+        Queues are listed in the current round-robin order so the first task
+        goes to the priority whose turn it is. Stream backends may return one
+        task per priority.
+        """
+        order = self._round_order()
+        items = await self.backend.block_pop([self.queues[p] for p in order], timeout)
+        
+        tasks = []
+        for queue_name, task in items:
+            priority = next(p for p in order if self.queues[p] == queue_name)
+            self.deficits[priority] -= 1
+            self._record(priority, [task])
+            tasks.append(task)
+        return tasks
+    
+    async def pop(self, count: Union[int, Callable[[Dict[str, int]], int]]) -> List[Dict[str, Any]]:
+        """
+        Pop up to count tasks split across priorities by weighted fair share.
+        
+        Uses one pipelined round-trip to read queue depths and oldest tasks and
+        one to pop the allocated number of tasks from each queue.
+        
+        Args:
+            count: Number of tasks, or a function of the current queue depths
+                (priority -> length) returning it
+        """
+        depths, oldest = await self.backend.inspect([self.queues[p] for p in self.priorities])
+        
+        backlogs: Dict[str, int] = {}
+        overdue: List[str] = []
+        now = datetime.utcnow().timestamp()
+        for priority in self.priorities:
+            queue_name = self.queues[priority]
+            backlogs[priority] = depths[queue_name]
+            if self.max_wait and oldest[queue_name] is not None and now - oldest[queue_name] > self.max_wait:
+                overdue.append(priority)
+        
+        if callable(count):
+            count = count(backlogs)
+        allocation = self.allocate(count, backlogs, overdue)
+        to_pop = {self.queues[p]: n for p, n in allocation.items() if n > 0}
+        if not to_pop:
+            return []
+        
+        popped = await self.backend.pop(to_pop)
+        
+        tasks = []
+        for priority in self.priorities:
+            decoded = popped.get(self.queues[priority], [])
+            if decoded:
+                self._record(priority, decoded)
+                tasks.extend(decoded)
+        return tasks
+    
+    def get_stats(self) -> Dict[str, Dict[str, float]]:
+        """Get achieved vs. target share and queue wait per priority."""
+        total_served = sum(self.served.values())
+        total_weight = sum(self.weights.values())
+        return {
+            priority: {
+                "weight": self.weights[priority],
+                "target_share": self.weights[priority] / total_weight,
+                "achieved_share": self.served[priority] / total_served if total_served else 0.0,
+                "served": self.served[priority],
+                "aged": self.aged[priority],
+                "avg_wait": self.wait_total[priority] / self.served[priority] if self.served[priority] else 0.0,
+                "max_wait": self.wait_max[priority],
+                "last_wait": self.last_wait[priority],
+                "deficit": self.deficits[priority]
+            }
+            for priority in self.priorities
+        }
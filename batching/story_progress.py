@@ -0,0 +1,246 @@
+import asyncio
+import json
+import logging
+import time
+from typing import List, Dict, Any, Optional, AsyncIterator
+import redis.asyncio as redis
+
+import metrics
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Applies counter increments (ARGV[6..], field/amount pairs) to a story's
+# progress hash, sets the flag named by ARGV[5] ("sealed" or "cancelled")
+# if there is one, bumps its version and publishes the resulting snapshot
+# as [story_id, [field, value, ...]] on channel ARGV[1], so subscribers
+# never see a counter change without it. Returns the snapshot.
+UPDATE_SCRIPT = """
+for i = 6, #ARGV, 2 do
+    redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+if ARGV[5] ~= '' then
+    redis.call('HSET', KEYS[1], ARGV[5], 1)
+end
+redis.call('HSETNX', KEYS[1], 'created_at', ARGV[4])
+redis.call('HSET', KEYS[1], 'updated_at', ARGV[4])
+redis.call('HINCRBY', KEYS[1], 'version', 1)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+local snapshot = redis.call('HGETALL', KEYS[1])
+redis.call('PUBLISH', ARGV[1], cjson.encode({ARGV[2], snapshot}))
+return snapshot
+"""
+
+class StoryProgress:
+    """
+    Per-story task counters with a live feed of their changes.
+    
+    Each story has one small hash of "<task_type>:<state>" counters, where
+    state is total (enqueued), completed or failed, plus whether the story is
+    sealed (all of its tasks are enqueued) or cancelled, and a version. Every change goes
+    through UPDATE_SCRIPT, which updates the counters and publishes the new
+    snapshot on STORY_PROGRESS_CHANNEL in one step.
+    
+    Watchers are served from a single subscription to that channel per
+    process, started on the first watch() and shared by every watcher, so
+    thousands of clients following stories cost one subscription rather
+    than thousands of polls.
+    
+    Keys:
+        story_progress:{story_id}  HASH <task_type>:<state> -> count, sealed, cancelled, version, created_at, updated_at, finished_at
+    """
+    
+    PREFIX = "story_progress"
+    STATES = ("total", "completed", "failed")
+    # Statuses after which a story's progress no longer changes meaningfully
+    FINAL = ("done", "cancelled")
+    
+    def __init__(self, redis_client: redis.Redis):
+        self.redis_client = redis_client
+        self.update_script = redis_client.register_script(UPDATE_SCRIPT)
+        self.watchers: Dict[str, set] = {}
+        self.listener: Optional[asyncio.Task] = None
+    
+    def key(self, story_id: str) -> str:
+        """Progress hash of a story."""
+        return f"{self.PREFIX}:{story_id}"
+    
+    @staticmethod
+    def _group(tasks: List[Dict[str, Any]], states: List[str]) -> Dict[str, Dict[str, int]]:
+        """Count tasks per story by "<task_type>:<state>" field."""
+        counts: Dict[str, Dict[str, int]] = {}
+        for task, state in zip(tasks, states):
+            fields = counts.setdefault(task["story_id"], {})
+            field = f"{task['task_type']}:{state}"
+            fields[field] = fields.get(field, 0) + 1
+        return counts
+    
+    async def _update(self, pipe: redis.client.Pipeline, story_id: str, counts: Dict[str, int], flag: str = ""):
+        """Queue one story's counter update, optionally setting a flag, on a pipeline."""
+        args = [settings.STORY_PROGRESS_CHANNEL, story_id, settings.STORY_PROGRESS_TTL, time.time(), flag]
+        for field, amount in counts.items():
+            args.extend([field, amount])
+        await self.update_script(keys=[self.key(story_id)], args=args, client=pipe)
+    
+    async def stage(self, pipe: redis.client.Pipeline, tasks: List[Dict[str, Any]], sealed: bool = True):
+        """
+        Queue the counting of newly enqueued tasks on the pipeline that enqueues them.
+        
+        Args:
+            pipe: Pipeline the tasks are enqueued on
+            tasks: Tasks being enqueued
+            sealed: Whether these are their stories' last tasks
+        """
+        for story_id, counts in self._group(tasks, ["total"] * len(tasks)).items():
+            await self._update(pipe, story_id, counts, "sealed" if sealed else "")
+    
+    async def record(self, tasks: List[Dict[str, Any]], results: Dict[str, Any]):
+        """
+        Count finished tasks as completed or failed.
+        
+        Args:
+            tasks: Finished tasks
+            results: Batch results; tasks without a completed result count as failed
+        """
+        if not tasks:
+            return
+        task_results = results.get("task_results", [])
+        states = [
+            "completed" if index < len(task_results) and isinstance(task_results[index], dict)
+            and task_results[index].get("status") == "completed" else "failed"
+            for index in range(len(tasks))
+        ]
+        stories = self._group(tasks, states)
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for story_id, counts in stories.items():
+                await self._update(pipe, story_id, counts)
+            snapshots = await pipe.execute()
+        
+        for story_id, snapshot in zip(stories, snapshots):
+            state = dict(zip(snapshot[::2], snapshot[1::2]))
+            progress = self._render(story_id, state)
+            if progress["status"] != "done" or "finished_at" in state:
+                continue
+            # Whichever process records a story's last task first times it
+            finished_at = time.time()
+            if await self.redis_client.hsetnx(self.key(story_id), "finished_at", finished_at):
+                metrics.STORY_END_TO_END.observe(finished_at - progress["created_at"])
+    
+    async def cancel(self, pipe: redis.client.Pipeline, story_id: str):
+        """Queue marking a story cancelled on a pipeline."""
+        await self._update(pipe, story_id, {}, "cancelled")
+    
+    async def get(self, story_id: str) -> Optional[Dict[str, Any]]:
+        """Current progress of a story, or None if it is unknown or expired."""
+        state = await self.redis_client.hgetall(self.key(story_id))
+        return self._render(story_id, state) if state else None
+    
+    @classmethod
+    def _render(cls, story_id: str, state: Dict[str, str]) -> Dict[str, Any]:
+        """Turn a progress hash into its API representation."""
+        tasks: Dict[str, Dict[str, int]] = {}
+        for field, value in state.items():
+            task_type, separator, counter = field.partition(":")
+            if separator:
+                tasks.setdefault(task_type, dict.fromkeys(cls.STATES, 0))[counter] = int(value)
+        for counts in tasks.values():
+            counts["pending"] = counts["total"] - counts["completed"] - counts["failed"]
+        totals = {counter: sum(counts[counter] for counts in tasks.values()) for counter in (*cls.STATES, "pending")}
+        
+        sealed = bool(state.get("sealed"))
+        if state.get("cancelled"):
+            status = "cancelled"
+        elif sealed and totals["pending"] <= 0:
+            status = "done"
+        elif totals["completed"] or totals["failed"]:
+            status = "running"
+        else:
+            status = "queued"
+        return {
+            "story_id": story_id,
+            "status": status,
+            "sealed": sealed,
+            "tasks": tasks,
+            "totals": totals,
+            "version": int(state.get("version", 0)),
+            "created_at": float(state["created_at"]) if "created_at" in state else None,
+            "updated_at": float(state["updated_at"]) if "updated_at" in state else None
+        }
+    
+    async def watch(self, story_id: str, idle_timeout: float) -> AsyncIterator[Optional[Dict[str, Any]]]:
+        """
+        Follow a story's progress.
+        
+        Yields the current progress, then every newer snapshot until the story
+        is done or cancelled. A watcher that falls behind skips to the latest snapshot.
+        
+        Args:
+            story_id: Story to follow
+            idle_timeout: Seconds without a change after which None is yielded (for keepalives)
+        """
+        updates: asyncio.Queue = asyncio.Queue(maxsize=1)
+        self.watchers.setdefault(story_id, set()).add(updates)
+        self._ensure_listener()
+        try:
+            version = 0
+            progress = await self.get(story_id)
+            while True:
+                if progress is not None and progress["version"] > version:
+                    version = progress["version"]
+                    yield progress
+                    if progress["status"] in self.FINAL:
+                        return
+                try:
+                    progress = await asyncio.wait_for(updates.get(), idle_timeout)
+                except asyncio.TimeoutError:
+                    progress = None
+                    yield None
+        finally:
+            watchers = self.watchers.get(story_id)
+            if watchers is not None:
+                watchers.discard(updates)
+                if not watchers:
+                    del self.watchers[story_id]
+    
+    def _notify(self, story_id: str, progress: Dict[str, Any]):
+        """Hand a snapshot to a story's local watchers, replacing any they haven't taken yet."""
+        for updates in self.watchers.get(story_id, ()):
+            if updates.full():
+                updates.get_nowait()
+            updates.put_nowait(progress)
+    
+    def _ensure_listener(self):
+        """Start this process's subscription if it isn't running."""
+        if self.listener is None or self.listener.done():
+            self.listener = asyncio.create_task(self._listen())
+    
+    async def _listen(self):
+        """Fan progress updates from the process-wide subscription out to local watchers."""
+        while True:
+            pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(settings.STORY_PROGRESS_CHANNEL)
+                # Updates published while (re)subscribing would be lost, so resync
+                for story_id in list(self.watchers):
+                    progress = await self.get(story_id)
+                    if progress is not None:
+                        self._notify(story_id, progress)
+                
+                async for message in pubsub.listen():
+                    story_id, fields = json.loads(message["data"])
+                    if story_id in self.watchers:
+                        self._notify(story_id, self._render(story_id, dict(zip(fields[::2], fields[1::2]))))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Story progress subscription failed: {str(e)}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+    
+    async def stop(self):
+        """Drop this process's subscription."""
+        if self.listener is not None:
+            self.listener.cancel()
+            await asyncio.gather(self.listener, return_exceptions=True)
+            self.listener = None
@@ -0,0 +1,297 @@
+import json
+import logging
+import struct
+import uuid
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import List, Dict, Any, Optional, Tuple, Union
+import redis.asyncio as redis
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Schema version 2 wire format (all integers big-endian):
+#
+#   version      B    always 2
+#   timestamp    Q    enqueue time in microseconds since the epoch
+#   task_id      16s  UUID bytes
+#   task_type    B    index into TASK_TYPES_V1
+#   priority     B    index into PRIORITIES_V1
+#   scene_idx    I
+#   deps         B    number of dependency task IDs, followed by 16 bytes each
+#   story_id     H    length, followed by UTF-8 bytes
+#   prompt       I    length, followed by UTF-8 bytes
+#   extra        I    length, followed by compact JSON of task-specific fields
+#
+# The timestamp sits at a fixed offset so the task graph's release script can
+# restamp released tasks without decoding them. Version 1 payloads, still
+# decoded, differ only in a 16-bit scene_idx, which book-length streamed
+# stories outgrow. Payloads starting with "{" are the JSON tasks queued
+# before the binary format was introduced.
+VERSION = 2
+TASK_TYPES_V1 = ("character", "scene", "clip")
+PRIORITIES_V1 = ("premium", "free")
+_HEADERS = {1: struct.Struct(">BQ16sBBHB"), 2: struct.Struct(">BQ16sBBIB")}
+_HEADER = _HEADERS[VERSION]
+_TIMESTAMP = struct.Struct(">Q")
+_TIMESTAMP_OFFSET = 1
+_LENGTH16 = struct.Struct(">H")
+_LENGTH32 = struct.Struct(">I")
+
+# Fields shared by every task of a story, stored once in its metadata hash
+STORY_FIELDS = ("user_id", "callback_url")
+# Extra field pointing a task to its metadata hash
+META_FIELD = "meta_id"
+# Fields with a dedicated slot in the binary layout
+_WIRE_FIELDS = ("task_id", "task_type", "priority", "scene_idx", "depends_on", "story_id", "prompt", "timestamp")
+
+class EncodedTask(MutableMapping):
+    """
+    A queued task decoded from its wire payload on first access.
+    
+    The fixed header and story ID are unpacked the first time any field is
+    read; the prompt and task-specific extras only when they are asked for.
+    Keys set on the task (such as the stream position) are kept alongside the
+    payload, which is reused unchanged when the task is queued again.
+    Story-level fields are absent until the task is inflated.
+    """
+    
+    __slots__ = ("payload", "_fields", "_prompt_at", "_extra_at", "_extra", "_overrides")
+    
+    def __init__(self, payload: bytes):
+        self.payload = payload
+        self._fields: Optional[Dict[str, Any]] = None
+        self._prompt_at = 0
+        self._extra_at = 0
+        self._extra: Optional[Dict[str, Any]] = None
+        self._overrides: Dict[str, Any] = {}
+    
+    def _head(self) -> Dict[str, Any]:
+        """Unpack the fixed-size fields and story ID."""
+        if self._fields is None:
+            header = _HEADERS[self.payload[0]]
+            version, timestamp, task_id, task_type, priority, scene_idx, deps = header.unpack_from(self.payload)
+            offset = header.size
+            depends_on = []
+            for _ in range(deps):
+                depends_on.append(str(uuid.UUID(bytes=self.payload[offset:offset + 16])))
+                offset += 16
+            (length,) = _LENGTH16.unpack_from(self.payload, offset)
+            offset += _LENGTH16.size
+            story_id = self.payload[offset:offset + length].decode()
+            
+            self._prompt_at = offset + length
+            (length,) = _LENGTH32.unpack_from(self.payload, self._prompt_at)
+            self._extra_at = self._prompt_at + _LENGTH32.size + length
+            self._fields = {
+                "task_id": str(uuid.UUID(bytes=task_id)),
+                "task_type": TASK_TYPES_V1[task_type],
+                "priority": PRIORITIES_V1[priority],
+                "story_id": story_id,
+                "scene_idx": scene_idx,
+                "depends_on": depends_on,
+                "timestamp": timestamp / 1_000_000
+            }
+        return self._fields
+    
+    def _extras(self) -> Dict[str, Any]:
+        """Decode the task-specific fields."""
+        if self._extra is None:
+            self._head()
+            (length,) = _LENGTH32.unpack_from(self.payload, self._extra_at)
+            start = self._extra_at + _LENGTH32.size
+            self._extra = json.loads(self.payload[start:start + length]) if length else {}
+        return self._extra
+    
+    def _prompt(self) -> str:
+        """Decode the prompt."""
+        self._head()
+        (length,) = _LENGTH32.unpack_from(self.payload, self._prompt_at)
+        start = self._prompt_at + _LENGTH32.size
+        return self.payload[start:start + length].decode()
+    
+    @property
+    def modified(self) -> bool:
+        """Whether a field stored in the payload was changed since decoding."""
+        return any(not key.startswith("_") for key in self._overrides)
+    
+    def __getitem__(self, key: str) -> Any:
+        if key in self._overrides:
+            return self._overrides[key]
+        if key == "prompt":
+            return self._prompt()
+        head = self._head()
+        if key in head:
+            return head[key]
+        return self._extras()[key]
+    
+    def __setitem__(self, key: str, value: Any):
+        self._overrides[key] = value
+    
+    def __delitem__(self, key: str):
+        if key in self._overrides:
+            del self._overrides[key]
+        else:
+            raise KeyError(key)
+    
+    def __iter__(self):
+        keys = list(self._head()) + ["prompt"] + list(self._extras())
+        yield from keys
+        yield from (key for key in self._overrides if key not in keys)
+    
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+class TaskCodec:
+    """
+    Compact wire format for batching tasks.
+    
+    Tasks are packed into a versioned binary layout (see VERSION); fields
+    shared by the whole story (STORY_FIELDS) are written once per enqueued
+    story to a "task_meta:{meta_id}" hash, and tasks carry only its ID.
+    The ID is generated here rather than taken from the client-chosen story
+    ID, so a later story reusing that ID cannot change where an earlier
+    one's results are sent. Queues hold the binary payloads, the batching
+    side works on lazily decoded EncodedTasks, and full task dictionaries
+    are only rebuilt by inflate() right before they are sent to the GPU
+    service and used for callbacks.
+    """
+    
+    META_PREFIX = "task_meta"
+    
+    def __init__(self, redis_client: redis.Redis):
+        self.redis_client = redis_client
+        # Metadata IDs are never reused, so a small LRU cache saves most lookups
+        self.meta_cache: "OrderedDict[str, Dict[str, str]]" = OrderedDict()
+    
+    @classmethod
+    def meta_key(cls, meta_id: str) -> str:
+        """Hash holding a story's shared task fields."""
+        return f"{cls.META_PREFIX}:{meta_id}"
+    
+    def encode(self, task: Union[Dict[str, Any], EncodedTask]) -> bytes:
+        """Pack a task into the current wire format."""
+        if isinstance(task, EncodedTask) and not task.modified:
+            return task.payload
+        
+        depends_on = task.get("depends_on") or []
+        story_id = task["story_id"].encode()
+        prompt = task.get("prompt", "").encode()
+        extra = {
+            key: value for key, value in task.items()
+            if key not in _WIRE_FIELDS and key not in STORY_FIELDS and not key.startswith("_")
+        }
+        extra_json = json.dumps(extra, separators=(",", ":")).encode() if extra else b""
+        
+        parts = [
+            _HEADER.pack(
+                VERSION,
+                int(task.get("timestamp", 0) * 1_000_000),
+                uuid.UUID(task["task_id"]).bytes,
+                TASK_TYPES_V1.index(task["task_type"]),
+                PRIORITIES_V1.index(task["priority"]),
+                task.get("scene_idx", 0),
+                len(depends_on)
+            ),
+            *(uuid.UUID(parent_id).bytes for parent_id in depends_on),
+            _LENGTH16.pack(len(story_id)), story_id,
+            _LENGTH32.pack(len(prompt)), prompt,
+            _LENGTH32.pack(len(extra_json)), extra_json
+        ]
+        return b"".join(parts)
+    
+    def decode(self, payload: Union[bytes, str]) -> Union[Dict[str, Any], EncodedTask]:
+        """Wrap a wire payload for lazy decoding."""
+        if isinstance(payload, str):
+            payload = payload.encode()
+        if payload[:1] == b"{":
+            return json.loads(payload)
+        if payload[0] not in _HEADERS:
+            raise ValueError(f"Unsupported task encoding version {payload[0]}")
+        return EncodedTask(payload)
+    
+    def timestamp(self, payload: Union[bytes, str]) -> Optional[float]:
+        """Read a payload's enqueue time without decoding the rest of it."""
+        if isinstance(payload, str):
+            payload = payload.encode()
+        if payload[:1] == b"{":
+            return json.loads(payload).get("timestamp")
+        (micros,) = _TIMESTAMP.unpack_from(payload, _TIMESTAMP_OFFSET)
+        return micros / 1_000_000
+    
+    def stage_metadata(self, pipe: redis.client.Pipeline, tasks: List[Dict[str, Any]]):
+        """Queue writes of the story-level fields of tasks on a pipeline, pointing each task to them."""
+        stories: Dict[str, Dict[str, str]] = {}
+        for task in tasks:
+            stories.setdefault(task["story_id"], {}).update(
+                {field: task[field] for field in STORY_FIELDS if field in task}
+            )
+        meta_ids = {}
+        for story_id, fields in stories.items():
+            if fields:
+                meta_ids[story_id] = uuid.uuid4().hex
+                pipe.hset(self.meta_key(meta_ids[story_id]), mapping=fields)
+                pipe.expire(self.meta_key(meta_ids[story_id]), settings.TASK_META_TTL)
+        for task in tasks:
+            if task["story_id"] in meta_ids:
+                task[META_FIELD] = meta_ids[task["story_id"]]
+    
+    async def _story_metadata(self, meta_ids: List[str]) -> Dict[str, Dict[str, str]]:
+        """Fetch several metadata hashes, from the cache where possible; expired ones are left out."""
+        found = {}
+        missing = []
+        for meta_id in meta_ids:
+            if meta_id in self.meta_cache:
+                self.meta_cache.move_to_end(meta_id)
+                found[meta_id] = self.meta_cache[meta_id]
+            else:
+                missing.append(meta_id)
+        
+        if missing:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                for meta_id in missing:
+                    pipe.hgetall(self.meta_key(meta_id))
+                replies = await pipe.execute()
+            for meta_id, fields in zip(missing, replies):
+                if not fields:
+                    continue
+                found[meta_id] = fields
+                self.meta_cache[meta_id] = fields
+                if len(self.meta_cache) > settings.TASK_META_CACHE_SIZE:
+                    self.meta_cache.popitem(last=False)
+        return found
+    
+    async def inflate(
+        self,
+        tasks: List[Union[Dict[str, Any], EncodedTask]]
+    ) -> Tuple[List[Dict[str, Any]], List[int]]:
+        """
+        Rebuild full task dictionaries, including story-level fields.
+        
+        Args:
+            tasks: Decoded tasks, lazily or from legacy JSON
+        
+        Returns:
+            (plain task dictionaries in the format the GPU service and callbacks
+            expect, indexes of tasks whose metadata has expired)
+        """
+        metadata = await self._story_metadata(list({
+            task[META_FIELD] for task in tasks if isinstance(task, EncodedTask) and META_FIELD in task
+        }))
+        inflated = []
+        orphaned = []
+        for index, task in enumerate(tasks):
+            if not isinstance(task, EncodedTask):
+                inflated.append(dict(task))
+                continue
+            meta_id = task.get(META_FIELD)
+            if meta_id is not None and meta_id not in metadata:
+                logger.warning(f"Task metadata of story {task['story_id']} has expired")
+                orphaned.append(index)
+            task_data = {**metadata.get(meta_id, {}), **task}
+            inflated.append({
+                key: value for key, value in task_data.items()
+                if key != META_FIELD and not key.startswith("_")
+            })
+        return inflated, orphaned
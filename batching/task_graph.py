@@ -0,0 +1,290 @@
+import json
+import logging
+from typing import List, Dict, Any, Union
+import redis.asyncio as redis
+
+from config import settings
+from batching.queue_backend import RAW, ListQueueBackend, StreamQueueBackend
+
+logger = logging.getLogger(__name__)
+
+# Releases the dependents of one completed task. Each dependent's remaining
+# dependency count is decremented; dependents that reach zero are moved from
+# the story's pending hash onto their batching queue (list or stream, per
+# ARGV[2]) with a fresh timestamp. The timestamp is spliced into the binary
+# payload at the offset defined by batching.task_codec (byte 2, a big-endian
+# uint64 of microseconds), so payloads are never decoded here.
+# Work is proportional to the completed task's direct dependents only.
+# Target queues are taken from the graph, so this assumes a single Redis node.
+RELEASE_SCRIPT = """
+local children = redis.call('HGET', KEYS[3], ARGV[1])
+if not children then
+    return 0
+end
+redis.call('HDEL', KEYS[3], ARGV[1])
+
+local now = redis.call('TIME')
+local micros = tonumber(now[1]) * 1000000 + tonumber(now[2])
+local stamp = ''
+for shift = 7, 0, -1 do
+    stamp = stamp .. string.char(math.floor(micros / 2 ^ (8 * shift)) % 256)
+end
+
+local released = 0
+for _, child in ipairs(cjson.decode(children)) do
+    if redis.call('HINCRBY', KEYS[2], child, -1) <= 0 then
+        local payload = redis.call('HGET', KEYS[1], child)
+        local queue = redis.call('HGET', KEYS[4], child)
+        if payload and queue then
+            local task
+            if string.sub(payload, 1, 1) == '{' then
+                -- JSON task parked before the binary encoding was introduced
+                local decoded = cjson.decode(payload)
+                decoded['timestamp'] = micros / 1000000
+                task = cjson.encode(decoded)
+            else
+                task = string.sub(payload, 1, 1) .. stamp .. string.sub(payload, 10)
+            end
+            if ARGV[2] == 'stream' then
+                -- Mirrors StreamQueueBackend.stream_key
+                redis.call('XADD', queue .. ':stream', '*', 'task', task)
+            else
+                redis.call('LPUSH', queue, task)
+            end
+            released = released + 1
+        end
+        redis.call('HDEL', KEYS[1], child)
+        redis.call('HDEL', KEYS[2], child)
+        redis.call('HDEL', KEYS[4], child)
+    end
+end
+return released
+"""
+
+# Parks a task whose dependencies include tasks staged by an earlier call
+# (stories enqueued in chunks). Parents still open have an entry in the
+# dependents hash, which RELEASE_SCRIPT removes on completion; the task is
+# appended to those and waits for them plus the ARGV[3] parents staged
+# alongside it. If nothing is left to wait for, it is queued right away.
+# The task's payload and target queue are written before this runs.
+ATTACH_SCRIPT = """
+local count = tonumber(ARGV[3])
+for i = 4, #ARGV do
+    local children = redis.call('HGET', KEYS[3], ARGV[i])
+    if children then
+        local list = cjson.decode(children)
+        table.insert(list, ARGV[1])
+        redis.call('HSET', KEYS[3], ARGV[i], cjson.encode(list))
+        count = count + 1
+    end
+end
+if count > 0 then
+    redis.call('HSET', KEYS[2], ARGV[1], count)
+    return 0
+end
+
+local payload = redis.call('HGET', KEYS[1], ARGV[1])
+local queue = redis.call('HGET', KEYS[4], ARGV[1])
+if ARGV[2] == 'stream' then
+    redis.call('XADD', queue .. ':stream', '*', 'task', payload)
+else
+    redis.call('LPUSH', queue, payload)
+end
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[4], ARGV[1])
+return 1
+"""
+
+# Removes the direct dependents of one failed task from the story's graph
+# and returns their payloads, as they can never run. Dependents that also
+# wait on other open tasks are removed as well; RELEASE_SCRIPT finds nothing
+# to queue for them when those tasks finish. Binary payloads are returned
+# as is, so the reply must not be decoded.
+FAIL_SCRIPT = """
+local children = redis.call('HGET', KEYS[3], ARGV[1])
+if not children then
+    return {}
+end
+redis.call('HDEL', KEYS[3], ARGV[1])
+
+local failed = {}
+for _, child in ipairs(cjson.decode(children)) do
+    local payload = redis.call('HGET', KEYS[1], child)
+    if payload then
+        table.insert(failed, payload)
+    end
+    redis.call('HDEL', KEYS[1], child)
+    redis.call('HDEL', KEYS[2], child)
+    redis.call('HDEL', KEYS[4], child)
+end
+return failed
+"""
+
+class TaskGraph:
+    """
+    Per-story dependency graph of tasks stored in Redis.
+    
+    Tasks with unfinished dependencies are parked in the story's graph instead
+    of a batching queue, so the batch loops only ever see runnable work. When a
+    task completes, its dependents are released in O(1) per dependent; when
+    it fails, they are removed and handed back to be failed in turn.
+    
+    Keys per story:
+        task_graph:{story_id}:pending     HASH task_id -> encoded task
+        task_graph:{story_id}:deps        HASH task_id -> remaining dependency count
+        task_graph:{story_id}:dependents  HASH task_id -> JSON list of dependent task IDs
+        task_graph:{story_id}:queues      HASH task_id -> target queue name
+    """
+    
+    def __init__(self, redis_client: redis.Redis, queue_backend: Union[ListQueueBackend, StreamQueueBackend]):
+        self.redis_client = redis_client
+        self.queue_backend = queue_backend
+        self.release_script = redis_client.register_script(RELEASE_SCRIPT)
+        self.attach_script = redis_client.register_script(ATTACH_SCRIPT)
+    
+    @staticmethod
+    def _keys(story_id: str) -> List[str]:
+        """Graph keys of a story, in the order RELEASE_SCRIPT expects."""
+        prefix = f"task_graph:{story_id}"
+        return [f"{prefix}:pending", f"{prefix}:deps", f"{prefix}:dependents", f"{prefix}:queues"]
+    
+    async def stage(
+        self,
+        pipe: redis.client.Pipeline,
+        tasks: List[Dict[str, Any]],
+        open_ended: bool = False
+    ) -> Dict[str, List[bytes]]:
+        """
+        Queue the graph writes for a set of tasks on a pipeline.
+        
+        Tasks may list the IDs of tasks they wait for in "depends_on". A
+        dependency is either part of the same call or was staged by an earlier
+        open-ended call for the same story. Tasks without dependencies are
+        returned for immediate enqueueing.
+        
+        Args:
+            pipe: Pipeline (normally a MULTI/EXEC transaction) to add commands to
+            tasks: Task dictionaries with task_id, story_id, task_type and priority
+            open_ended: Later calls may add tasks depending on these ones
+        
+        Returns:
+            Mapping of queue name -> encoded runnable tasks
+        """
+        codec = self.queue_backend.codec
+        staged = {task_data["task_id"] for task_data in tasks}
+        runnable: Dict[str, List[bytes]] = {}
+        dependents: Dict[str, Dict[str, List[str]]] = {}
+        parked: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        attached: List[Dict[str, Any]] = []
+        
+        for task_data in tasks:
+            queue_name = settings.QUEUE_NAMES[task_data["task_type"]][task_data["priority"]]
+            depends_on = task_data.get("depends_on") or []
+            if not depends_on:
+                runnable.setdefault(queue_name, []).append(codec.encode(task_data))
+                continue
+            
+            story_id = task_data["story_id"]
+            parked.setdefault(story_id, {})[task_data["task_id"]] = task_data
+            for parent_id in depends_on:
+                if parent_id in staged:
+                    dependents.setdefault(story_id, {}).setdefault(parent_id, []).append(task_data["task_id"])
+            if any(parent_id not in staged for parent_id in depends_on):
+                attached.append(task_data)
+        
+        if open_ended:
+            # An (empty) dependents entry marks a task as open for later calls to wait on
+            for task_data in tasks:
+                story_dependents = dependents.setdefault(task_data["story_id"], {})
+                story_dependents.setdefault(task_data["task_id"], [])
+                parked.setdefault(task_data["story_id"], {})
+        
+        attached_ids = {task_data["task_id"] for task_data in attached}
+        for story_id, story_tasks in parked.items():
+            pending_key, deps_key, dependents_key, queues_key = self._keys(story_id)
+            if story_tasks:
+                pipe.hset(pending_key, mapping={
+                    task_id: codec.encode(task_data) for task_id, task_data in story_tasks.items()
+                })
+                pipe.hset(queues_key, mapping={
+                    task_id: settings.QUEUE_NAMES[task_data["task_type"]][task_data["priority"]]
+                    for task_id, task_data in story_tasks.items()
+                })
+            deps = {
+                task_id: len(task_data["depends_on"])
+                for task_id, task_data in story_tasks.items() if task_id not in attached_ids
+            }
+            if deps:
+                pipe.hset(deps_key, mapping=deps)
+            if dependents.get(story_id):
+                pipe.hset(dependents_key, mapping={
+                    parent_id: json.dumps(children) for parent_id, children in dependents[story_id].items()
+                })
+            for key in self._keys(story_id):
+                pipe.expire(key, settings.TASK_GRAPH_TTL)
+        
+        for task_data in attached:
+            depends_on = task_data["depends_on"]
+            await self.attach_script(
+                keys=self._keys(task_data["story_id"]),
+                args=[
+                    task_data["task_id"],
+                    self.queue_backend.name,
+                    sum(1 for parent_id in depends_on if parent_id in staged),
+                    *(parent_id for parent_id in depends_on if parent_id not in staged)
+                ],
+                client=pipe
+            )
+        
+        return runnable
+    
+    async def complete(self, tasks: List[Dict[str, Any]]) -> int:
+        """
+        Mark tasks as finished and release dependents that became runnable.
+        
+        Args:
+            tasks: Completed task dictionaries with task_id and story_id
+        
+        Returns:
+            Number of dependent tasks moved onto batching queues
+        """
+        if not tasks:
+            return 0
+        
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for task_data in tasks:
+                await self.release_script(
+                    keys=self._keys(task_data["story_id"]),
+                    args=[task_data["task_id"], self.queue_backend.name],
+                    client=pipe
+                )
+            released = await pipe.execute()
+        return sum(released)
+    
+    async def fail(self, tasks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Mark tasks as failed and take their dependents out of the graph.
+        
+        Args:
+            tasks: Failed task dictionaries with task_id and story_id
+        
+        Returns:
+            Decoded dependents, which will never become runnable
+        """
+        if not tasks:
+            return []
+        
+        # Failures are rare, so the script is sent with EVAL rather than
+        # registered; registered scripts always decode their replies
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for task_data in tasks:
+                pipe.execute_command(
+                    "EVAL", FAIL_SCRIPT, 4, *self._keys(task_data["story_id"]), task_data["task_id"], **RAW
+                )
+            replies = await pipe.execute()
+        codec = self.queue_backend.codec
+        return [codec.decode(payload) for reply in replies for payload in reply]
+    
+    def discard(self, pipe: redis.client.Pipeline, story_id: str):
+        """Queue dropping a story's graph on a pipeline, so tasks still waiting on dependencies never run."""
+        pipe.delete(*self._keys(story_id))
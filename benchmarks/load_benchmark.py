@@ -0,0 +1,449 @@
+"""
+End-to-end load benchmark for the story pipeline.
+
+Runs main.app (batching service, worker pool, callback dispatcher) in this
+process against an in-process Redis stand-in and a fake GPU service, drives a
+configurable mix of streamed stories through POST /submit_story and reports
+throughput, story latency percentiles, batch fill ratio and Redis operations
+per story as JSON, so runs can be compared:
+
+    python benchmarks/load_benchmark.py --stories 200 --rate 10 --output before.json
+    BATCH_SIZE=16 python benchmarks/load_benchmark.py --stories 200 --rate 10 --output after.json
+
+With --gpu-per-reference-ms, batches pay for every distinct character
+reference they use, so AFFINITY_PACKING_ENABLED=false and =true runs compare
+images per GPU-second with and without affinity packing. Packing needs
+QUEUE_BACKEND=stream.
+
+Settings from config.py can be overridden through the environment as usual;
+the ones the benchmark depends on default to benchmark-friendly values.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import List, Dict, Any, Optional, AsyncIterator
+
+import fakeredis
+import httpx
+from fastapi import FastAPI, Request, Response
+from redis.asyncio.client import Pipeline
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+logger = logging.getLogger("load_benchmark")
+
+# Character names the generated stories draw their cast from
+CAST = [
+    "Alice", "Bruno", "Clara", "Dmitri", "Elena", "Farid", "Greta", "Hiro",
+    "Ines", "Jonas", "Kira", "Lucas", "Mira", "Nadia", "Oscar", "Priya"
+]
+
+class CountingRedis(fakeredis.FakeAsyncRedis):
+    """In-process Redis stand-in that counts commands and round-trips."""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.commands = 0
+        self.round_trips = 0
+    
+    async def execute_command(self, *args, **options):
+        self.commands += 1
+        self.round_trips += 1
+        return await super().execute_command(*args, **options)
+    
+    def pipeline(self, transaction: bool = True, shard_hint: Optional[str] = None) -> "CountingPipeline":
+        return CountingPipeline(self, transaction, shard_hint)
+
+class CountingPipeline(Pipeline):
+    """Pipeline that counts its commands on the client it came from."""
+    
+    def __init__(self, owner: CountingRedis, transaction: bool, shard_hint: Optional[str]):
+        super().__init__(owner.connection_pool, owner.response_callbacks, transaction, shard_hint)
+        self.owner = owner
+    
+    async def execute(self, raise_on_error: bool = True) -> List[Any]:
+        if self.command_stack:
+            self.owner.commands += len(self.command_stack)
+            self.owner.round_trips += 1
+        return await super().execute(raise_on_error)
+
+class FakeGPUService:
+    """
+    Stand-in for the generic GPU service (GPU_BACKEND=http).
+    
+    A batch of n tasks using r distinct reference images takes
+    fixed_cost + n * per_item_cost + r * per_reference_cost seconds (the
+    reference is encoded once per batch), at most `concurrency` batches run
+    at once (one per simulated GPU) and a batch fails with probability
+    failure_rate after running.
+    """
+    
+    def __init__(
+        self,
+        fixed_cost: float,
+        per_item_cost: float,
+        per_reference_cost: float,
+        failure_rate: float,
+        concurrency: int,
+        rng: random.Random
+    ):
+        self.fixed_cost = fixed_cost
+        self.per_item_cost = per_item_cost
+        self.per_reference_cost = per_reference_cost
+        self.failure_rate = failure_rate
+        self.rng = rng
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.batch_sizes: List[int] = []
+        self.references: List[int] = []
+        self.failures = 0
+        self.busy_seconds = 0.0
+        
+        self.app = FastAPI()
+        self.app.post("/process_batch")(self.process_batch)
+        self.app.get("/health")(self.health)
+    
+    async def process_batch(self, request: Request):
+        payload = await request.json()
+        tasks = payload["tasks"]
+        references = len({task["reference_image"] for task in tasks if task.get("reference_image")})
+        cost = self.fixed_cost + self.per_item_cost * len(tasks) + self.per_reference_cost * references
+        async with self.semaphore:
+            await asyncio.sleep(cost)
+        self.busy_seconds += cost
+        if self.rng.random() < self.failure_rate:
+            self.failures += 1
+            return Response(status_code=503)
+        
+        self.batch_sizes.append(len(tasks))
+        self.references.append(references)
+        return {
+            "batch_id": payload["batch_id"],
+            "task_results": [{"task_id": task["task_id"], "status": "completed"} for task in tasks]
+        }
+    
+    async def health(self):
+        return {"status": "healthy"}
+
+class CallbackReceiver:
+    """Collects task callbacks per story and records when each story is complete."""
+    
+    def __init__(self):
+        self.stories: Dict[str, Dict[str, Any]] = {}
+        self.pending = 0
+        self.all_done = asyncio.Event()
+        
+        self.app = FastAPI()
+        self.app.post("/stories/{story_id}")(self.receive)
+    
+    def url(self, story_id: str) -> str:
+        return f"http://callbacks.bench/stories/{story_id}"
+    
+    def expect(self, story_id: str, priority: str, submitted_at: float):
+        """Start tracking a story as its upload begins."""
+        self.stories[story_id] = {
+            "priority": priority,
+            "submitted_at": submitted_at,
+            "task_count": None,
+            "delivered": set(),
+            "completed_at": None
+        }
+        self.pending += 1
+        self.all_done.clear()
+    
+    def accepted(self, story_id: str, task_count: Optional[int]):
+        """Record how many tasks the story was split into (None if the upload failed)."""
+        story = self.stories[story_id]
+        if task_count is None:
+            del self.stories[story_id]
+            self._settle()
+            return
+        story["task_count"] = task_count
+        self._check(story)
+    
+    async def receive(self, story_id: str, request: Request):
+        body = await request.json()
+        story = self.stories.get(story_id)
+        if story is None:
+            return {}
+        # Coalesced callbacks arrive as {"tasks": [...]}
+        for payload in body.get("tasks", [body]):
+            if payload.get("task_id"):
+                story["delivered"].add(payload["task_id"])
+        self._check(story)
+        return {}
+    
+    def _check(self, story: Dict[str, Any]):
+        if story["completed_at"] is None and story["task_count"] is not None and len(story["delivered"]) >= story["task_count"]:
+            story["completed_at"] = time.monotonic()
+            self._settle()
+    
+    def _settle(self):
+        self.pending -= 1
+        if self.pending == 0:
+            self.all_done.set()
+
+def _configure_environment(workdir: str):
+    """Point settings at the in-process stand-ins before config.py is imported."""
+    defaults = {
+        "GPU_BACKEND": "http",
+        "GPU_SERVICE_URL": "http://gpu.bench",
+        "WORKER_PROCESSES": "0",
+        "AUTOSCALE_ENABLED": "false",
+        # Needs ffmpeg and real clips; the fake GPU service returns no media
+        "COMPOSER_ENABLED": "false",
+        "BATCH_BLOCK_TIMEOUT": "1",
+        "ARTIFACT_DIR": os.path.join(workdir, "artifacts"),
+        "CHARACTER_CACHE_DIR": os.path.join(workdir, "character_refs"),
+        "COMPOSER_DIR": os.path.join(workdir, "videos")
+    }
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+
+def _story_text(index: int, scenes: int, cast: List[str], rng: random.Random) -> str:
+    """Generate a story of `scenes` paragraphs, each naming one or two of its cast."""
+    paragraphs = []
+    for scene_idx in range(scenes):
+        names = rng.sample(cast, min(len(cast), rng.randint(1, 2)))
+        paragraphs.append(
+            f"In scene {scene_idx} of story {index}, {' and '.join(names)} "
+            f"cross the valley at hour {rng.randint(0, 23)} while the wind turns."
+        )
+    return "\n\n".join(paragraphs)
+
+async def _chunks(text: str, chunk_size: int) -> AsyncIterator[bytes]:
+    """Upload body in chunks, as a client using chunked transfer encoding would send it."""
+    data = text.encode()
+    for start in range(0, len(data), chunk_size):
+        yield data[start:start + chunk_size]
+        await asyncio.sleep(0)
+
+def _percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """Nearest-rank p50/p95/p99 with mean and max."""
+    if not values:
+        return {"count": 0, "p50": None, "p95": None, "p99": None, "mean": None, "max": None}
+    ordered = sorted(values)
+    
+    def rank(q: float) -> float:
+        return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+    return {
+        "count": len(ordered),
+        "p50": rank(50),
+        "p95": rank(95),
+        "p99": rank(99),
+        "mean": sum(ordered) / len(ordered),
+        "max": ordered[-1]
+    }
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    """Start the app against the stand-ins, submit the story mix and collect the results."""
+    workdir = tempfile.mkdtemp(prefix="storee-bench-")
+    _configure_environment(workdir)
+    
+    rng = random.Random(args.seed)
+    gpu = FakeGPUService(
+        args.gpu_fixed_ms / 1000, args.gpu_per_item_ms / 1000, args.gpu_per_reference_ms / 1000,
+        args.gpu_failure_rate, args.gpu_concurrency, rng
+    )
+    receiver = CallbackReceiver()
+    
+    # Every service takes the shared Redis client, GPU client and callback
+    # dispatcher from these hooks, so they must be in place before main builds them
+    import redis_pool
+    from gpu_workers.callback_dispatcher import CallbackDispatcher, set_callback_dispatcher
+    from gpu_workers.worker_interface import GPUWorkerInterface, set_gpu_worker
+    redis_client = CountingRedis(decode_responses=True)
+    redis_pool.set_redis_client(redis_client)
+    # The app's outbound HTTP goes to the in-process services
+    set_callback_dispatcher(CallbackDispatcher(transport=httpx.ASGITransport(app=receiver.app)))
+    set_gpu_worker(GPUWorkerInterface(transport=httpx.ASGITransport(app=gpu.app)))
+    
+    import main as app_main
+    import metrics
+    from config import settings
+    logging.getLogger().setLevel(args.log_level)
+    
+    await app_main.startup_event()
+    client = httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app_main.app), base_url="http://storee.bench", timeout=None
+    )
+    cast = CAST[:args.cast_size]
+    failed_uploads = 0
+    rejected = 0
+    
+    async def submit(index: int, delay: float):
+        nonlocal failed_uploads, rejected
+        await asyncio.sleep(delay)
+        story_id = f"bench-{index:05d}"
+        priority = "premium" if rng.random() < args.premium_ratio else "free"
+        text = _story_text(index, rng.randint(args.min_scenes, args.max_scenes), cast, rng)
+        receiver.expect(story_id, priority, time.monotonic())
+        try:
+            response = await client.post(
+                "/submit_story",
+                params={
+                    "user_id": f"bench-user-{index}",
+                    "priority": priority,
+                    "callback_url": receiver.url(story_id),
+                    "story_id": story_id
+                },
+                content=_chunks(text, args.chunk_size),
+                headers={"content-type": "text/plain; charset=utf-8"}
+            )
+            if response.status_code == 429:
+                # Turned away by admission control
+                rejected += 1
+                receiver.accepted(story_id, None)
+                return
+            response.raise_for_status()
+            receiver.accepted(story_id, response.json()["task_count"])
+        except Exception as e:
+            logger.error(f"Submitting story {story_id} failed: {str(e)}")
+            failed_uploads += 1
+            receiver.accepted(story_id, None)
+    
+    # Open-loop arrivals: Poisson at --rate stories per second, or all at once
+    delays, elapsed = [], 0.0
+    for _ in range(args.stories):
+        delays.append(elapsed)
+        if args.rate > 0:
+            elapsed += rng.expovariate(args.rate)
+    
+    commands_before, round_trips_before = redis_client.commands, redis_client.round_trips
+    started = time.monotonic()
+    try:
+        await asyncio.gather(*(submit(index, delay) for index, delay in enumerate(delays)))
+        await asyncio.wait_for(receiver.all_done.wait(), timeout=args.timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"Timed out after {args.timeout}s with {receiver.pending} stories incomplete")
+    finished = time.monotonic()
+    commands = redis_client.commands - commands_before
+    round_trips = redis_client.round_trips - round_trips_before
+    
+    await client.aclose()
+    await app_main.shutdown_event()
+    leftovers = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in leftovers:
+        task.cancel()
+    await asyncio.gather(*leftovers, return_exceptions=True)
+    
+    stories = list(receiver.stories.values())
+    completed = [story for story in stories if story["completed_at"] is not None]
+    last_completion = max((story["completed_at"] for story in completed), default=finished)
+    duration = max(last_completion - started, 1e-9)
+    latencies = {
+        priority: [story["completed_at"] - story["submitted_at"] for story in completed if story["priority"] == priority]
+        for priority in settings.PRIORITY_LEVELS
+    }
+    fill_ratios = {
+        values[0]: child.sum / child.count
+        for values, child in metrics.BATCH_FILL_RATIO.children.items() if child.count
+    }
+    tasks_by_source: Dict[str, float] = {}
+    for (_, source), child in metrics.BATCH_TASKS.children.items():
+        tasks_by_source[source] = tasks_by_source.get(source, 0) + child.value
+    tasks_completed = sum(story["task_count"] for story in completed)
+    
+    return {
+        "benchmark": "load",
+        "started_at": datetime.utcnow().isoformat() + "Z",
+        "config": {
+            **vars(args),
+            "settings": {
+                name: getattr(settings, name)
+                for name in (
+                    "QUEUE_BACKEND", "BATCH_SIZE", "BATCH_MAX_SIZE", "PRIORITY_RATIO", "TARGET_P95_LATENCY",
+                    "RESULT_CACHE_ENABLED", "STORY_STREAM_ENQUEUE_SCENES", "CALLBACK_COALESCE_WINDOW",
+                    "AFFINITY_PACKING_ENABLED", "AFFINITY_LOOKAHEAD", "AFFINITY_MAX_DELAY"
+                )
+            }
+        },
+        "results": {
+            "stories_submitted": args.stories,
+            "stories_completed": len(completed),
+            "stories_incomplete": len(stories) - len(completed),
+            "stories_rejected": rejected,
+            "uploads_failed": failed_uploads,
+            "tasks_completed": tasks_completed,
+            "duration_seconds": duration,
+            "throughput_stories_per_second": len(completed) / duration,
+            "throughput_tasks_per_second": tasks_completed / duration,
+            "story_latency_seconds": {
+                "all": _percentiles([latency for values in latencies.values() for latency in values]),
+                **{priority: _percentiles(values) for priority, values in latencies.items()}
+            },
+            "batch_fill_ratio": fill_ratios,
+            "gpu": {
+                "batches": len(gpu.batch_sizes),
+                "failed_batches": gpu.failures,
+                "mean_batch_size": sum(gpu.batch_sizes) / len(gpu.batch_sizes) if gpu.batch_sizes else 0.0,
+                "mean_references_per_batch": sum(gpu.references) / len(gpu.references) if gpu.references else 0.0,
+                "busy_seconds": gpu.busy_seconds,
+                # Divided by GPU busy time, so it doesn't depend on how fast stories arrive
+                "images_per_gpu_second": sum(gpu.batch_sizes) / gpu.busy_seconds if gpu.busy_seconds else 0.0
+            },
+            "affinity": app_main.batching_service.packer.get_stats() if app_main.batching_service.packer else None,
+            "tasks_by_source": tasks_by_source,
+            "redis_commands_per_story": commands / len(stories) if stories else 0.0,
+            "redis_round_trips_per_story": round_trips / len(stories) if stories else 0.0
+        }
+    }
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stories", type=int, default=100, help="stories to submit")
+    parser.add_argument("--rate", type=float, default=10.0, help="mean arrivals per second (0: all at once)")
+    parser.add_argument("--premium-ratio", type=float, default=0.2, help="share of premium stories")
+    parser.add_argument("--min-scenes", type=int, default=4, help="fewest scenes per story")
+    parser.add_argument("--max-scenes", type=int, default=12, help="most scenes per story")
+    parser.add_argument("--cast-size", type=int, default=len(CAST), help="distinct character names stories draw from")
+    parser.add_argument("--chunk-size", type=int, default=256, help="bytes per upload chunk")
+    parser.add_argument("--gpu-fixed-ms", type=float, default=200.0, help="fixed cost per GPU batch")
+    parser.add_argument("--gpu-per-item-ms", type=float, default=50.0, help="added cost per task in a GPU batch")
+    parser.add_argument("--gpu-per-reference-ms", type=float, default=0.0, help="added cost per distinct reference image in a GPU batch")
+    parser.add_argument("--gpu-failure-rate", type=float, default=0.0, help="probability a GPU batch fails")
+    parser.add_argument("--gpu-concurrency", type=int, default=1, help="GPU batches that can run at once")
+    parser.add_argument("--timeout", type=float, default=600.0, help="seconds to wait for stories after submitting")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the story mix and GPU failures")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--log-level", default="WARNING", help="log level of the services under test")
+    args = parser.parse_args(argv)
+    if args.min_scenes < 1 or args.max_scenes < args.min_scenes:
+        parser.error("--min-scenes must be at least 1 and at most --max-scenes")
+    if not 1 <= args.cast_size <= len(CAST):
+        parser.error(f"--cast-size must be between 1 and {len(CAST)}")
+    return args
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    logger.setLevel(logging.INFO)
+    report = asyncio.run(run(args))
+    
+    results = report["results"]
+    latency = {
+        name: f"{value:.2f}s" if value is not None else "n/a"
+        for name, value in results["story_latency_seconds"]["all"].items()
+    }
+    logger.info(
+        f"{results['stories_completed']}/{results['stories_submitted']} stories in {results['duration_seconds']:.1f}s "
+        f"({results['throughput_stories_per_second']:.2f}/s); latency p50 {latency['p50']} p95 {latency['p95']} "
+        f"p99 {latency['p99']}; {results['redis_commands_per_story']:.0f} Redis commands per story"
+    )
+    output = json.dumps(report, indent=2, default=str)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from typing import List, Dict, Any, Optional, Tuple
+import redis.asyncio as redis
+
+from config import settings
+from redis_pool import get_redis_client
+from gpu_workers.artifact_store import ArtifactStore, get_artifact_store
+from gpu_workers.callback_dispatcher import CallbackDispatcher, get_callback_dispatcher
+
+logger = logging.getLogger(__name__)
+
+class VideoComposer:
+    """
+    Assembles a story's video incrementally as its clips complete.
+    
+    Each completed clip is turned into an MPEG-TS segment on its own (stream
+    copy, or a short encode for still images), so segments can be produced
+    in any order and by any batcher process. Segments are published to the
+    story's HLS playlist strictly in scene order: whenever the next scene's
+    segment is ready, it and any ready successors are appended, so the video
+    is playable as soon as the first scene is done and nothing is ever
+    re-encoded. Once every scene of a sealed story is published, the
+    playlist is closed, remuxed into a single MP4 in the artifact store and
+    the story's callback_url is notified.
+    
+    State per story (Redis):
+        composer:{story_id}           HASH total, sealed, next, started_at, first_segment_at
+        composer:{story_id}:segments  HASH scene_idx -> duration of its ready segment (-1: clip failed, skipped)
+    """
+    
+    def __init__(
+        self,
+        redis_client: Optional[redis.Redis] = None,
+        artifact_store: Optional[ArtifactStore] = None,
+        callback_dispatcher: Optional[CallbackDispatcher] = None
+    ):
+        self.redis_client = redis_client or get_redis_client()
+        self.artifact_store = artifact_store or get_artifact_store()
+        self.callback_dispatcher = callback_dispatcher or get_callback_dispatcher()
+        self.semaphore = asyncio.Semaphore(settings.COMPOSER_CONCURRENCY)
+        self.jobs: set = set()
+    
+    @staticmethod
+    def _keys(story_id: str) -> List[str]:
+        """Composer keys of a story."""
+        return [f"composer:{story_id}", f"composer:{story_id}:segments"]
+    
+    def story_dir(self, story_id: str) -> str:
+        """Directory holding a story's playlist and segments."""
+        if os.path.basename(story_id) != story_id or story_id in ("", ".", ".."):
+            raise ValueError(f"Invalid story_id {story_id!r}")
+        return os.path.join(settings.COMPOSER_DIR, story_id)
+    
+    def playlist_path(self, story_id: str) -> str:
+        """HLS playlist of a story's video."""
+        return os.path.join(self.story_dir(story_id), "index.m3u8")
+    
+    def stage_scenes(self, pipe: redis.client.Pipeline, tasks: List[Dict[str, Any]], sealed: bool = True):
+        """
+        Queue the expected scene counts of stories on a pipeline.
+        
+        Args:
+            pipe: Pipeline the stories' tasks are enqueued on
+            tasks: Tasks being enqueued; each clip task is one scene of the video
+            sealed: Whether these are the story's last tasks
+        """
+        clips: Dict[str, int] = {}
+        for task in tasks:
+            if task["task_type"] == "clip":
+                clips[task["story_id"]] = clips.get(task["story_id"], 0) + 1
+            else:
+                clips.setdefault(task["story_id"], 0)
+        
+        for story_id, count in clips.items():
+            state_key, segments_key = self._keys(story_id)
+            pipe.hincrby(state_key, "total", count)
+            pipe.hsetnx(state_key, "next", 0)
+            pipe.hsetnx(state_key, "started_at", time.time())
+            if sealed:
+                pipe.hset(state_key, "sealed", 1)
+            pipe.expire(state_key, settings.TASK_GRAPH_TTL)
+    
+    def on_clips_completed(self, tasks: List[Dict[str, Any]], results: Dict[str, Any]):
+        """Start composing a batch's finished clips in the background; returns immediately."""
+        for task, result in zip(tasks, results.get("task_results", [])):
+            if task.get("task_type") != "clip":
+                continue
+            artifact = result.get("artifact") if isinstance(result, dict) else None
+            job = asyncio.create_task(self._compose(task, artifact))
+            self.jobs.add(job)
+            job.add_done_callback(self.jobs.discard)
+    
+    async def _compose(self, task: Dict[str, Any], artifact: Optional[Dict[str, Any]]):
+        """Segment one clip and publish whatever is now contiguous."""
+        story_id = task["story_id"]
+        scene_idx = int(task["scene_idx"])
+        duration = -1.0
+        try:
+            if artifact:
+                async with self.semaphore:
+                    duration = await self._segment(story_id, scene_idx, artifact)
+            else:
+                logger.warning(f"Clip for scene {scene_idx} of story {story_id} failed, skipping it in the video")
+        except Exception as e:
+            logger.error(f"Error composing scene {scene_idx} of story {story_id}: {str(e)}")
+        try:
+            # A scene that can't be segmented is skipped rather than stalling the rest of the story
+            segments_key = self._keys(story_id)[1]
+            async with self.redis_client.pipeline(transaction=True) as pipe:
+                pipe.hset(segments_key, scene_idx, duration)
+                pipe.expire(segments_key, settings.TASK_GRAPH_TTL)
+                await pipe.execute()
+            await self._publish(story_id, task)
+        except Exception as e:
+            logger.error(f"Error publishing scene {scene_idx} of story {story_id}: {str(e)}")
+    
+    async def _run(self, *args: str) -> bytes:
+        """Run an ffmpeg tool and return its stdout."""
+        process = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError(f"{args[0]} exited with {process.returncode}: {stderr.decode(errors='replace')[-500:]}")
+        return stdout
+    
+    async def _segment(self, story_id: str, scene_idx: int, artifact: Dict[str, Any]) -> float:
+        """Write a clip's MPEG-TS segment and return its duration in seconds."""
+        source = self.artifact_store.resolve(artifact)
+        os.makedirs(self.story_dir(story_id), exist_ok=True)
+        segment = os.path.join(self.story_dir(story_id), f"scene_{scene_idx:05d}.ts")
+        tmp_segment = f"{segment}.tmp"
+        
+        if artifact.get("media_type", "").startswith("image/"):
+            # A still frame becomes a short clip of its own
+            args = [
+                "-loop", "1", "-t", str(settings.COMPOSER_IMAGE_DURATION), "-i", source,
+                "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p"
+            ]
+        elif settings.COMPOSER_VIDEO_CODEC == "copy":
+            args = ["-i", source, "-c", "copy", "-bsf:v", "h264_mp4toannexb"]
+        else:
+            args = ["-i", source, "-c:v", settings.COMPOSER_VIDEO_CODEC, "-preset", "veryfast", "-c:a", "aac"]
+        await self._run(settings.FFMPEG_PATH, "-y", "-v", "error", *args, "-f", "mpegts", tmp_segment)
+        os.replace(tmp_segment, segment)
+        
+        probe = await self._run(
+            settings.FFPROBE_PATH, "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", segment
+        )
+        return float(probe.decode().strip() or 0)
+    
+    async def _publish(self, story_id: str, task: Dict[str, Any]):
+        """Append contiguous ready segments to the playlist, and finish the video when complete."""
+        state_key, segments_key = self._keys(story_id)
+        async with self.redis_client.lock(f"composer:{story_id}:lock", timeout=settings.COMPOSER_LOCK_TIMEOUT):
+            state = await self.redis_client.hgetall(state_key)
+            durations = await self.redis_client.hgetall(segments_key)
+            published = int(state.get("next", 0))
+            ready = published
+            while str(ready) in durations:
+                ready += 1
+            if ready == published:
+                return
+            
+            total = int(state.get("total", 0))
+            done = bool(state.get("sealed")) and ready >= total
+            segments = [(i, float(durations[str(i)])) for i in range(ready) if float(durations[str(i)]) >= 0]
+            if segments:
+                self._write_playlist(story_id, segments, done)
+            await self.redis_client.hset(state_key, "next", ready)
+            if segments and "first_segment_at" not in state:
+                first_segment_at = time.time()
+                await self.redis_client.hset(state_key, "first_segment_at", first_segment_at)
+                started_at = float(state.get("started_at", first_segment_at))
+                logger.info(f"Story {story_id} video playable after {first_segment_at - started_at:.1f}s")
+            logger.info(f"Published scenes {published}-{ready - 1} of story {story_id} ({ready}/{total})")
+        
+        if done and segments:
+            await self._finish(story_id, task)
+        elif done:
+            logger.error(f"Every clip of story {story_id} failed, no video composed")
+    
+    def _write_playlist(self, story_id: str, segments: List[Tuple[int, float]], done: bool):
+        """Atomically rewrite a story's HLS playlist for its published segments."""
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            f"#EXT-X-TARGETDURATION:{max(1, math.ceil(max(duration for _, duration in segments)))}",
+            "#EXT-X-MEDIA-SEQUENCE:0",
+            f"#EXT-X-PLAYLIST-TYPE:{'VOD' if done else 'EVENT'}"
+        ]
+        for position, (scene_idx, duration) in enumerate(segments):
+            if position:
+                # Segments are encoded independently, so timestamps restart per scene
+                lines.append("#EXT-X-DISCONTINUITY")
+            lines.append(f"#EXTINF:{duration:.3f},")
+            lines.append(f"scene_{scene_idx:05d}.ts")
+        if done:
+            lines.append("#EXT-X-ENDLIST")
+        
+        path = self.playlist_path(story_id)
+        with open(f"{path}.tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(f"{path}.tmp", path)
+    
+    async def _finish(self, story_id: str, task: Dict[str, Any]):
+        """Remux the finished playlist into one MP4 and notify the story's callback."""
+        output = os.path.join(self.story_dir(story_id), "video.mp4")
+        await self._run(
+            settings.FFMPEG_PATH, "-y", "-v", "error", "-i", self.playlist_path(story_id),
+            "-c", "copy", "-movflags", "+faststart", output
+        )
+        video = await self.artifact_store.put_file(output, move=True)
+        logger.info(f"Composed video of story {story_id}: {video['artifact']}")
+        
+        if task.get("callback_url"):
+            await self.callback_dispatcher.dispatch([(task["callback_url"], {
+                "story_id": story_id,
+                "status": "video_ready",
+                "video": video,
+                "playlist": self.playlist_path(story_id),
+                "timestamp": time.time()
+            })])
+    
+    async def get_status(self, story_id: str) -> Dict[str, Any]:
+        """Composition progress of a story."""
+        state = await self.redis_client.hgetall(self._keys(story_id)[0])
+        return {
+            "scenes_total": int(state.get("total", 0)),
+            "scenes_published": int(state.get("next", 0)),
+            "sealed": bool(state.get("sealed")),
+            "playlist": self.playlist_path(story_id) if "first_segment_at" in state else None,
+            "first_segment_at": float(state["first_segment_at"]) if "first_segment_at" in state else None
+        }
+    
+    async def stop(self):
+        """Wait for in-flight compositions to finish."""
+        await asyncio.gather(*self.jobs, return_exceptions=True)
+
+_composer: Optional[VideoComposer] = None
+
+def get_video_composer() -> VideoComposer:
+    """Get the process-wide video composer, creating it on first use."""
+    global _composer
+    if _composer is None:
+        _composer = VideoComposer()
+    return _composer
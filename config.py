@@ -10,14 +10,169 @@ class Settings(BaseSettings):
     REDIS_HOST: str = os.getenv("REDIS_HOST", "localhost")
     REDIS_PORT: int = int(os.getenv("REDIS_PORT", "6379"))
     REDIS_PASSWORD: Optional[str] = os.getenv("REDIS_PASSWORD")
+    REDIS_MAX_CONNECTIONS: int = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+    REDIS_POOL_TIMEOUT: int = int(os.getenv("REDIS_POOL_TIMEOUT", "20"))  # seconds to wait for a free pooled connection
     
     # GPU Service Configuration
     GPU_SERVICE_URL: str = os.getenv("GPU_SERVICE_URL", "http://localhost:8000")
     GPU_API_KEY: Optional[str] = os.getenv("GPU_API_KEY")
+    GPU_HTTP2: bool = os.getenv("GPU_HTTP2", "false").lower() == "true"  # requires the h2 package
+    GPU_REQUEST_TIMEOUT: float = float(os.getenv("GPU_REQUEST_TIMEOUT", "300"))  # seconds per batch request
+    GPU_MAX_CONNECTIONS: int = int(os.getenv("GPU_MAX_CONNECTIONS", "20"))
+    GPU_KEEPALIVE_EXPIRY: float = float(os.getenv("GPU_KEEPALIVE_EXPIRY", "60"))  # seconds
+    GPU_HEALTH_INTERVAL: float = float(os.getenv("GPU_HEALTH_INTERVAL", "5"))  # seconds between background probes
+    GPU_HEALTH_TIMEOUT: float = float(os.getenv("GPU_HEALTH_TIMEOUT", "2"))  # seconds
+    GPU_CIRCUIT_FAILURE_THRESHOLD: int = int(os.getenv("GPU_CIRCUIT_FAILURE_THRESHOLD", "3"))
+    GPU_CIRCUIT_RESET_TIMEOUT: float = float(os.getenv("GPU_CIRCUIT_RESET_TIMEOUT", "30"))  # seconds
+    GPU_BACKEND: str = os.getenv("GPU_BACKEND", "http")  # "http" (generic /process_batch service) or "comfyui"
+    
+    # ComfyUI Backend Configuration (GPU_BACKEND=comfyui)
+    COMFYUI_URLS: list = [url.strip() for url in os.getenv("COMFYUI_URLS", "http://localhost:8188").split(",") if url.strip()]
+    COMFYUI_REQUEST_TIMEOUT: float = float(os.getenv("COMFYUI_REQUEST_TIMEOUT", "30"))  # seconds per HTTP call
+    COMFYUI_PROMPT_TIMEOUT: float = float(os.getenv("COMFYUI_PROMPT_TIMEOUT", "600"))  # seconds a graph may run
+    COMFYUI_RECONNECT_BACKOFF: float = float(os.getenv("COMFYUI_RECONNECT_BACKOFF", "1"))  # seconds
+    COMFYUI_RECONNECT_MAX_BACKOFF: float = float(os.getenv("COMFYUI_RECONNECT_MAX_BACKOFF", "30"))  # seconds
+    COMFYUI_OUTPUT_DIR: str = os.getenv("COMFYUI_OUTPUT_DIR", "/mnt/data/comfyui/output")  # ComfyUI's output dir on the shared volume
+    
+    # ComfyUI Workflow Configuration (API-format templates, one per task type)
+    WORKFLOW_DIR: str = os.getenv(
+        "WORKFLOW_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "comfyui_service", "workflows")
+    )
+    WORKFLOW_TEMPLATES: Dict[str, str] = {
+        "character": os.getenv("WORKFLOW_CHARACTER", "mv_adapter_workflow.json"),
+        "scene": os.getenv("WORKFLOW_SCENE", "mv_adapter_workflow.json"),
+        "clip": os.getenv("WORKFLOW_CLIP", "")  # empty: clips run on the generic GPU service's own pipeline
+    }
+    WORKFLOW_MAX_BATCH_SIZE: int = int(os.getenv("WORKFLOW_MAX_BATCH_SIZE", "8"))  # images per latent batch
+    
+    # Callback Delivery Configuration
+    CALLBACK_TIMEOUT: float = float(os.getenv("CALLBACK_TIMEOUT", "10"))  # seconds per POST
+    CALLBACK_CONCURRENCY: int = int(os.getenv("CALLBACK_CONCURRENCY", "20"))
+    CALLBACK_MAX_CONNECTIONS: int = int(os.getenv("CALLBACK_MAX_CONNECTIONS", "100"))
+    CALLBACK_KEEPALIVE_EXPIRY: float = float(os.getenv("CALLBACK_KEEPALIVE_EXPIRY", "30"))  # seconds
+    CALLBACK_COALESCE_WINDOW: float = float(os.getenv("CALLBACK_COALESCE_WINDOW", "0.05"))  # seconds
+    CALLBACK_LEASE: int = int(os.getenv("CALLBACK_LEASE", "60"))  # seconds before an undelivered entry is retried
+    CALLBACK_RETRY_INTERVAL: float = float(os.getenv("CALLBACK_RETRY_INTERVAL", "1"))  # seconds
+    CALLBACK_RETRY_BATCH: int = int(os.getenv("CALLBACK_RETRY_BATCH", "100"))
+    CALLBACK_RETRY_BASE_DELAY: float = float(os.getenv("CALLBACK_RETRY_BASE_DELAY", "1"))  # seconds
+    CALLBACK_RETRY_MAX_DELAY: float = float(os.getenv("CALLBACK_RETRY_MAX_DELAY", "300"))  # seconds
+    CALLBACK_MAX_ATTEMPTS: int = int(os.getenv("CALLBACK_MAX_ATTEMPTS", "8"))
     
     # Batching Configuration
     BATCH_SIZE: int = int(os.getenv("BATCH_SIZE", "10"))
     BATCH_TIMEOUT: int = int(os.getenv("BATCH_TIMEOUT", "5"))  # seconds
+    # Adaptive batching tunes size within [BATCH_MIN_SIZE, BATCH_MAX_SIZE] and linger up to BATCH_TIMEOUT
+    ADAPTIVE_BATCHING: bool = os.getenv("ADAPTIVE_BATCHING", "true").lower() == "true"
+    BATCH_MIN_SIZE: int = int(os.getenv("BATCH_MIN_SIZE", "1"))
+    BATCH_MAX_SIZE: int = int(os.getenv("BATCH_MAX_SIZE", os.getenv("BATCH_SIZE", "10")))
+    ADAPTIVE_WINDOW: int = int(os.getenv("ADAPTIVE_WINDOW", "100"))  # batches / tasks remembered per task type
+    ADAPTIVE_LINGER_FRACTION: float = float(os.getenv("ADAPTIVE_LINGER_FRACTION", "0.1"))  # share of latency slack spent lingering
+    TARGET_P95_LATENCY: Dict[str, float] = {  # seconds from enqueue to GPU result
+        "premium": float(os.getenv("TARGET_P95_LATENCY_PREMIUM", "60")),
+        "free": float(os.getenv("TARGET_P95_LATENCY_FREE", "300"))
+    }
+    BATCH_BLOCK_TIMEOUT: int = int(os.getenv("BATCH_BLOCK_TIMEOUT", "5"))  # seconds a batch loop blocks waiting for its first task
+    # Affinity packing groups tasks sharing a character reference or story into the same batch (stream backend only)
+    AFFINITY_PACKING_ENABLED: bool = os.getenv("AFFINITY_PACKING_ENABLED", "true").lower() == "true"
+    AFFINITY_LOOKAHEAD: int = int(os.getenv("AFFINITY_LOOKAHEAD", "32"))  # queued tasks considered beyond the batch size
+    AFFINITY_MAX_DELAY: float = float(os.getenv("AFFINITY_MAX_DELAY", "5"))  # seconds a task may be held back for a better batch
+    
+    # Seconds a story's task graph is kept for tasks still waiting on dependencies
+    TASK_GRAPH_TTL: int = int(os.getenv("TASK_GRAPH_TTL", "86400"))
+    
+    # Story-level task fields are stored once per story in the compact task encoding
+    TASK_META_TTL: int = int(os.getenv("TASK_META_TTL", "86400"))  # seconds
+    TASK_META_CACHE_SIZE: int = int(os.getenv("TASK_META_CACHE_SIZE", "1024"))  # stories cached per process
+    
+    # Artifact Store (generated images and clips on the volume shared with ComfyUI)
+    ARTIFACT_DIR: str = os.getenv("ARTIFACT_DIR", "/mnt/data/artifacts")
+    ARTIFACT_MAX_BYTES: int = int(os.getenv("ARTIFACT_MAX_BYTES", str(100 * 1024 ** 3)))
+    ARTIFACT_MAX_AGE: float = float(os.getenv("ARTIFACT_MAX_AGE", str(7 * 86400)))  # seconds since last use
+    ARTIFACT_GC_INTERVAL: float = float(os.getenv("ARTIFACT_GC_INTERVAL", "300"))  # seconds
+    ARTIFACT_CHUNK_SIZE: int = int(os.getenv("ARTIFACT_CHUNK_SIZE", str(1024 * 1024)))  # bytes per streamed read
+    
+    # Video Composer (incremental HLS assembly of each story's clips)
+    COMPOSER_ENABLED: bool = os.getenv("COMPOSER_ENABLED", "true").lower() == "true"
+    COMPOSER_DIR: str = os.getenv("COMPOSER_DIR", "/mnt/data/videos")  # one playlist and its segments per story
+    COMPOSER_VIDEO_CODEC: str = os.getenv("COMPOSER_VIDEO_CODEC", "copy")  # "copy" when clips are already H.264
+    COMPOSER_IMAGE_DURATION: float = float(os.getenv("COMPOSER_IMAGE_DURATION", "3"))  # seconds a still clip is shown
+    COMPOSER_CONCURRENCY: int = int(os.getenv("COMPOSER_CONCURRENCY", "4"))  # ffmpeg processes per batcher
+    COMPOSER_LOCK_TIMEOUT: float = float(os.getenv("COMPOSER_LOCK_TIMEOUT", "60"))  # seconds
+    FFMPEG_PATH: str = os.getenv("FFMPEG_PATH", "ffmpeg")
+    FFPROBE_PATH: str = os.getenv("FFPROBE_PATH", "ffprobe")
+    
+    # Result Cache (GPU results memoized by their effective inputs, across users and stories)
+    RESULT_CACHE_ENABLED: bool = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+    RESULT_CACHE_TTL: int = int(os.getenv("RESULT_CACHE_TTL", "86400"))  # seconds since last use
+    RESULT_CACHE_MAX_BYTES: int = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 ** 2)))  # Redis memory for cached results
+    RESULT_CACHE_INFLIGHT_TTL: int = int(os.getenv("RESULT_CACHE_INFLIGHT_TTL", "900"))  # seconds a running task holds its key
+    
+    # Character Reference Cache (on the volume shared with ComfyUI)
+    CHARACTER_CACHE_DIR: str = os.getenv("CHARACTER_CACHE_DIR", "/mnt/data/character_refs")
+    CHARACTER_CACHE_MAX_BYTES: int = int(os.getenv("CHARACTER_CACHE_MAX_BYTES", str(10 * 1024 ** 3)))
+    
+    # Worker Pool Configuration (WORKER_PROCESSES > 0 runs workers in separate processes)
+    WORKER_PROCESSES: int = int(os.getenv("WORKER_PROCESSES", "0"))
+    WORKERS_PER_PROCESS: int = int(os.getenv("WORKERS_PER_PROCESS", "5"))
+    WORKER_SUPERVISE_INTERVAL: float = float(os.getenv("WORKER_SUPERVISE_INTERVAL", "1"))  # seconds
+    WORKER_DRAIN_TIMEOUT: float = float(os.getenv("WORKER_DRAIN_TIMEOUT", "30"))  # seconds
+    WORKER_RESTART_BACKOFF: float = float(os.getenv("WORKER_RESTART_BACKOFF", "1"))  # seconds
+    WORKER_RESTART_MAX_BACKOFF: float = float(os.getenv("WORKER_RESTART_MAX_BACKOFF", "60"))  # seconds
+    
+    # Autoscaler Configuration
+    AUTOSCALE_ENABLED: bool = os.getenv("AUTOSCALE_ENABLED", "true").lower() == "true"
+    AUTOSCALE_MIN_WORKERS: int = int(os.getenv("AUTOSCALE_MIN_WORKERS", "1"))
+    AUTOSCALE_MAX_WORKERS: int = int(os.getenv("AUTOSCALE_MAX_WORKERS", "20"))
+    AUTOSCALE_INTERVAL: float = float(os.getenv("AUTOSCALE_INTERVAL", "10"))  # seconds
+    AUTOSCALE_TARGET_DRAIN_TIME: float = float(os.getenv("AUTOSCALE_TARGET_DRAIN_TIME", "60"))  # seconds to clear the backlog
+    AUTOSCALE_DEFAULT_LATENCY: float = float(os.getenv("AUTOSCALE_DEFAULT_LATENCY", "5"))  # seconds per story before any are observed
+    AUTOSCALE_DOWN_RATIO: float = float(os.getenv("AUTOSCALE_DOWN_RATIO", "0.7"))  # scale down only below this fraction of the pool
+    AUTOSCALE_UP_COOLDOWN: float = float(os.getenv("AUTOSCALE_UP_COOLDOWN", "30"))  # seconds
+    AUTOSCALE_DOWN_COOLDOWN: float = float(os.getenv("AUTOSCALE_DOWN_COOLDOWN", "120"))  # seconds
+    AUTOSCALE_HISTORY: int = int(os.getenv("AUTOSCALE_HISTORY", "50"))  # decisions kept for the API
+    
+    # Story Submission Configuration
+    MAX_BULK_STORIES: int = int(os.getenv("MAX_BULK_STORIES", "500"))
+    STORY_STREAM_ENQUEUE_SCENES: int = int(os.getenv("STORY_STREAM_ENQUEUE_SCENES", "4"))  # scenes per enqueue of a streamed story
+    STORY_STREAM_MAX_PARAGRAPH: int = int(os.getenv("STORY_STREAM_MAX_PARAGRAPH", "65536"))  # characters buffered per scene
+    
+    # Story Progress Configuration (per-story counters and their event stream)
+    STORY_PROGRESS_CHANNEL: str = os.getenv("STORY_PROGRESS_CHANNEL", "story_progress")
+    STORY_PROGRESS_TTL: int = int(os.getenv("STORY_PROGRESS_TTL", "86400"))  # seconds after a story's last update
+    STORY_EVENTS_HEARTBEAT: float = float(os.getenv("STORY_EVENTS_HEARTBEAT", "15"))  # seconds between keepalives on idle event streams
+    
+    # Story Cancellation Configuration (queued tasks of cancelled stories are dropped before dispatch)
+    STORY_CANCEL_CHANNEL: str = os.getenv("STORY_CANCEL_CHANNEL", "story_cancel")
+    STORY_CANCEL_TTL: int = int(os.getenv("STORY_CANCEL_TTL", "86400"))  # seconds a cancelled story's tasks are dropped on sight
+    STORY_CANCEL_CACHE_SIZE: int = int(os.getenv("STORY_CANCEL_CACHE_SIZE", "10000"))  # cancelled stories remembered per process
+    
+    # Admission Control Configuration (rates and bursts in stories per minute)
+    ADMISSION_ENABLED: bool = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+    ADMISSION_USER_RATE: Dict[str, float] = {
+        "premium": float(os.getenv("ADMISSION_USER_RATE_PREMIUM", "30")),
+        "free": float(os.getenv("ADMISSION_USER_RATE_FREE", "5"))
+    }
+    ADMISSION_USER_BURST: Dict[str, int] = {
+        "premium": int(os.getenv("ADMISSION_USER_BURST_PREMIUM", "20")),
+        "free": int(os.getenv("ADMISSION_USER_BURST_FREE", "5"))
+    }
+    ADMISSION_PRIORITY_RATE: Dict[str, float] = {
+        "premium": float(os.getenv("ADMISSION_PRIORITY_RATE_PREMIUM", "600")),
+        "free": float(os.getenv("ADMISSION_PRIORITY_RATE_FREE", "300"))
+    }
+    ADMISSION_PRIORITY_BURST: Dict[str, int] = {
+        "premium": int(os.getenv("ADMISSION_PRIORITY_BURST_PREMIUM", "500")),
+        "free": int(os.getenv("ADMISSION_PRIORITY_BURST_FREE", "500"))
+    }
+    ADMISSION_MAX_QUEUE_DEPTH: Dict[str, int] = {  # queued tasks per priority
+        "premium": int(os.getenv("ADMISSION_MAX_QUEUE_DEPTH_PREMIUM", "20000")),
+        "free": int(os.getenv("ADMISSION_MAX_QUEUE_DEPTH_FREE", "50000"))
+    }
+    ADMISSION_TASKS_PER_STORY: int = int(os.getenv("ADMISSION_TASKS_PER_STORY", "25"))  # estimated tasks of a story not yet split
+    ADMISSION_THROUGHPUT_WINDOW: int = int(os.getenv("ADMISSION_THROUGHPUT_WINDOW", "60"))  # seconds of GPU throughput averaged
+    ADMISSION_ESTIMATE_TTL: float = float(os.getenv("ADMISSION_ESTIMATE_TTL", "1"))  # seconds a backlog reading is reused
+    ADMISSION_RETRY_AFTER: float = float(os.getenv("ADMISSION_RETRY_AFTER", "30"))  # seconds, when the drain rate is unknown
+    ADMISSION_DEFER: bool = os.getenv("ADMISSION_DEFER", "false").lower() == "true"  # queue stories that would miss their target at the next lower priority
     
     # Priority Configuration
     PRIORITY_RATIO: Dict[str, int] = {
@@ -25,6 +180,20 @@ class Settings(BaseSettings):
         "free": 1
     }
     
+    # Seconds a task may wait before its priority is served ahead of its fair share (0 disables aging)
+    SCHEDULER_MAX_WAIT: float = float(os.getenv("SCHEDULER_MAX_WAIT", "30"))
+    
+    # Task queue backend: "list" (single batcher) or "stream" (consumer groups, many batchers)
+    QUEUE_BACKEND: str = os.getenv("QUEUE_BACKEND", "list")
+    STREAM_GROUP: str = os.getenv("STREAM_GROUP", "batchers")
+    # An unacknowledged task is claimed once idle longer than the longest GPU call could take, plus a margin
+    STREAM_CLAIM_MARGIN: float = float(os.getenv("STREAM_CLAIM_MARGIN", "60"))  # seconds
+    STREAM_CLAIM_IDLE: float = float(os.getenv("STREAM_CLAIM_IDLE", str(max(GPU_REQUEST_TIMEOUT, COMFYUI_PROMPT_TIMEOUT) + STREAM_CLAIM_MARGIN)))  # seconds
+    STREAM_CLAIM_INTERVAL: float = float(os.getenv("STREAM_CLAIM_INTERVAL", "30"))  # seconds
+    STREAM_CLAIM_BATCH: int = int(os.getenv("STREAM_CLAIM_BATCH", "100"))
+    STREAM_MAX_DELIVERIES: int = int(os.getenv("STREAM_MAX_DELIVERIES", "5"))
+    STREAM_DEAD_LETTER: str = os.getenv("STREAM_DEAD_LETTER", "task_dead_letter:stream")
+    
     # Queue Names
     QUEUE_NAMES: Dict[str, Dict[str, str]] = {
         "character": {
@@ -0,0 +1,271 @@
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import mmap
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from typing import AsyncIterator, Dict, Any, Iterator, List, Optional
+import redis.asyncio as redis
+
+from config import settings
+from redis_pool import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+def _hash_file(path: str) -> str:
+    """SHA-256 of a file, read through a memory map so memory use stays flat."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                digest.update(mapped)
+    return digest.hexdigest()
+
+class ArtifactStore:
+    """
+    Content-addressed store for generated images and clips on the shared volume.
+    
+    Artifacts live under ARTIFACT_DIR as <sha256[:2]>/<sha256><ext>, on the
+    same /mnt/data volume ComfyUI writes to, so ingesting an output is a
+    rename rather than a copy and identical outputs are stored once. Tasks and
+    callbacks carry the reference returned by put_file()/put_stream() instead
+    of the bytes; readers map or stream the file.
+    
+    Like the character reference cache, Redis keeps an LRU index of artifacts
+    and their sizes. gc() removes artifacts unused for ARTIFACT_MAX_AGE and
+    then the least recently used ones while the total exceeds
+    ARTIFACT_MAX_BYTES.
+    """
+    
+    LRU_KEY = "artifacts:lru"
+    SIZES_KEY = "artifacts:sizes"
+    TOTAL_KEY = "artifacts:bytes"
+    
+    def __init__(self, redis_client: Optional[redis.Redis] = None, root: Optional[str] = None):
+        self.redis_client = redis_client or get_redis_client()
+        self.root = root or settings.ARTIFACT_DIR
+        self.incoming_dir = os.path.join(self.root, "incoming")
+        self.gc_task: Optional[asyncio.Task] = None
+    
+    def _name(self, digest: str, ext: str) -> str:
+        """Index name (path relative to the store root) of an artifact."""
+        return os.path.join(digest[:2], f"{digest}{ext}")
+    
+    def _reference(self, name: str, size: int) -> Dict[str, Any]:
+        """Reference handed to tasks and callbacks in place of the content."""
+        digest, ext = os.path.splitext(os.path.basename(name))
+        return {
+            "artifact": f"sha256:{digest}",
+            "path": os.path.join(self.root, name),
+            "size": size,
+            "media_type": mimetypes.guess_type(name)[0] or "application/octet-stream"
+        }
+    
+    def staging_dir(self, batch_id: str) -> str:
+        """Directory on the shared volume where a GPU service can write a batch's outputs."""
+        path = os.path.join(self.incoming_dir, batch_id)
+        os.makedirs(path, exist_ok=True)
+        return path
+    
+    def _install(self, src_path: str, name: str, move: bool):
+        """Place a file at its content address (rename when possible) or drop it if already stored."""
+        dst_path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        if os.path.exists(dst_path):
+            if move:
+                os.remove(src_path)
+            return
+        if move:
+            try:
+                os.replace(src_path, dst_path)
+                return
+            except OSError:
+                # Different filesystem: fall through to an in-kernel copy
+                pass
+        tmp_path = f"{dst_path}.{uuid.uuid4().hex}.tmp"
+        shutil.copyfile(src_path, tmp_path)
+        os.replace(tmp_path, dst_path)
+        if move:
+            os.remove(src_path)
+    
+    async def put_file(self, src_path: str, move: bool = True) -> Dict[str, Any]:
+        """
+        Store a file already on disk.
+        
+        Args:
+            src_path: File to ingest, ideally on the shared volume
+            move: Take ownership of the file (renamed into place) instead of copying it
+        
+        Returns:
+            Artifact reference
+        """
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(None, _hash_file, src_path)
+        name = self._name(digest, os.path.splitext(src_path)[1].lower())
+        size = os.path.getsize(src_path)
+        await loop.run_in_executor(None, self._install, src_path, name, move)
+        await self._index(name, size)
+        return self._reference(name, size)
+    
+    async def put_stream(self, chunks: AsyncIterator[bytes], ext: str = "") -> Dict[str, Any]:
+        """
+        Store content arriving in chunks (e.g. an HTTP download) without buffering it.
+        
+        Returns:
+            Artifact reference
+        """
+        os.makedirs(self.incoming_dir, exist_ok=True)
+        tmp_path = os.path.join(self.incoming_dir, f"{uuid.uuid4().hex}.tmp")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_path, "wb") as f:
+                async for chunk in chunks:
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            name = self._name(digest.hexdigest(), ext.lower())
+            self._install(tmp_path, name, move=True)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        await self._index(name, size)
+        return self._reference(name, size)
+    
+    async def _index(self, name: str, size: int):
+        """Record an artifact as just used and account for its size."""
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.zadd(self.LRU_KEY, {name: time.time()})
+            pipe.hsetnx(self.SIZES_KEY, name, size)
+            added = (await pipe.execute())[1]
+        if added:
+            await self.redis_client.incrby(self.TOTAL_KEY, size)
+    
+    async def touch(self, references: List[Dict[str, Any]]):
+        """Mark artifacts as used (e.g. served from a cache) so GC keeps them."""
+        now = time.time()
+        names = {os.path.relpath(reference["path"], self.root): now for reference in references}
+        await self.redis_client.zadd(self.LRU_KEY, names, xx=True)
+    
+    def resolve(self, reference: Dict[str, Any]) -> str:
+        """Path of a referenced artifact, checked to be inside the store."""
+        path = os.path.realpath(reference["path"])
+        if not path.startswith(os.path.realpath(self.root) + os.sep):
+            raise ValueError(f"Artifact path {reference['path']} is outside the store")
+        return path
+    
+    def path_for(self, artifact_id: str) -> Optional[str]:
+        """Path of an artifact given its "sha256:<digest>" ID, if stored."""
+        digest = artifact_id.split(":", 1)[-1]
+        if len(digest) != 64 or not all(c in "0123456789abcdef" for c in digest):
+            return None
+        directory = os.path.join(self.root, digest[:2])
+        try:
+            for filename in os.listdir(directory):
+                if filename.startswith(digest) and not filename.endswith(".tmp"):
+                    return os.path.join(directory, filename)
+        except FileNotFoundError:
+            pass
+        return None
+    
+    @contextmanager
+    def open_mmap(self, reference: Dict[str, Any]) -> Iterator[mmap.mmap]:
+        """Map a referenced artifact read-only; pages are loaded on demand."""
+        with open(self.resolve(reference), "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield mapped
+    
+    def iter_chunks(self, reference: Dict[str, Any], chunk_size: Optional[int] = None) -> Iterator[bytes]:
+        """Stream a referenced artifact in fixed-size chunks."""
+        chunk_size = chunk_size or settings.ARTIFACT_CHUNK_SIZE
+        with open(self.resolve(reference), "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+    
+    def place(self, reference: Dict[str, Any], dst_path: str):
+        """Make an artifact available at another path on the volume (hard link, copy as fallback)."""
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        tmp_path = f"{dst_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.link(self.resolve(reference), tmp_path)
+        except OSError:
+            shutil.copyfile(self.resolve(reference), tmp_path)
+        os.replace(tmp_path, dst_path)
+    
+    async def gc(self) -> int:
+        """
+        Remove expired artifacts, then least recently used ones over the size bound.
+        
+        Returns:
+            Number of artifacts removed
+        """
+        expired = await self.redis_client.zrangebyscore(self.LRU_KEY, "-inf", time.time() - settings.ARTIFACT_MAX_AGE)
+        removed = 0
+        for name in expired:
+            await self._remove(name)
+            removed += 1
+        
+        total = int(await self.redis_client.get(self.TOTAL_KEY) or 0)
+        while total > settings.ARTIFACT_MAX_BYTES:
+            oldest = await self.redis_client.zrange(self.LRU_KEY, 0, 0)
+            if not oldest:
+                break
+            total = await self._remove(oldest[0])
+            removed += 1
+        
+        if removed:
+            logger.info(f"Artifact GC removed {removed} artifacts, {total} bytes remain")
+        return removed
+    
+    async def _remove(self, name: str) -> int:
+        """Drop one artifact from the index and the volume; returns the new total size."""
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.hget(self.SIZES_KEY, name)
+            pipe.zrem(self.LRU_KEY, name)
+            pipe.hdel(self.SIZES_KEY, name)
+            size, _, _ = await pipe.execute()
+        total = await self.redis_client.decrby(self.TOTAL_KEY, int(size or 0))
+        try:
+            os.remove(os.path.join(self.root, name))
+        except FileNotFoundError:
+            pass
+        return total
+    
+    async def _gc_loop(self):
+        """Run gc() every ARTIFACT_GC_INTERVAL seconds."""
+        while True:
+            await asyncio.sleep(settings.ARTIFACT_GC_INTERVAL)
+            try:
+                await self.gc()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error in artifact GC: {str(e)}")
+    
+    async def start(self):
+        """Start the background garbage collector."""
+        if self.gc_task is None:
+            self.gc_task = asyncio.create_task(self._gc_loop())
+    
+    async def stop(self):
+        """Stop the background garbage collector."""
+        if self.gc_task is not None:
+            self.gc_task.cancel()
+            await asyncio.gather(self.gc_task, return_exceptions=True)
+            self.gc_task = None
+
+_store: Optional[ArtifactStore] = None
+
+def get_artifact_store() -> ArtifactStore:
+    """Get the process-wide artifact store, creating it on first use."""
+    global _store
+    if _store is None:
+        _store = ArtifactStore()
+    return _store
@@ -0,0 +1,257 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+from typing import List, Dict, Any, Optional, Tuple
+import httpx
+import redis.asyncio as redis
+
+import metrics
+from config import settings
+from redis_pool import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+# Atomically leases due outbox entries so that only one dispatcher (across
+# processes) retries each of them. Entries keep their member string; only the
+# score moves forward to the end of the lease.
+CLAIM_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[3]))
+for _, member in ipairs(due) do
+    redis.call('ZADD', KEYS[1], ARGV[2], member)
+end
+return due
+"""
+
+# Renews the lease of entries right before they are sent: ARGV[1] is the new
+# lease end, followed by member/lease pairs. An entry is renewed and returned
+# only while its score is still the lease this dispatcher holds; otherwise
+# the lease ran out and the entry was claimed again (or settled) elsewhere.
+RENEW_SCRIPT = """
+local renewed = {}
+for i = 2, #ARGV, 2 do
+    local score = redis.call('ZSCORE', KEYS[1], ARGV[i])
+    if score and tonumber(score) == tonumber(ARGV[i + 1]) then
+        redis.call('ZADD', KEYS[1], ARGV[1], ARGV[i])
+        table.insert(renewed, ARGV[i])
+    end
+end
+return renewed
+"""
+
+class CallbackDispatcher:
+    """
+    Delivers task callbacks off the GPU batch path.
+    
+    Callbacks are written to a Redis outbox (a sorted set scored by the time
+    the entry is next due) before any delivery is attempted, then buffered in
+    memory per callback_url. Results for the same URL that arrive within
+    CALLBACK_COALESCE_WINDOW are sent as a single POST over a shared keep-alive
+    client with bounded concurrency. Successful deliveries are removed from the
+    outbox; failures are rescheduled with exponential backoff and moved to a
+    dead-letter list after CALLBACK_MAX_ATTEMPTS. Entries left behind by a
+    crashed process become due once their lease expires and are picked up by
+    any dispatcher's retry loop. The lease is renewed when a delivery gets
+    its turn to send, and only if it was not claimed again in the meantime,
+    so a callback queued behind slow endpoints is not delivered twice.
+    
+    A single callback is posted with the same body as before; coalesced
+    callbacks are posted as {"tasks": [<callback>, ...]}.
+    """
+    
+    OUTBOX_KEY = "callback_outbox"
+    DEAD_LETTER_KEY = "callback_outbox:dead"
+    
+    def __init__(
+        self,
+        redis_client: Optional[redis.Redis] = None,
+        transport: Optional[httpx.AsyncBaseTransport] = None
+    ):
+        self.redis_client = redis_client or get_redis_client()
+        self.client = httpx.AsyncClient(
+            transport=transport,
+            timeout=settings.CALLBACK_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=settings.CALLBACK_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.CALLBACK_MAX_CONNECTIONS,
+                keepalive_expiry=settings.CALLBACK_KEEPALIVE_EXPIRY
+            )
+        )
+        self.semaphore = asyncio.Semaphore(settings.CALLBACK_CONCURRENCY)
+        self.claim_script = self.redis_client.register_script(CLAIM_SCRIPT)
+        self.renew_script = self.redis_client.register_script(RENEW_SCRIPT)
+        # Outbox member -> end of the lease this process holds on it
+        self.leases: Dict[str, float] = {}
+        self.buffers: Dict[str, List[Tuple[str, Dict[str, Any]]]] = {}
+        self.flush_tasks: Dict[str, asyncio.Task] = {}
+        self.deliveries: set = set()
+        self.retry_task: Optional[asyncio.Task] = None
+    
+    async def start(self):
+        """Start the outbox retry loop."""
+        if self.retry_task is None:
+            self.retry_task = asyncio.create_task(self._retry_loop())
+    
+    async def stop(self):
+        """Stop retrying, flush buffered callbacks and close the HTTP client."""
+        if self.retry_task is not None:
+            self.retry_task.cancel()
+            await asyncio.gather(self.retry_task, return_exceptions=True)
+            self.retry_task = None
+        
+        for task in list(self.flush_tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self.flush_tasks.values(), return_exceptions=True)
+        
+        buffers, self.buffers = self.buffers, {}
+        await asyncio.gather(
+            *(self._deliver(url, items) for url, items in buffers.items()),
+            *self.deliveries,
+            return_exceptions=True
+        )
+        await self.client.aclose()
+    
+    async def dispatch(self, callbacks: List[Tuple[str, Dict[str, Any]]]):
+        """
+        Record callbacks in the outbox and schedule their delivery.
+        
+        Returns as soon as the outbox write is done; delivery happens in the
+        background.
+        
+        Args:
+            callbacks: (callback_url, callback_data) pairs
+        """
+        if not callbacks:
+            return
+        
+        items = []
+        for callback_url, callback_data in callbacks:
+            entry = {
+                "id": str(uuid.uuid4()),
+                "callback_url": callback_url,
+                "payload": callback_data,
+                "attempt": 0
+            }
+            items.append((json.dumps(entry), entry))
+        
+        lease_until = time.time() + settings.CALLBACK_LEASE
+        await self.redis_client.zadd(self.OUTBOX_KEY, {member: lease_until for member, _ in items})
+        for item in items:
+            self.leases[item[0]] = lease_until
+            self._buffer(item)
+    
+    def _buffer(self, item: Tuple[str, Dict[str, Any]]):
+        """Buffer an outbox entry until its URL's coalescing window closes."""
+        callback_url = item[1]["callback_url"]
+        self.buffers.setdefault(callback_url, []).append(item)
+        if callback_url not in self.flush_tasks:
+            self.flush_tasks[callback_url] = asyncio.create_task(self._flush_after_window(callback_url))
+    
+    async def _flush_after_window(self, callback_url: str):
+        """Deliver everything buffered for a URL once the coalescing window closes."""
+        try:
+            await asyncio.sleep(settings.CALLBACK_COALESCE_WINDOW)
+        finally:
+            self.flush_tasks.pop(callback_url, None)
+        
+        items = self.buffers.pop(callback_url, [])
+        if items:
+            delivery = asyncio.create_task(self._deliver(callback_url, items))
+            self.deliveries.add(delivery)
+            delivery.add_done_callback(self.deliveries.discard)
+    
+    async def _deliver(self, callback_url: str, items: List[Tuple[str, Dict[str, Any]]]):
+        """POST one or more coalesced callbacks and settle their outbox entries."""
+        try:
+            async with self.semaphore:
+                items = await self._renew(items)
+                if not items:
+                    return
+                payloads = [entry["payload"] for _, entry in items]
+                body = payloads[0] if len(payloads) == 1 else {"tasks": payloads}
+                # Bounded by the renewed lease, which CALLBACK_LEASE must exceed
+                response = await asyncio.wait_for(
+                    self.client.post(callback_url, json=body), settings.CALLBACK_TIMEOUT
+                )
+                response.raise_for_status()
+            await self.redis_client.zrem(self.OUTBOX_KEY, *(member for member, _ in items))
+            delivered_at = time.time()
+            for payload in payloads:
+                if payload.get("timestamp"):
+                    metrics.CALLBACK_LATENCY.observe(max(0.0, delivered_at - payload["timestamp"]))
+        except Exception as e:
+            logger.warning(f"Callback delivery of {len(items)} results to {callback_url} failed: {str(e)}")
+            metrics.CALLBACK_FAILURES.inc(len(items))
+            await self._reschedule(items)
+        finally:
+            for member, _ in items:
+                self.leases.pop(member, None)
+    
+    async def _renew(self, items: List[Tuple[str, Dict[str, Any]]]) -> List[Tuple[str, Dict[str, Any]]]:
+        """Extend the leases of entries about to be sent, dropping those this process no longer holds."""
+        lease_until = time.time() + settings.CALLBACK_LEASE
+        args = [lease_until]
+        for member, _ in items:
+            args.extend([member, self.leases.get(member, 0)])
+        renewed = set(await self.renew_script(keys=[self.OUTBOX_KEY], args=args))
+        for member, _ in items:
+            if member in renewed:
+                self.leases[member] = lease_until
+            else:
+                self.leases.pop(member, None)
+        return [item for item in items if item[0] in renewed]
+    
+    async def _reschedule(self, items: List[Tuple[str, Dict[str, Any]]]):
+        """Reschedule failed entries with exponential backoff or dead-letter them."""
+        now = time.time()
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            for member, entry in items:
+                pipe.zrem(self.OUTBOX_KEY, member)
+                entry = {**entry, "attempt": entry["attempt"] + 1}
+                if entry["attempt"] >= settings.CALLBACK_MAX_ATTEMPTS:
+                    logger.error(f"Dead-lettering callback {entry['id']} for task {entry['payload'].get('task_id')}")
+                    pipe.lpush(self.DEAD_LETTER_KEY, json.dumps(entry))
+                    continue
+                delay = min(
+                    settings.CALLBACK_RETRY_BASE_DELAY * 2 ** (entry["attempt"] - 1),
+                    settings.CALLBACK_RETRY_MAX_DELAY
+                )
+                pipe.zadd(self.OUTBOX_KEY, {json.dumps(entry): now + delay})
+            await pipe.execute()
+    
+    async def _retry_loop(self):
+        """Periodically lease due outbox entries and queue them for delivery."""
+        while True:
+            try:
+                now = time.time()
+                lease_until = now + settings.CALLBACK_LEASE
+                due = await self.claim_script(
+                    keys=[self.OUTBOX_KEY],
+                    args=[now, lease_until, settings.CALLBACK_RETRY_BATCH]
+                )
+                for member in due:
+                    # An entry still in flight here keeps its one delivery, under the new lease
+                    held = member in self.leases
+                    self.leases[member] = lease_until
+                    if not held:
+                        self._buffer((member, json.loads(member)))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error in callback retry loop: {str(e)}")
+            await asyncio.sleep(settings.CALLBACK_RETRY_INTERVAL)
+
+_dispatcher: Optional[CallbackDispatcher] = None
+
+def get_callback_dispatcher() -> CallbackDispatcher:
+    """Get the process-wide callback dispatcher, creating it on first use."""
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = CallbackDispatcher()
+    return _dispatcher
+
+def set_callback_dispatcher(dispatcher: CallbackDispatcher):
+    """Use the given dispatcher process-wide, e.g. one with a test transport; call before building services."""
+    global _dispatcher
+    _dispatcher = dispatcher
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class CircuitBreaker:
+    """
+    Tracks GPU service failures and short-circuits work while it is down.
+    
+    The breaker opens after failure_threshold consecutive failures (of
+    requests or health probes; 4xx responses don't count) and stays open for reset_timeout seconds,
+    after which it is half-open: a single trial request may be in flight at a
+    time, taken with acquire(). Any success closes it; a failure while
+    half-open reopens it immediately.
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial = False
+    
+    def allow_request(self) -> bool:
+        """Check, without taking it, whether a request could be sent to the GPU service now."""
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            logger.info("GPU circuit breaker half-open, allowing a trial request")
+        return self.state == self.CLOSED or (self.state == self.HALF_OPEN and not self.trial)
+    
+    def try_acquire(self) -> bool:
+        """Take permission to send a request; while half-open only one trial is handed out."""
+        if not self.allow_request():
+            return False
+        if self.state == self.HALF_OPEN:
+            self.trial = True
+        return True
+    
+    async def acquire(self, poll_interval: float = 0.1):
+        """
+        Wait for permission to send a request, raising ConnectionError while the breaker is open.
+        
+        While another caller's trial is in flight this waits for its outcome:
+        a success lets the request through, a failure reopens the breaker.
+        """
+        while not self.try_acquire():
+            if self.state == self.OPEN:
+                raise ConnectionError("GPU circuit breaker is open")
+            await asyncio.sleep(poll_interval)
+    
+    def release(self):
+        """Give back a trial that ended without a success or failure being recorded."""
+        self.trial = False
+    
+    def record_success(self):
+        """Record a successful call, closing the breaker."""
+        if self.state != self.CLOSED:
+            logger.info("GPU circuit breaker closed")
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trial = False
+    
+    def record_failure(self):
+        """Record a failed call, opening the breaker past the failure threshold."""
+        self.failures += 1
+        self.trial = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.trip()
+    
+    def close(self):
+        """Close an open or half-open breaker without touching the failures counted while closed."""
+        if self.state != self.CLOSED:
+            self.record_success()
+    
+    def trip(self):
+        """Open the breaker immediately."""
+        if self.state != self.OPEN:
+            logger.warning(f"GPU circuit breaker open after {self.failures} failures")
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+    
+    async def wait_until_available(self, poll_interval: float = 1):
+        """Wait until the breaker lets work through."""
+        while not self.allow_request():
+            await asyncio.sleep(poll_interval)
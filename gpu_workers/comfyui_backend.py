@@ -0,0 +1,369 @@
+import asyncio
+import json
+import logging
+import os
+import uuid
+from collections import OrderedDict
+from typing import AsyncIterator, List, Dict, Any, Optional, Set, Tuple
+import aiohttp
+import httpx
+
+from config import settings
+from gpu_workers.workflow_templates import WorkflowRegistry, get_workflow_registry
+from gpu_workers.artifact_store import ArtifactStore, get_artifact_store
+
+logger = logging.getLogger(__name__)
+
+class ComfyUIInstance:
+    """
+    One ComfyUI server: graph submission over HTTP, completion over its websocket.
+    
+    A listener keeps a websocket open for this client's ID. ComfyUI uses it to
+    push queue status (the live depth used for routing), progress and
+    execution events for the prompts we submitted, so completion never polls
+    /history. If the socket drops, prompts still pending are checked against
+    /history once it is back, in case they finished in between.
+    """
+    
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip("/")
+        self.client_id = str(uuid.uuid4())
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=settings.COMFYUI_REQUEST_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=settings.GPU_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.GPU_MAX_CONNECTIONS,
+                keepalive_expiry=settings.GPU_KEEPALIVE_EXPIRY
+            )
+        )
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.listener: Optional[asyncio.Task] = None
+        self.connected = False
+        self.queue_remaining = 0
+        # Graphs routed here whose /prompt call hasn't returned yet
+        self.submitting = 0
+        self.pending: Dict[str, asyncio.Future] = {}
+        # Prompt currently executing on the instance, as last reported over the socket
+        self.executing: Optional[str] = None
+        # Outcomes of prompts that finished before submit() registered them
+        self.unclaimed: "OrderedDict[str, Optional[Exception]]" = OrderedDict()
+        self.progress: Dict[str, Dict[str, Any]] = {}
+    
+    @property
+    def load(self) -> int:
+        """Prompts queued or running on the instance, including ones not yet reported over the socket."""
+        return max(self.queue_remaining, len(self.pending)) + self.submitting
+    
+    async def start(self):
+        """Start the websocket listener."""
+        if self.listener is None:
+            self.session = aiohttp.ClientSession()
+            self.listener = asyncio.create_task(self._listen())
+    
+    async def close(self):
+        """Stop listening, fail pending prompts and close connections."""
+        if self.listener is not None:
+            self.listener.cancel()
+            await asyncio.gather(self.listener, return_exceptions=True)
+            self.listener = None
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"ComfyUI instance {self.base_url} closed"))
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        await self.client.aclose()
+    
+    async def _listen(self):
+        """Keep the websocket connected and dispatch its events, reconnecting with backoff."""
+        ws_url = self.base_url.replace("http", "ws", 1) + f"/ws?clientId={self.client_id}"
+        backoff = settings.COMFYUI_RECONNECT_BACKOFF
+        while True:
+            try:
+                async with self.session.ws_connect(ws_url, heartbeat=30) as ws:
+                    self.connected = True
+                    backoff = settings.COMFYUI_RECONNECT_BACKOFF
+                    logger.info(f"Connected to ComfyUI websocket at {self.base_url}")
+                    await self._recover_pending()
+                    async for message in ws:
+                        if message.type == aiohttp.WSMsgType.TEXT:
+                            self._handle_event(json.loads(message.data))
+                        elif message.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                            break
+                        # Binary messages are live previews, which we don't use
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"ComfyUI websocket at {self.base_url} failed: {str(e)}")
+            self.connected = False
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, settings.COMFYUI_RECONNECT_MAX_BACKOFF)
+    
+    def _handle_event(self, event: Dict[str, Any]):
+        """Update queue depth and progress, and settle finished prompts."""
+        event_type = event.get("type")
+        data = event.get("data") or {}
+        prompt_id = data.get("prompt_id")
+        
+        if event_type == "status":
+            self.queue_remaining = data.get("status", {}).get("exec_info", {}).get("queue_remaining", 0)
+        elif event_type == "progress" and prompt_id in self.pending:
+            self.progress[prompt_id] = {"node": data.get("node"), "value": data.get("value"), "max": data.get("max")}
+        elif event_type == "executing" and prompt_id and data.get("node") is None:
+            # A null node marks the end of the prompt's execution
+            if self.executing == prompt_id:
+                self.executing = None
+            self._settle(prompt_id)
+        elif event_type == "executing" and prompt_id:
+            self.executing = prompt_id
+        elif event_type == "execution_success":
+            self._settle(prompt_id)
+        elif event_type in ("execution_error", "execution_interrupted"):
+            message = data.get("exception_message") or event_type.replace("_", " ")
+            self._settle(prompt_id, RuntimeError(f"ComfyUI prompt {prompt_id} failed: {message}"))
+    
+    def _settle(self, prompt_id: Optional[str], error: Optional[Exception] = None):
+        """Resolve the waiter of a finished prompt."""
+        if prompt_id is None:
+            return
+        future = self.pending.get(prompt_id)
+        if future is None:
+            self.unclaimed[prompt_id] = error
+            if len(self.unclaimed) > 1000:
+                self.unclaimed.popitem(last=False)
+            return
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(None)
+    
+    async def _recover_pending(self):
+        """Settle prompts that finished while the websocket was down."""
+        for prompt_id in list(self.pending):
+            try:
+                response = await self.client.get(f"/history/{prompt_id}")
+                response.raise_for_status()
+                entry = response.json().get(prompt_id)
+            except Exception as e:
+                logger.warning(f"Could not check ComfyUI prompt {prompt_id}: {str(e)}")
+                continue
+            if entry and entry.get("status", {}).get("completed", True):
+                self._settle(prompt_id)
+    
+    async def submit(self, graph: Dict[str, Any]) -> str:
+        """Queue a graph and register a waiter for it."""
+        self.submitting += 1
+        try:
+            response = await self.client.post("/prompt", json={"prompt": graph, "client_id": self.client_id})
+        finally:
+            self.submitting -= 1
+        if response.status_code == 400:
+            raise ValueError(f"ComfyUI rejected graph: {response.text}")
+        response.raise_for_status()
+        prompt_id = response.json()["prompt_id"]
+        self.pending[prompt_id] = asyncio.get_running_loop().create_future()
+        # Fast prompts can finish before the response to /prompt arrives
+        if prompt_id in self.unclaimed:
+            self._settle(prompt_id, self.unclaimed.pop(prompt_id))
+        return prompt_id
+    
+    async def interrupt(self, prompt_id: str):
+        """
+        Stop a submitted prompt and fail its waiter.
+        
+        A prompt still queued is deleted from the queue. A running one is
+        interrupted, which ComfyUI applies to whatever is executing, so this
+        is only done while the socket reports this very prompt as executing.
+        """
+        if self.executing == prompt_id:
+            response = await self.client.post("/interrupt", json={"prompt_id": prompt_id})
+        else:
+            response = await self.client.post("/queue", json={"delete": [prompt_id]})
+        response.raise_for_status()
+        # A prompt deleted from the queue never reports back over the socket
+        self._settle(prompt_id, RuntimeError(f"ComfyUI prompt {prompt_id} was cancelled"))
+    
+    async def wait(self, prompt_id: str) -> Dict[str, Any]:
+        """
+        Wait for a submitted prompt to finish and fetch its outputs.
+        
+        Returns:
+            Mapping of output node ID -> ComfyUI output (e.g. {"images": [...]})
+        """
+        try:
+            await asyncio.wait_for(self.pending[prompt_id], timeout=settings.COMFYUI_PROMPT_TIMEOUT)
+        finally:
+            self.pending.pop(prompt_id, None)
+            self.progress.pop(prompt_id, None)
+        
+        response = await self.client.get(f"/history/{prompt_id}")
+        response.raise_for_status()
+        return response.json().get(prompt_id, {}).get("outputs", {})
+    
+    async def stream_output(self, image: Dict[str, Any]) -> AsyncIterator[bytes]:
+        """Download one output image through /view in chunks."""
+        params = {
+            "filename": image["filename"],
+            "subfolder": image.get("subfolder", ""),
+            "type": image.get("type", "output")
+        }
+        async with self.client.stream("GET", "/view", params=params) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(settings.ARTIFACT_CHUNK_SIZE):
+                yield chunk
+    
+    async def check_health(self) -> bool:
+        """Check that the instance answers and its websocket is connected."""
+        try:
+            response = await self.client.get("/system_stats", timeout=settings.GPU_HEALTH_TIMEOUT)
+            return response.status_code == 200 and self.connected
+        except Exception:
+            return False
+
+class ComfyUIBackend:
+    """
+    Runs batches directly on a set of ComfyUI instances.
+    
+    Each batch is compiled into graphs by the WorkflowRegistry; every graph
+    goes to the connected instance with the lowest live queue depth, so adding
+    an instance to COMFYUI_URLS adds throughput. Results are returned in the
+    same {"task_results": [...]} shape as the generic GPU service, one entry
+    per task in batch order, with each output as an artifact reference.
+    Outputs ComfyUI wrote to the shared volume (COMFYUI_OUTPUT_DIR) are
+    renamed into the artifact store; others are streamed from /view.
+    """
+    
+    def __init__(
+        self,
+        urls: Optional[List[str]] = None,
+        workflows: Optional[WorkflowRegistry] = None,
+        artifact_store: Optional[ArtifactStore] = None
+    ):
+        self.instances = [ComfyUIInstance(url) for url in (urls or settings.COMFYUI_URLS)]
+        self.workflows = workflows or get_workflow_registry()
+        self.artifact_store = artifact_store or get_artifact_store()
+        # Submitted prompts -> (instance, stories of their tasks), and those being interrupted
+        self.running: Dict[str, Tuple[ComfyUIInstance, Set[str]]] = {}
+        self.interrupted: Set[str] = set()
+    
+    async def start(self):
+        """Connect to every instance's websocket."""
+        for instance in self.instances:
+            await instance.start()
+    
+    async def close(self):
+        """Disconnect from every instance."""
+        await asyncio.gather(*(instance.close() for instance in self.instances))
+    
+    def _least_loaded(self) -> ComfyUIInstance:
+        """Pick the connected instance with the shortest queue (any instance if none is connected)."""
+        candidates = [instance for instance in self.instances if instance.connected] or self.instances
+        return min(candidates, key=lambda instance: instance.load)
+    
+    async def _run_job(self, job: Dict[str, Any], stories: Dict[str, str]) -> Dict[str, Dict[str, Any]]:
+        """Run one compiled graph and pick each task's image out of its outputs."""
+        instance = self._least_loaded()
+        prompt_id = await instance.submit(job["prompt"])
+        logger.debug(f"Submitted graph for {len(job['task_ids'])} tasks to {instance.base_url} as {prompt_id}")
+        self.running[prompt_id] = (instance, {stories[task_id] for task_id in job["task_ids"]})
+        try:
+            outputs = await instance.wait(prompt_id)
+        except Exception:
+            if prompt_id not in self.interrupted:
+                raise
+            return {
+                task_id: {"status": "cancelled", "instance": instance.base_url, "prompt_id": prompt_id}
+                for task_id in job["task_ids"]
+            }
+        finally:
+            self.running.pop(prompt_id, None)
+            self.interrupted.discard(prompt_id)
+        
+        results = {}
+        for task_id, output in job["outputs"].items():
+            images = outputs.get(output["node"], {}).get("images", [])
+            image = images[output["batch_index"]] if output["batch_index"] < len(images) else None
+            results[task_id] = {
+                "status": "completed" if image else "failed",
+                "artifact": await self._store_output(instance, image) if image else None,
+                "instance": instance.base_url,
+                "prompt_id": prompt_id
+            }
+        return results
+    
+    async def _store_output(self, instance: ComfyUIInstance, image: Dict[str, Any]) -> Dict[str, Any]:
+        """Move an output into the artifact store without holding it in memory."""
+        local_path = os.path.join(settings.COMFYUI_OUTPUT_DIR, image.get("subfolder", ""), image["filename"])
+        if image.get("type", "output") == "output" and os.path.exists(local_path):
+            return await self.artifact_store.put_file(local_path, move=True)
+        return await self.artifact_store.put_stream(
+            instance.stream_output(image), os.path.splitext(image["filename"])[1]
+        )
+    
+    async def process_batch(self, batch: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Run a batch of tasks on the ComfyUI instances.
+        
+        Args:
+            batch: Inflated task dictionaries
+        
+        Returns:
+            Dict with "task_results", one result per task in batch order
+        """
+        jobs = self.workflows.compile_batch(batch)
+        stories = {task["task_id"]: task["story_id"] for task in batch}
+        job_results = await asyncio.gather(*(self._run_job(job, stories) for job in jobs))
+        results = {task_id: result for job_result in job_results for task_id, result in job_result.items()}
+        
+        task_results = []
+        for task in batch:
+            result = results.get(task["task_id"])
+            if result is None:
+                logger.warning(f"No workflow for {task['task_type']} task {task['task_id']}")
+                result = {"status": "failed", "error": f"no workflow for task type {task['task_type']}"}
+            task_results.append(result)
+        return {"task_results": task_results}
+    
+    async def interrupt(self, story_ids: Set[str]) -> int:
+        """
+        Stop prompts whose tasks all belong to the given stories.
+        
+        Prompts shared with other stories keep running. The tasks of stopped
+        prompts get a "cancelled" result instead of failing the batch.
+        
+        Returns:
+            Number of prompts stopped
+        """
+        stopped = 0
+        for prompt_id, (instance, stories) in list(self.running.items()):
+            if prompt_id in self.interrupted or not stories <= story_ids:
+                continue
+            self.interrupted.add(prompt_id)
+            try:
+                await instance.interrupt(prompt_id)
+                stopped += 1
+            except Exception as e:
+                self.interrupted.discard(prompt_id)
+                logger.warning(f"Could not interrupt ComfyUI prompt {prompt_id}: {str(e)}")
+        return stopped
+    
+    async def check_health(self) -> bool:
+        """Healthy while at least one instance is reachable."""
+        checks = await asyncio.gather(*(instance.check_health() for instance in self.instances))
+        return any(checks)
+    
+    def get_instances(self) -> List[Dict[str, Any]]:
+        """Connection state, queue depth and in-flight progress per instance."""
+        return [
+            {
+                "url": instance.base_url,
+                "connected": instance.connected,
+                "queue_remaining": instance.queue_remaining,
+                "pending": len(instance.pending),
+                "progress": dict(instance.progress)
+            }
+            for instance in self.instances
+        ]
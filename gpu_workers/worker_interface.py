@@ -1,20 +1,86 @@
 import logging
+import os
+import shutil
 import httpx
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Set
 import asyncio
 from datetime import datetime
 
 from config import settings
+from gpu_workers.callback_dispatcher import CallbackDispatcher, get_callback_dispatcher
+from gpu_workers.circuit_breaker import CircuitBreaker
+from gpu_workers.comfyui_backend import ComfyUIBackend
+from gpu_workers.artifact_store import ArtifactStore, get_artifact_store
+from gpu_workers.workflow_templates import WorkflowRegistry, get_workflow_registry
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def _http2_available() -> bool:
+    """Check whether the optional h2 package needed for HTTP/2 is installed."""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def _is_client_error(error: Exception) -> bool:
+    """Check whether the GPU service answered with a 4xx status."""
+    return isinstance(error, httpx.HTTPStatusError) and 400 <= error.response.status_code < 500
+
 class GPUWorkerInterface:
-    def __init__(self):
+    def __init__(
+        self,
+        callback_dispatcher: Optional[CallbackDispatcher] = None,
+        workflows: Optional[WorkflowRegistry] = None,
+        artifact_store: Optional[ArtifactStore] = None,
+        transport: Optional[httpx.AsyncBaseTransport] = None
+    ):
+        self.callback_dispatcher = callback_dispatcher or get_callback_dispatcher()
+        self.artifact_store = artifact_store or get_artifact_store()
+        # Templates are loaded and validated once, when the GPU client is created
+        self.workflows = workflows or get_workflow_registry()
+        
+        http2 = settings.GPU_HTTP2 and _http2_available()
+        if settings.GPU_HTTP2 and not http2:
+            logger.warning("GPU_HTTP2 is enabled but the h2 package is not installed, using HTTP/1.1")
         self.client = httpx.AsyncClient(
+            transport=transport,
             base_url=settings.GPU_SERVICE_URL,
-            headers={"Authorization": f"Bearer {settings.GPU_API_KEY}"} if settings.GPU_API_KEY else {}
+            headers={"Authorization": f"Bearer {settings.GPU_API_KEY}"} if settings.GPU_API_KEY else {},
+            http2=http2,
+            timeout=settings.GPU_REQUEST_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=settings.GPU_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.GPU_MAX_CONNECTIONS,
+                keepalive_expiry=settings.GPU_KEEPALIVE_EXPIRY
+            )
         )
+        self.circuit_breaker = CircuitBreaker(
+            failure_threshold=settings.GPU_CIRCUIT_FAILURE_THRESHOLD,
+            reset_timeout=settings.GPU_CIRCUIT_RESET_TIMEOUT
+        )
+        # Talk to ComfyUI instances directly instead of the generic GPU service
+        self.comfyui = (
+            ComfyUIBackend(workflows=self.workflows, artifact_store=self.artifact_store)
+            if settings.GPU_BACKEND == "comfyui" else None
+        )
+        self.healthy = False
+        self.last_health_check: Optional[float] = None
+        self.health_task: Optional[asyncio.Task] = None
+    
+    async def start(self):
+        """Connect to the ComfyUI instances (if used) and start the background health prober."""
+        if self.comfyui is not None:
+            await self.comfyui.start()
+        if self.health_task is None:
+            self.health_task = asyncio.create_task(self._health_loop())
+    
+    async def _health_loop(self):
+        """Probe the GPU service periodically and feed the result to the circuit breaker."""
+        while True:
+            await self.check_health()
+            await asyncio.sleep(settings.GPU_HEALTH_INTERVAL)
     
     async def process_batch(self, batch: List[Dict[str, Any]]) -> Dict[str, Any]:
         """
@@ -22,30 +88,27 @@ class GPUWorkerInterface:
         
         Args:
             batch: List of task dictionaries to process
-            
+        
         Returns:
             Dict containing the batch processing results
         """
         try:
-            # Prepare the batch payload
-            payload = {
-                "batch_id": batch[0]["task_id"],  # Use first task ID as batch ID
-                "tasks": batch,
-                "timestamp": datetime.utcnow().timestamp()
-            }
-            
-            # Send the batch to the GPU service
-            response = await self.client.post("/process_batch", json=payload)
-            response.raise_for_status()
-            
-            # Process the results
-            results = response.json()
-            
-            # Send callbacks for each completed task
-            await self._send_callbacks(batch, results)
+            # While half-open, only one batch goes out as the trial
+            await self.circuit_breaker.acquire()
+            try:
+                results = await self._run_batch(batch)
+            except (httpx.HTTPError, ConnectionError, asyncio.TimeoutError) as e:
+                # A 4xx is a rejected batch, not a sign the GPU service is down
+                if not _is_client_error(e):
+                    self.circuit_breaker.record_failure()
+                raise
+            finally:
+                self.circuit_breaker.release()
+            self.circuit_breaker.record_success()
             
+            await self.deliver(batch, results)
             return results
-            
+        
         except httpx.HTTPError as e:
             logger.error(f"HTTP error processing batch: {str(e)}")
             raise
@@ -53,43 +116,188 @@ class GPUWorkerInterface:
             logger.error(f"Error processing batch: {str(e)}")
             raise
     
-    async def _send_callbacks(self, batch: List[Dict[str, Any]], results: Dict[str, Any]):
-        """Send callback notifications for completed tasks."""
+    async def _run_batch(self, batch: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Run tasks with a workflow template on ComfyUI (if used) and the rest on the generic GPU service."""
+        if self.comfyui is None:
+            return await self._post_batch(batch)
+        native = [task for task in batch if self.workflows.has_template(task["task_type"])]
+        generic = [task for task in batch if not self.workflows.has_template(task["task_type"])]
+        if not generic:
+            return await self.comfyui.process_batch(native)
+        if not native:
+            return await self._post_batch(generic)
+        
+        native_results, generic_results = await asyncio.gather(
+            self.comfyui.process_batch(native), self._post_batch(generic)
+        )
+        results = {}
+        for tasks, part in ((native, native_results), (generic, generic_results)):
+            results.update(zip((task["task_id"] for task in tasks), part.get("task_results", [])))
+        return {"task_results": [
+            results.get(task["task_id"], {"status": "failed", "error": "No result returned"}) for task in batch
+        ]}
+    
+    async def interrupt(self, story_ids: Set[str]) -> int:
+        """
+        Stop GPU jobs whose tasks all belong to the given (cancelled) stories.
+        
+        Only ComfyUI prompts can be stopped; the generic GPU service has no
+        way to abandon a batch, which then runs to completion.
+        
+        Returns:
+            Number of jobs stopped
+        """
+        if self.comfyui is None:
+            return 0
+        return await self.comfyui.interrupt(story_ids)
+    
+    async def _post_batch(self, batch: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Send a batch to the generic GPU service's /process_batch endpoint.
+        
+        The service writes outputs to "output_dir" on the shared volume and
+        returns their paths; results with a "path" inside output_dir are moved
+        into the artifact store and returned with an "artifact" reference
+        instead, and any other path fails its task.
+        """
+        batch_id = batch[0]["task_id"]  # Use first task ID as batch ID
+        output_dir = self.artifact_store.staging_dir(batch_id)
+        
+        # Prepare the batch payload; compatible tasks share one ComfyUI graph
+        payload = {
+            "batch_id": batch_id,
+            "tasks": batch,
+            "workflows": self.workflows.compile_batch(batch),
+            "output_dir": output_dir,
+            "timestamp": datetime.utcnow().timestamp()
+        }
+        
+        try:
+            response = await self.client.post("/process_batch", json=payload)
+            response.raise_for_status()
+            results = response.json()
+            
+            staged = os.path.realpath(output_dir)
+            for result in results.get("task_results", []):
+                if isinstance(result, dict) and result.get("path"):
+                    # Only files the service wrote to this batch's directory are moved into the store
+                    path = os.path.realpath(os.path.join(output_dir, result.pop("path")))
+                    if os.path.commonpath([staged, path]) != staged or not os.path.isfile(path):
+                        logger.warning(f"GPU service returned output {path} outside batch directory {output_dir}")
+                        result.update(status="failed", error="output outside the batch directory")
+                        continue
+                    result["artifact"] = await self.artifact_store.put_file(path, move=True)
+            return results
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+    
+    async def deliver(self, batch: List[Dict[str, Any]], results: Dict[str, Any]):
+        """
+        Hand results to their tasks: place outputs and queue callbacks.
+        
+        Also used for results that did not come from the GPU (e.g. cache hits).
+        """
+        # Character references are linked to where the reference cache expects them
+        self._place_outputs(batch, results)
+        
+        # Send callbacks for each completed task
+        await self._send_callbacks(batch, results)
+    
+    def _place_outputs(self, batch: List[Dict[str, Any]], results: Dict[str, Any]):
+        """Link artifacts of tasks with an "output_path" (character references) to that path."""
         for task, result in zip(batch, results.get("task_results", [])):
-            try:
-                callback_url = task["callback_url"]
-                callback_data = {
-                    "task_id": task["task_id"],
-                    "status": "completed",
-                    "result": result,
-                    "timestamp": datetime.utcnow().timestamp()
-                }
-                
-                async with httpx.AsyncClient() as client:
-                    response = await client.post(callback_url, json=callback_data)
-                    response.raise_for_status()
-                    
-            except Exception as e:
-                logger.error(f"Error sending callback for task {task['task_id']}: {str(e)}")
-                # TODO: Implement retry logic for failed callbacks
+            if task.get("output_path") and isinstance(result, dict) and result.get("artifact"):
+                try:
+                    self.artifact_store.place(result["artifact"], task["output_path"])
+                except OSError as e:
+                    logger.error(f"Could not place output of task {task['task_id']}: {str(e)}")
+    
+    async def _send_callbacks(self, batch: List[Dict[str, Any]], results: Dict[str, Any]):
+        """Hand callback notifications for finished tasks to the callback dispatcher."""
+        timestamp = datetime.utcnow().timestamp()
+        task_results = results.get("task_results", [])
+        callbacks = []
+        for index, task in enumerate(batch):
+            if index < len(task_results):
+                result = task_results[index]
+            else:
+                # The GPU service returned no result for this task
+                result = {"status": "failed", "error": "No result returned"}
+            if result.get("status") == "cancelled":
+                # Tasks of cancelled stories whose job was interrupted get no callback
+                continue
+            callbacks.append((task["callback_url"], {
+                "task_id": task["task_id"],
+                "status": result.get("status", "completed"),
+                "result": result,
+                "timestamp": timestamp
+            }))
+        
+        try:
+            # Delivery, coalescing and retries happen off the batch path
+            await self.callback_dispatcher.dispatch(callbacks)
+        except Exception as e:
+            logger.error(f"Error queueing {len(callbacks)} callbacks: {str(e)}")
+    
+    async def notify_failed(self, batch: List[Dict[str, Any]], error: str):
+        """Queue failed callbacks for tasks of a batch that will not be retried."""
+        await self._send_callbacks(batch, {
+            "task_results": [{"status": "failed", "error": error} for _ in batch]
+        })
     
     async def check_health(self) -> bool:
-        """Check if the GPU service is healthy and available."""
+        """
+        Probe the GPU service (or ComfyUI instances) and cache the result.
+        
+        A healthy probe only closes an open breaker, leaving failures counted
+        from requests alone; an unreachable or erroring service counts like a
+        failed request.
+        """
+        server_down = False
         try:
-            response = await self.client.get("/health")
-            return response.status_code == 200
+            if self.comfyui is not None:
+                self.healthy = await self.comfyui.check_health()
+                server_down = not self.healthy
+            else:
+                response = await self.client.get("/health", timeout=settings.GPU_HEALTH_TIMEOUT)
+                self.healthy = response.status_code == 200
+                server_down = response.status_code >= 500
         except Exception as e:
             logger.error(f"GPU service health check failed: {str(e)}")
-            return False
+            self.healthy = False
+            server_down = True
+        
+        self.last_health_check = datetime.utcnow().timestamp()
+        if self.healthy:
+            self.circuit_breaker.close()
+        elif server_down:
+            self.circuit_breaker.record_failure()
+        return self.healthy
     
     async def close(self):
-        """Close the HTTP client."""
+        """Stop the health prober and close the HTTP client and ComfyUI connections."""
+        if self.health_task is not None:
+            self.health_task.cancel()
+            await asyncio.gather(self.health_task, return_exceptions=True)
+            self.health_task = None
+        if self.comfyui is not None:
+            await self.comfyui.close()
         await self.client.aclose()
 
+_gpu_worker: Optional[GPUWorkerInterface] = None
+
+def get_gpu_worker() -> GPUWorkerInterface:
+    """Get the process-wide GPU client, creating it on first use."""
+    global _gpu_worker
+    if _gpu_worker is None:
+        _gpu_worker = GPUWorkerInterface()
+    return _gpu_worker
+
+def set_gpu_worker(gpu_worker: GPUWorkerInterface):
+    """Use the given GPU client process-wide, e.g. one with a test transport; call before building services."""
+    global _gpu_worker
+    _gpu_worker = gpu_worker
+
 async def process_batch(batch: List[Dict[str, Any]]) -> Dict[str, Any]:
     """Entry point for processing a batch of tasks."""
-    worker = GPUWorkerInterface()
-    try:
-        return await worker.process_batch(batch)
-    finally:
-        await worker.close() 
\ No newline at end of file
+    return await get_gpu_worker().process_batch(batch)
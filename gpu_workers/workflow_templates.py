@@ -0,0 +1,279 @@
+import json
+import logging
+import os
+import zlib
+from typing import List, Dict, Any, Optional, Tuple
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+SAMPLER_TYPES = ("KSampler", "KSamplerAdvanced")
+# Sampler inputs that must match for tasks to share a graph
+SAMPLER_SETTINGS = ("steps", "cfg", "sampler_name", "scheduler", "denoise")
+
+def _is_link(value: Any) -> bool:
+    """Check whether a node input is a link ([node_id, output_index]) to another node."""
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[0], str) and isinstance(value[1], int)
+
+class WorkflowTemplate:
+    """
+    A validated ComfyUI API-format workflow with precompiled substitution points.
+    
+    At load time the graph is checked for structure, dangling links and
+    cycles, and the nodes behind each substitution point are located from the
+    sampler's wiring: prompt and negative prompt (the CLIPTextEncode nodes
+    feeding "positive"/"negative"), seed, reference image (LoadImage) and
+    resolution (the EmptyLatentImage feeding "latent_image"). Nodes that
+    depend on any of them form the per-image branch; everything else
+    (checkpoint, MV-Adapter and other loaders) is shared.
+    
+    render() turns a group of tasks into one graph: the shared nodes appear
+    once, and each distinct (prompt, negative prompt, reference image)
+    becomes a branch whose latent has batch_size set to the number of tasks
+    in it. Stock ComfyUI conditions a sampler on a single prompt, so tasks
+    with different prompts become parallel branches rather than one latent
+    batch; the loaders are still paid once per graph.
+    """
+    
+    def __init__(self, name: str, graph: Dict[str, Dict[str, Any]]):
+        self.name = name
+        self.graph = graph
+        self._validate()
+        
+        samplers = self._nodes_of(*SAMPLER_TYPES)
+        if len(samplers) != 1:
+            raise ValueError(f"Workflow {name} must have exactly one sampler node, found {len(samplers)}")
+        self.sampler = samplers[0]
+        sampler_inputs = graph[self.sampler]["inputs"]
+        self.seed_input = "noise_seed" if "noise_seed" in sampler_inputs else "seed"
+        
+        self.positive = self._linked(self.sampler, "positive", "CLIPTextEncode")
+        self.negative = self._linked(self.sampler, "negative", "CLIPTextEncode", required=False)
+        self.latent = self._linked(self.sampler, "latent_image", "EmptyLatentImage")
+        self.references = self._nodes_of("LoadImage")
+        self.outputs = self._nodes_of("SaveImage")
+        if not self.outputs:
+            raise ValueError(f"Workflow {name} has no SaveImage node")
+        checkpoints = self._nodes_of("CheckpointLoaderSimple")
+        self.checkpoint = checkpoints[0] if checkpoints else None
+        
+        # Per-image nodes: substitution points and everything downstream of them
+        roots = {self.sampler, self.positive, self.latent, *self.references}
+        if self.negative:
+            roots.add(self.negative)
+        self.branch_nodes = self._downstream(roots)
+        self.shared_nodes = [node_id for node_id in self.order if node_id not in self.branch_nodes]
+        self.branch_order = [node_id for node_id in self.order if node_id in self.branch_nodes]
+        
+        self.defaults = {
+            "negative_prompt": graph[self.negative]["inputs"]["text"] if self.negative else None,
+            "reference_image": graph[self.references[0]]["inputs"]["image"] if self.references else None,
+            "width": graph[self.latent]["inputs"]["width"],
+            "height": graph[self.latent]["inputs"]["height"],
+            "checkpoint": graph[self.checkpoint]["inputs"]["ckpt_name"] if self.checkpoint else None,
+            **{key: sampler_inputs[key] for key in SAMPLER_SETTINGS if key in sampler_inputs}
+        }
+    
+    @classmethod
+    def load(cls, path: str) -> "WorkflowTemplate":
+        """Load and compile a workflow from an API-format JSON file."""
+        with open(path) as f:
+            graph = json.load(f)
+        return cls(os.path.basename(path), graph)
+    
+    def _validate(self):
+        """Check node structure and links, and compute a topological order."""
+        if not isinstance(self.graph, dict) or not self.graph:
+            raise ValueError(f"Workflow {self.name} is not an API-format node mapping")
+        
+        for node_id, node in self.graph.items():
+            if not isinstance(node, dict) or not isinstance(node.get("class_type"), str) or not isinstance(node.get("inputs"), dict):
+                raise ValueError(f"Workflow {self.name}: node {node_id} needs class_type and inputs")
+            for input_name, value in node["inputs"].items():
+                if _is_link(value) and value[0] not in self.graph:
+                    raise ValueError(f"Workflow {self.name}: {node_id}.{input_name} links to missing node {value[0]}")
+        
+        # Depth-first topological sort, rejecting cycles
+        self.order: List[str] = []
+        state: Dict[str, int] = {}
+        
+        def visit(node_id: str):
+            if state.get(node_id) == 2:
+                return
+            if state.get(node_id) == 1:
+                raise ValueError(f"Workflow {self.name} has a cycle through node {node_id}")
+            state[node_id] = 1
+            for value in self.graph[node_id]["inputs"].values():
+                if _is_link(value):
+                    visit(value[0])
+            state[node_id] = 2
+            self.order.append(node_id)
+        
+        for node_id in self.graph:
+            visit(node_id)
+    
+    def _nodes_of(self, *class_types: str) -> List[str]:
+        """IDs of nodes of the given classes, in topological order."""
+        return [node_id for node_id in self.order if self.graph[node_id]["class_type"] in class_types]
+    
+    def _linked(self, node_id: str, input_name: str, class_type: str, required: bool = True) -> Optional[str]:
+        """Node feeding an input, checked to be of the expected class."""
+        value = self.graph[node_id]["inputs"].get(input_name)
+        if not _is_link(value) or self.graph[value[0]]["class_type"] != class_type:
+            if required:
+                raise ValueError(f"Workflow {self.name}: {node_id}.{input_name} must be fed by a {class_type} node")
+            return None
+        return value[0]
+    
+    def _downstream(self, roots: set) -> set:
+        """Roots plus every node that (transitively) consumes one of them."""
+        nodes = set(roots)
+        for node_id in self.order:
+            if any(_is_link(value) and value[0] in nodes for value in self.graph[node_id]["inputs"].values()):
+                nodes.add(node_id)
+        return nodes
+    
+    def settings_for(self, task: Dict[str, Any]) -> Tuple:
+        """Checkpoint, resolution and sampler settings a task runs with (the grouping key)."""
+        return tuple(
+            task.get(key, self.defaults.get(key))
+            for key in ("checkpoint", "width", "height", *SAMPLER_SETTINGS)
+        )
+    
+    def render(self, tasks: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Build one ComfyUI graph for tasks sharing checkpoint, resolution and sampler settings.
+        
+        Args:
+            tasks: Tasks with the same settings_for() key
+        
+        Returns:
+            Dict with "prompt" (the graph to submit) and "outputs" mapping each
+            task_id to the SaveImage node and batch index of its image
+        """
+        first = tasks[0]
+        graph: Dict[str, Dict[str, Any]] = {}
+        for node_id in self.shared_nodes:
+            graph[node_id] = {**self.graph[node_id], "inputs": dict(self.graph[node_id]["inputs"])}
+        if self.checkpoint and "checkpoint" in first:
+            graph[self.checkpoint]["inputs"]["ckpt_name"] = first["checkpoint"]
+        
+        # Tasks with identical conditioning share a branch and a latent batch
+        branches: Dict[Tuple, List[Dict[str, Any]]] = {}
+        for task in tasks:
+            key = (
+                task["prompt"],
+                task.get("negative_prompt", self.defaults["negative_prompt"]),
+                task.get("reference_image", self.defaults["reference_image"])
+            )
+            members = branches.setdefault(key, [[]])
+            if len(members[-1]) >= settings.WORKFLOW_MAX_BATCH_SIZE:
+                members.append([])
+            members[-1].append(task)
+        
+        outputs: Dict[str, Dict[str, Any]] = {}
+        index = 0
+        for (prompt, negative_prompt, reference_image), members in branches.items():
+            for branch_tasks in members:
+                index += 1
+                suffix = f"_{index}"
+                renamed = {node_id: f"{node_id}{suffix}" for node_id in self.branch_order}
+                for node_id in self.branch_order:
+                    inputs = {
+                        name: [renamed[value[0]], value[1]] if _is_link(value) and value[0] in renamed else value
+                        for name, value in self.graph[node_id]["inputs"].items()
+                    }
+                    graph[renamed[node_id]] = {**self.graph[node_id], "inputs": inputs}
+                
+                lead = branch_tasks[0]
+                graph[renamed[self.positive]]["inputs"]["text"] = prompt
+                if self.negative:
+                    graph[renamed[self.negative]]["inputs"]["text"] = negative_prompt
+                for reference in self.references:
+                    graph[renamed[reference]]["inputs"]["image"] = reference_image
+                graph[renamed[self.sampler]]["inputs"][self.seed_input] = lead.get(
+                    "seed", zlib.crc32(lead["task_id"].encode())
+                )
+                for key in SAMPLER_SETTINGS:
+                    if key in lead:
+                        graph[renamed[self.sampler]]["inputs"][key] = lead[key]
+                latent = graph[renamed[self.latent]]["inputs"]
+                latent["width"] = lead.get("width", self.defaults["width"])
+                latent["height"] = lead.get("height", self.defaults["height"])
+                latent["batch_size"] = len(branch_tasks)
+                
+                save_node = renamed[self.outputs[0]]
+                for output in self.outputs:
+                    graph[renamed[output]]["inputs"]["filename_prefix"] = f"{lead.get('task_type', 'output')}/{lead['task_id']}"
+                for batch_index, task in enumerate(branch_tasks):
+                    outputs[task["task_id"]] = {"node": save_node, "batch_index": batch_index}
+        
+        return {"prompt": graph, "outputs": outputs}
+
+class WorkflowRegistry:
+    """
+    Workflow templates per task type, loaded and validated once.
+    
+    Task types configured without a template (clips by default, as no
+    animation workflow ships with the service) get no compiled graph; the
+    generic GPU service runs them through its own pipeline.
+    """
+    
+    def __init__(self, workflow_dir: Optional[str] = None):
+        self.workflow_dir = workflow_dir or settings.WORKFLOW_DIR
+        self.templates: Dict[str, WorkflowTemplate] = {}
+        loaded: Dict[str, WorkflowTemplate] = {}
+        for task_type, filename in settings.WORKFLOW_TEMPLATES.items():
+            if not filename:
+                continue
+            if filename not in loaded:
+                loaded[filename] = WorkflowTemplate.load(os.path.join(self.workflow_dir, filename))
+                logger.info(
+                    f"Compiled workflow {filename}: {len(loaded[filename].shared_nodes)} shared, "
+                    f"{len(loaded[filename].branch_nodes)} per-image nodes"
+                )
+            self.templates[task_type] = loaded[filename]
+    
+    def has_template(self, task_type: str) -> bool:
+        """Check whether tasks of a type run on a workflow template."""
+        return task_type in self.templates
+    
+    def compile_batch(self, batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Turn a batch into as few ComfyUI graphs as possible.
+        
+        Tasks are grouped by workflow and by checkpoint, resolution and sampler
+        settings; each group becomes one graph. Tasks of types without a
+        template are not part of any graph.
+        
+        Args:
+            batch: Task dictionaries (inflated, with prompt and task_type)
+        
+        Returns:
+            Jobs as returned by WorkflowTemplate.render, each with the IDs of
+            its tasks under "task_ids"
+        """
+        groups: Dict[Tuple, List[Dict[str, Any]]] = {}
+        for task in batch:
+            template = self.templates.get(task.get("task_type"))
+            if template is None:
+                # Left to the GPU service's own pipeline
+                continue
+            groups.setdefault((template.name, template.settings_for(task)), []).append(task)
+        
+        jobs = []
+        for tasks in groups.values():
+            job = self.templates[tasks[0]["task_type"]].render(tasks)
+            job["task_ids"] = [task["task_id"] for task in tasks]
+            jobs.append(job)
+        return jobs
+
+_registry: Optional[WorkflowRegistry] = None
+
+def get_workflow_registry() -> WorkflowRegistry:
+    """Get the process-wide workflow registry, loading the templates on first use."""
+    global _registry
+    if _registry is None:
+        _registry = WorkflowRegistry()
+    return _registry
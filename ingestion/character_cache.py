@@ -0,0 +1,195 @@
+import hashlib
+import logging
+import os
+import re
+import time
+from typing import List, Dict, Any, Optional
+import redis.asyncio as redis
+
+from config import settings
+from redis_pool import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+# Indexes references written by character tasks: ARGV holds cache key/size
+# pairs, ARGV[1] the current time. Keeps the total byte count (KEYS[3]) in
+# step with the sizes hash (KEYS[2]) and returns the new total.
+REGISTER_SCRIPT = """
+for i = 2, #ARGV, 2 do
+    local previous = tonumber(redis.call('HGET', KEYS[2], ARGV[i]) or '0')
+    redis.call('ZADD', KEYS[1], ARGV[1], ARGV[i])
+    redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 1])
+    redis.call('INCRBY', KEYS[3], tonumber(ARGV[i + 1]) - previous)
+end
+return tonumber(redis.call('GET', KEYS[3]) or '0')
+"""
+
+# Drops least recently used references from the index until the total is at
+# most ARGV[1] bytes, skipping references pinned by pending tasks (KEYS[4]).
+# Returns the dropped cache keys, whose files the caller then deletes.
+EVICT_SCRIPT = """
+local total = tonumber(redis.call('GET', KEYS[3]) or '0')
+local evicted = {}
+local offset = 0
+while total > tonumber(ARGV[1]) do
+    local oldest = redis.call('ZRANGE', KEYS[1], offset, offset)
+    if #oldest == 0 then
+        break
+    end
+    local cache_key = oldest[1]
+    if tonumber(redis.call('HGET', KEYS[4], cache_key) or '0') > 0 then
+        offset = offset + 1
+    else
+        local size = tonumber(redis.call('HGET', KEYS[2], cache_key) or '0')
+        redis.call('ZREM', KEYS[1], cache_key)
+        redis.call('HDEL', KEYS[2], cache_key)
+        total = redis.call('DECRBY', KEYS[3], size)
+        table.insert(evicted, cache_key)
+    end
+end
+return evicted
+"""
+
+# Releases one pin per ARGV entry, dropping counts that reach zero.
+UNPIN_SCRIPT = """
+for i = 1, #ARGV do
+    if redis.call('HINCRBY', KEYS[1], ARGV[i], -1) <= 0 then
+        redis.call('HDEL', KEYS[1], ARGV[i])
+    end
+end
+return 1
+"""
+
+class CharacterReferenceCache:
+    """
+    Content-addressed cache of generated character reference images.
+    
+    References live on the shared volume under CHARACTER_CACHE_DIR, named by a
+    hash of the story ID and the normalized character prompt, so a character
+    is generated once per story no matter how many scenes it appears in. Redis
+    keeps an LRU index of cached references and their sizes; the least recently
+    used files are evicted once the total exceeds CHARACTER_CACHE_MAX_BYTES.
+    
+    Scene tasks pin the reference they use from the moment they are enqueued
+    until they finish, and pinned references are never evicted, so a queued
+    scene can't lose its reference. A task lost without finishing (a crashed
+    batcher on the list backend) leaves its pin behind, which only keeps
+    that one reference on disk.
+    """
+    
+    LRU_KEY = "character_cache:lru"
+    SIZES_KEY = "character_cache:sizes"
+    TOTAL_KEY = "character_cache:bytes"
+    PINS_KEY = "character_cache:pins"
+    
+    def __init__(self, redis_client: Optional[redis.Redis] = None):
+        self.redis_client = redis_client or get_redis_client()
+        self.cache_dir = settings.CHARACTER_CACHE_DIR
+        self.register_script = self.redis_client.register_script(REGISTER_SCRIPT)
+        self.evict_script = self.redis_client.register_script(EVICT_SCRIPT)
+        self.unpin_script = self.redis_client.register_script(UNPIN_SCRIPT)
+    
+    @staticmethod
+    def normalize_prompt(prompt: str) -> str:
+        """Normalize a character prompt so trivially different spellings share a reference."""
+        return re.sub(r"\s+", " ", prompt).strip().strip(".,;:!?").lower()
+    
+    def cache_key(self, story_id: str, prompt: str) -> str:
+        """Content address of a story's character reference."""
+        digest = hashlib.sha256(f"{story_id}\0{self.normalize_prompt(prompt)}".encode("utf-8"))
+        return digest.hexdigest()
+    
+    def reference_path(self, cache_key: str) -> str:
+        """Path on the shared volume where a reference image is stored."""
+        return os.path.join(self.cache_dir, f"{cache_key}.png")
+    
+    def _pinned_keys(self, tasks: List[Dict[str, Any]]) -> List[str]:
+        """Cache keys of the references used by scene tasks, one per task."""
+        return [
+            os.path.splitext(os.path.basename(task["reference_image"]))[0]
+            for task in tasks
+            if task.get("task_type") == "scene" and task.get("reference_image")
+        ]
+    
+    def pin(self, pipe: redis.client.Pipeline, tasks: List[Dict[str, Any]]):
+        """Queue pinning the references of scene tasks on the pipeline that enqueues them."""
+        for cache_key in self._pinned_keys(tasks):
+            pipe.hincrby(self.PINS_KEY, cache_key, 1)
+    
+    async def unpin(self, tasks: List[Dict[str, Any]]):
+        """Release the pins of scene tasks that finished or were dropped."""
+        cache_keys = self._pinned_keys(tasks)
+        if cache_keys:
+            await self.unpin_script(keys=[self.PINS_KEY], args=cache_keys)
+    
+    async def lookup(self, cache_keys: List[str]) -> Dict[str, bool]:
+        """
+        Check which references are already cached and mark hits as recently used.
+        
+        Args:
+            cache_keys: Content addresses to check
+        
+        Returns:
+            Mapping of cache key -> whether a reference is available
+        """
+        if not cache_keys:
+            return {}
+        
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for cache_key in cache_keys:
+                pipe.zscore(self.LRU_KEY, cache_key)
+            scores = await pipe.execute()
+        
+        hits = {
+            cache_key: score is not None and os.path.exists(self.reference_path(cache_key))
+            for cache_key, score in zip(cache_keys, scores)
+        }
+        touched = {cache_key: time.time() for cache_key, hit in hits.items() if hit}
+        if touched:
+            await self.redis_client.zadd(self.LRU_KEY, touched, xx=True)
+        return hits
+    
+    async def register_results(self, tasks: List[Dict[str, Any]]) -> int:
+        """
+        Index reference images written by completed character tasks.
+        
+        Args:
+            tasks: Completed tasks; only character tasks with a cache_key are indexed
+        
+        Returns:
+            Number of references added to the index
+        """
+        entries = {}
+        for task in tasks:
+            cache_key = task.get("cache_key")
+            if task.get("task_type") != "character" or not cache_key:
+                continue
+            path = self.reference_path(cache_key)
+            if os.path.exists(path):
+                entries[cache_key] = os.path.getsize(path)
+        
+        if not entries:
+            return 0
+        
+        args = [time.time()]
+        for cache_key, size in entries.items():
+            args.extend([cache_key, size])
+        total = await self.register_script(keys=[self.LRU_KEY, self.SIZES_KEY, self.TOTAL_KEY], args=args)
+        
+        if total > settings.CHARACTER_CACHE_MAX_BYTES:
+            await self._evict()
+        return len(entries)
+    
+    async def _evict(self):
+        """Remove least recently used unpinned references until the cache fits its size bound."""
+        evicted = await self.evict_script(
+            keys=[self.LRU_KEY, self.SIZES_KEY, self.TOTAL_KEY, self.PINS_KEY],
+            args=[settings.CHARACTER_CACHE_MAX_BYTES]
+        )
+        for cache_key in evicted:
+            try:
+                os.remove(self.reference_path(cache_key))
+            except FileNotFoundError:
+                pass
+        if evicted:
+            logger.info(f"Evicted {len(evicted)} character references")
@@ -1,18 +1,66 @@
-import json
+import asyncio
+import codecs
 import logging
+import re
 import uuid
-from typing import Dict, List, Any
+from typing import AsyncIterator, Dict, List, Any, Optional
 from datetime import datetime
 
 from config import settings
 from batching.batching_service import BatchingService
+from ingestion.character_cache import CharacterReferenceCache
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Client-chosen story IDs become part of Redis keys and file paths
+STORY_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,128}")
+
+def check_story_id(story_id: str):
+    """Reject story IDs that are not safe to use in keys and paths."""
+    if not STORY_ID_PATTERN.fullmatch(story_id):
+        raise ValueError(f"Invalid story_id {story_id!r}: use 1-128 letters, digits, '-' or '_'")
+
+# A blank line (possibly holding whitespace or "\r") ends a paragraph
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+
+async def iter_paragraphs(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """
+    Yield the non-empty paragraphs of a text as its chunks arrive.
+    
+    Paragraphs are separated by blank lines, as in TaskSplitter._extract_scenes.
+    Only the paragraph in progress is buffered; one longer than
+    STORY_STREAM_MAX_PARAGRAPH characters is cut at its last whitespace.
+    
+    Args:
+        chunks: UTF-8 encoded text, split anywhere (even inside a character)
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    buffer = ""
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        while True:
+            match = PARAGRAPH_BREAK.search(buffer)
+            if match:
+                paragraph, buffer = buffer[:match.start()], buffer[match.end():]
+            else:
+                if len(buffer) <= settings.STORY_STREAM_MAX_PARAGRAPH:
+                    break
+                limit = settings.STORY_STREAM_MAX_PARAGRAPH
+                end = max(buffer.rfind(" ", 0, limit), buffer.rfind("\n", 0, limit))
+                if end <= 0:
+                    end = limit
+                paragraph, buffer = buffer[:end], buffer[end:]
+            if paragraph.strip():
+                yield paragraph.strip()
+    buffer += decoder.decode(b"", final=True)
+    if buffer.strip():
+        yield buffer.strip()
+
 class TaskSplitter:
-    def __init__(self, batching_service: BatchingService):
+    def __init__(self, batching_service: BatchingService, character_cache: Optional[CharacterReferenceCache] = None):
         self.batching_service = batching_service
+        self.character_cache = character_cache or CharacterReferenceCache(batching_service.redis_client)
     
     async def process_story(self, story_data: Dict[str, Any]) -> Dict[str, Any]:
         """
@@ -29,60 +77,188 @@ class TaskSplitter:
         Returns:
             Dict containing the story_id and list of created task IDs
         """
-        story_id = story_data.get("story_id", str(uuid.uuid4()))
-        user_id = story_data["user_id"]
+        story_id = story_data.get("story_id") or str(uuid.uuid4())
+        check_story_id(story_id)
+        
+        # Extract scenes from the story
+        scenes = self._extract_scenes(story_data["content"])
+        
+        characters: Dict[str, Dict[str, Any]] = {}
+        character_task_ids: Dict[str, str] = {}
+        tasks = await self._build_story_tasks(story_data, story_id, scenes, 0, characters, character_task_ids)
+        
+        # Enqueue the whole story atomically in a single round-trip
+        await self.batching_service.add_tasks(tasks)
+        task_ids = [task["task_id"] for task in tasks]
+        logger.info(
+            f"Queued {len(task_ids)} tasks for story {story_id} "
+            f"({len(scenes)} scenes, {len(characters)} characters, {len(characters) - len(character_task_ids)} cached)"
+        )
+        
+        return {
+            "story_id": story_id,
+            "task_ids": task_ids
+        }
+    
+    async def process_story_stream(self, story_data: Dict[str, Any], chunks: AsyncIterator[bytes]) -> Dict[str, Any]:
+        """
+        Process a story whose text arrives in chunks, without holding all of it.
+        
+        Scenes are extracted as their paragraphs complete and their tasks are
+        enqueued every STORY_STREAM_ENQUEUE_SCENES scenes, so the first scenes
+        reach the batching queues while the rest is still being received. The
+        next group's enqueue overlaps reading the text that follows it. Each
+        group is enqueued atomically; later groups may depend on character
+        tasks from earlier ones.
+        
+        Args:
+            story_data: Same fields as process_story, without content
+            chunks: The story text, UTF-8 encoded, in arbitrary chunks
+        
+        Returns:
+            Dict containing the story_id and the number of scenes and tasks created
+        """
+        story_id = story_data.get("story_id") or str(uuid.uuid4())
+        check_story_id(story_id)
+        characters: Dict[str, Dict[str, Any]] = {}
+        character_task_ids: Dict[str, str] = {}
+        scenes: List[Dict[str, Any]] = []
+        scene_count = 0
+        task_count = 0
+        enqueueing: Optional[asyncio.Task] = None
+        
+        try:
+            async for paragraph in iter_paragraphs(chunks):
+                # The last group is held back so the final enqueue is never empty
+                if len(scenes) >= settings.STORY_STREAM_ENQUEUE_SCENES:
+                    tasks = await self._build_story_tasks(
+                        story_data, story_id, scenes, scene_count - len(scenes), characters, character_task_ids
+                    )
+                    task_count += len(tasks)
+                    if enqueueing is not None:
+                        await enqueueing
+                    enqueueing = asyncio.create_task(self.batching_service.add_tasks(tasks, final=False))
+                    scenes = []
+                scenes.append(self._scene_from_paragraph(paragraph))
+                scene_count += 1
+            
+            tasks = await self._build_story_tasks(
+                story_data, story_id, scenes, scene_count - len(scenes), characters, character_task_ids
+            )
+            task_count += len(tasks)
+            if enqueueing is not None:
+                await enqueueing
+            await self.batching_service.add_tasks(tasks)
+        except Exception:
+            logger.error(f"Streamed story {story_id} was cut off after {scene_count} scenes")
+            if enqueueing is not None:
+                await asyncio.gather(enqueueing, return_exceptions=True)
+                # Groups already enqueued belong to a story that will never be sealed
+                await self.batching_service.cancel_story(story_id)
+            raise
+        logger.info(
+            f"Queued {task_count} tasks for streamed story {story_id} "
+            f"({scene_count} scenes, {len(characters)} characters)"
+        )
+        
+        return {
+            "story_id": story_id,
+            "scene_count": scene_count,
+            "task_count": task_count
+        }
+    
+    async def _build_story_tasks(
+        self,
+        story_data: Dict[str, Any],
+        story_id: str,
+        scenes: List[Dict[str, Any]],
+        first_scene_idx: int,
+        characters: Dict[str, Dict[str, Any]],
+        character_task_ids: Dict[str, str]
+    ) -> List[Dict[str, Any]]:
+        """
+        Build the tasks for consecutive scenes of a story.
+        
+        Args:
+            story_data: Story fields (user_id, priority, callback_url)
+            story_id: ID of the story
+            scenes: Scenes as returned by _scene_from_paragraph
+            first_scene_idx: Index of the first of these scenes in the story
+            characters: Characters seen so far in the story, updated in place
+            character_task_ids: Character task IDs created so far, updated in place
+        
+        Returns:
+            Task records, not yet queued
+        """
         priority = story_data["priority"]
-        content = story_data["content"]
+        user_id = story_data["user_id"]
         callback_url = story_data["callback_url"]
         
-        # Extract scenes from the story
-        scenes = self._extract_scenes(content)
+        # One character task per distinct character in the story, skipped
+        # entirely when its reference is already cached on the shared volume
+        new_characters: Dict[str, Dict[str, Any]] = {}
+        for scene_idx, scene in enumerate(scenes, start=first_scene_idx):
+            for character_prompt in scene["character_prompts"]:
+                cache_key = self.character_cache.cache_key(story_id, character_prompt)
+                if cache_key not in characters:
+                    new_characters.setdefault(cache_key, {"prompt": character_prompt, "scene_idx": scene_idx})
+        cached = await self.character_cache.lookup(list(new_characters)) if new_characters else {}
+        characters.update(new_characters)
         
-        # Create tasks for each scene
-        task_ids = []
-        for scene_idx, scene in enumerate(scenes):
-            # Create character generation task
-            char_task = await self._create_task(
+        # Build every task in memory first; scenes wait for the references of
+        # all their characters and clips for the scene image they animate
+        tasks = []
+        for cache_key, character in new_characters.items():
+            if cached.get(cache_key):
+                continue
+            task = self._build_task(
                 task_type="character",
                 priority=priority,
                 user_id=user_id,
                 story_id=story_id,
-                scene_idx=scene_idx,
-                prompt=scene["character_prompt"],
-                callback_url=callback_url
+                scene_idx=character["scene_idx"],
+                prompt=character["prompt"],
+                callback_url=callback_url,
+                extra={
+                    "cache_key": cache_key,
+                    "output_path": self.character_cache.reference_path(cache_key)
+                }
             )
-            task_ids.append(char_task["task_id"])
-            
-            # Create scene generation task
-            scene_task = await self._create_task(
+            tasks.append(task)
+            character_task_ids[cache_key] = task["task_id"]
+        
+        for scene_idx, scene in enumerate(scenes, start=first_scene_idx):
+            cache_keys = [
+                self.character_cache.cache_key(story_id, character_prompt)
+                for character_prompt in scene["character_prompts"]
+            ]
+            depends_on = [character_task_ids[key] for key in dict.fromkeys(cache_keys) if key in character_task_ids]
+            scene_task = self._build_task(
                 task_type="scene",
                 priority=priority,
                 user_id=user_id,
                 story_id=story_id,
                 scene_idx=scene_idx,
                 prompt=scene["scene_prompt"],
-                callback_url=callback_url
+                callback_url=callback_url,
+                depends_on=depends_on,
+                # The primary character's reference conditions the scene image
+                extra={"reference_image": self.character_cache.reference_path(cache_keys[0])}
             )
-            task_ids.append(scene_task["task_id"])
-            
-            # Create clip generation task
-            clip_task = await self._create_task(
+            clip_task = self._build_task(
                 task_type="clip",
                 priority=priority,
                 user_id=user_id,
                 story_id=story_id,
                 scene_idx=scene_idx,
                 prompt=scene["animation_prompt"],
-                callback_url=callback_url
+                callback_url=callback_url,
+                depends_on=[scene_task["task_id"]]
             )
-            task_ids.append(clip_task["task_id"])
-        
-        return {
-            "story_id": story_id,
-            "task_ids": task_ids
-        }
+            tasks.extend([scene_task, clip_task])
+        return tasks
     
-    def _extract_scenes(self, content: str) -> List[Dict[str, str]]:
+    def _extract_scenes(self, content: str) -> List[Dict[str, Any]]:
         """
         Extract scenes from story content.
         This is a placeholder implementation - in reality, you'd want to use
@@ -90,19 +266,31 @@ class TaskSplitter:
         """
         # Simple split by paragraphs for demonstration
         paragraphs = content.split("\n\n")
-        scenes = []
-        
-        for paragraph in paragraphs:
-            if paragraph.strip():
-                scenes.append({
-                    "character_prompt": f"Generate character for: {paragraph[:100]}...",
-                    "scene_prompt": f"Generate scene for: {paragraph[:100]}...",
-                    "animation_prompt": f"Animate scene: {paragraph[:100]}..."
-                })
-        
-        return scenes
+        return [self._scene_from_paragraph(paragraph) for paragraph in paragraphs if paragraph.strip()]
     
-    async def _create_task(
+    def _scene_from_paragraph(self, paragraph: str) -> Dict[str, Any]:
+        """Build the prompts of the scene described by one paragraph."""
+        return {
+            "character_prompts": [
+                f"Character reference of {name}" for name in self._extract_characters(paragraph)
+            ],
+            "scene_prompt": f"Generate scene for: {paragraph[:100]}...",
+            "animation_prompt": f"Animate scene: {paragraph[:100]}..."
+        }
+    
+    def _extract_characters(self, paragraph: str) -> List[str]:
+        """
+        Extract character names from a paragraph.
+        Placeholder heuristic: capitalized words that do not start a sentence,
+        falling back to the story's protagonist when none are found.
+        """
+        names = []
+        for match in re.finditer(r"(?<![.!?\"]\s)(?<![\"'])(?<!^)\b([A-Z][a-z]+)\b", paragraph.strip()):
+            if match.group(1) not in names:
+                names.append(match.group(1))
+        return names or ["the protagonist"]
+    
+    def _build_task(
         self,
         task_type: str,
         priority: str,
@@ -110,9 +298,11 @@ class TaskSplitter:
         story_id: str,
         scene_idx: int,
         prompt: str,
-        callback_url: str
+        callback_url: str,
+        depends_on: Optional[List[str]] = None,
+        extra: Optional[Dict[str, Any]] = None
     ) -> Dict[str, Any]:
-        """Create and queue a new task."""
+        """Build a task record without queueing it."""
         task_data = {
             "task_id": str(uuid.uuid4()),
             "user_id": user_id,
@@ -122,10 +312,10 @@ class TaskSplitter:
             "scene_idx": scene_idx,
             "prompt": prompt,
             "callback_url": callback_url,
+            "depends_on": depends_on or [],
             "timestamp": datetime.utcnow().timestamp()
         }
-        
-        await self.batching_service.add_task(task_type, priority, task_data)
+        task_data.update(extra or {})
         return task_data
 
 async def process_story(story_data: Dict[str, Any]) -> Dict[str, Any]:
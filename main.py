@@ -1,66 +1,315 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from typing import List, Optional, Dict
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError
+from typing import List, Optional, Dict, Tuple
 import uvicorn
 import asyncio
+import json
+import math
+import os
 from datetime import datetime
 
-from ingestion.task_splitter import process_story
+from ingestion.task_splitter import process_story, TaskSplitter, STORY_ID_PATTERN
 from batching.batching_service import BatchingService
-from gpu_workers.worker_interface import GPUWorkerInterface
-from queue.task_queue import StoryQueue
+from batching.admission import AdmissionController
+from gpu_workers.worker_interface import get_gpu_worker
+from gpu_workers.callback_dispatcher import get_callback_dispatcher
+from gpu_workers.artifact_store import get_artifact_store
+from composer.video_composer import get_video_composer
+from queues.task_queue import StoryQueue
 from workers.worker_pool import WorkerPool
+from workers.process_pool import ProcessWorkerPool
+from workers.autoscaler import WorkerAutoscaler
+from config import settings
+from redis_pool import close_redis
+import metrics
 
 app = FastAPI(title="StoreeBackend", description="Scalable Video Generation Queue System")
 
 # Initialize services
 story_queue = StoryQueue()
-worker_pool = WorkerPool(num_workers=5)  # Start with 5 workers
+gpu_worker = get_gpu_worker()
+batching_service = BatchingService(gpu_worker=gpu_worker)
+task_splitter = TaskSplitter(batching_service)
+if settings.WORKER_PROCESSES > 0:
+    # Story planning runs in separate processes, away from request handling
+    worker_pool = ProcessWorkerPool(
+        num_processes=settings.WORKER_PROCESSES,
+        workers_per_process=settings.WORKERS_PER_PROCESS
+    )
+else:
+    worker_pool = WorkerPool(num_workers=5, story_queue=story_queue, task_splitter=task_splitter)  # Start with 5 workers
+autoscaler = WorkerAutoscaler(worker_pool, story_queue)
+admission = AdmissionController(batching_service.queue_backend, story_queue, batching_service.throughput)
+callback_dispatcher = get_callback_dispatcher()
+artifact_store = get_artifact_store()
+video_composer = get_video_composer()
 
 class StorySubmission(BaseModel):
     user_id: str
     priority: str
-    story_id: Optional[str] = None
+    story_id: Optional[str] = Field(None, pattern=f"^{STORY_ID_PATTERN.pattern}$")
     content: str
     callback_url: str
 
+class BulkStorySubmission(BaseModel):
+    stories: List[StorySubmission]
+
 class HealthResponse(BaseModel):
     status: str
     timestamp: float
     gpu_service_healthy: bool
+    gpu_circuit_state: str
+    gpu_last_checked: Optional[float] = None
     active_workers: int
     queue_lengths: Dict[str, int]
 
 @app.post("/submit_story")
-async def submit_story(story: StorySubmission):
-    """Submit a new story for processing."""
+async def submit_story(
+    request: Request,
+    user_id: Optional[str] = None,
+    priority: str = "free",
+    callback_url: Optional[str] = None,
+    story_id: Optional[str] = None
+):
+    """
+    Submit a new story for processing.
+    
+    A JSON body (StorySubmission) queues the story for the story workers.
+    Any other body is taken as the raw story text, typically uploaded with
+    chunked transfer encoding, and is split into tasks as it streams in;
+    user_id, priority, callback_url and story_id then come from the query.
+    
+    Stories the system can't take on in time are rejected with 429 and a
+    Retry-After header (see AdmissionController).
+    """
+    if request.headers.get("content-type", "").startswith("application/json"):
+        try:
+            story = StorySubmission.model_validate(await request.json())
+        except ValidationError as e:
+            raise RequestValidationError(e.errors())
+        story.priority = (await _admit([(story.user_id, story.priority)]))[0]
+        return await _queue_story(story)
+    
+    if not user_id or not callback_url:
+        raise HTTPException(status_code=400, detail="user_id and callback_url are required for streamed stories")
+    if story_id is not None and not STORY_ID_PATTERN.fullmatch(story_id):
+        raise HTTPException(status_code=400, detail="story_id may only hold 1-128 letters, digits, '-' or '_'")
+    # Decided before the body is read, so rejected uploads cost nothing
+    priority = (await _admit([(user_id, priority)]))[0]
+    try:
+        result = await task_splitter.process_story_stream(
+            {"user_id": user_id, "priority": priority, "callback_url": callback_url, "story_id": story_id},
+            request.stream()
+        )
+        return {**result, "status": "queued", "priority": priority}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def _admit(stories: List[Tuple[str, str]]) -> List[str]:
+    """Apply admission control to (user_id, priority) pairs; returns the priority each story is queued at."""
+    decision = await admission.admit(stories)
+    if not decision["admitted"]:
+        headers = {"Retry-After": str(max(1, math.ceil(decision["retry_after"])))} if decision["retry_after"] is not None else None
+        raise HTTPException(status_code=429, detail=decision["reason"], headers=headers)
+    return decision["priorities"]
+
+async def _queue_story(story: StorySubmission):
+    """Queue a story submitted as JSON for the story workers."""
     try:
         # Add story to queue
         request_id = await story_queue.enqueue_story(
             user_id=story.user_id,
             prompt=story.content,
-            priority=story.priority
+            priority=story.priority,
+            callback_url=story.callback_url
         )
-        return {"request_id": request_id, "status": "queued"}
+        return {"request_id": request_id, "status": "queued", "priority": story.priority}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/submit_stories")
+async def submit_stories(submission: BulkStorySubmission):
+    """Submit many stories at once in a single pipelined Redis round-trip."""
+    if len(submission.stories) > settings.MAX_BULK_STORIES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {settings.MAX_BULK_STORIES} stories can be submitted per request"
+        )
+    priorities = await _admit([(story.user_id, story.priority) for story in submission.stories])
+    try:
+        request_ids = await story_queue.enqueue_stories([
+            {"user_id": story.user_id, "prompt": story.content, "priority": priority, "callback_url": story.callback_url}
+            for story, priority in zip(submission.stories, priorities)
+        ])
+        return {"request_ids": request_ids, "status": "queued", "count": len(request_ids), "priorities": priorities}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/health")
 async def health_check():
     """Check the health of the service and its dependencies."""
-    gpu_worker = GPUWorkerInterface()
-    try:
-        gpu_healthy = await gpu_worker.check_health()
-        queue_lengths = await story_queue.get_queue_lengths()
-        return HealthResponse(
-            status="healthy",
-            timestamp=datetime.utcnow().timestamp(),
-            gpu_service_healthy=gpu_healthy,
-            active_workers=worker_pool.get_active_workers(),
-            queue_lengths=queue_lengths
-        )
-    finally:
-        await gpu_worker.close()
+    # GPU health comes from the background prober, so this never waits on the GPU service
+    queue_lengths = await story_queue.get_queue_lengths()
+    return HealthResponse(
+        status="healthy",
+        timestamp=datetime.utcnow().timestamp(),
+        gpu_service_healthy=gpu_worker.healthy,
+        gpu_circuit_state=gpu_worker.circuit_breaker.state,
+        gpu_last_checked=gpu_worker.last_health_check,
+        active_workers=worker_pool.get_active_workers(),
+        queue_lengths=queue_lengths
+    )
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    """Latency histograms, batch efficiency and queue and worker gauges in the Prometheus text format."""
+    queue_names = {
+        queue_name: (task_type, priority)
+        for task_type, queues in settings.QUEUE_NAMES.items() for priority, queue_name in queues.items()
+    }
+    depths, _ = await batching_service.queue_backend.inspect(list(queue_names))
+    for queue_name, depth in depths.items():
+        metrics.QUEUE_DEPTH.labels(*queue_names[queue_name]).set(depth)
+    for priority, depth in (await story_queue.get_queue_lengths()).items():
+        metrics.QUEUE_DEPTH.labels("story", priority).set(depth)
+    
+    total = worker_pool.get_active_workers()
+    busy = worker_pool.get_busy_workers()
+    metrics.WORKERS.labels("total").set(total)
+    if busy is not None:
+        metrics.WORKERS.labels("busy").set(busy)
+        metrics.WORKER_UTILIZATION.set(busy / total if total else 0.0)
+    metrics.GPU_CIRCUIT_OPEN.set(1 if gpu_worker.circuit_breaker.state == gpu_worker.circuit_breaker.OPEN else 0)
+    
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/scheduler/stats")
+async def scheduler_stats():
+    """Get target vs. achieved share and queue wait per priority."""
+    return {
+        "tasks": batching_service.get_scheduler_stats(),
+        "stories": story_queue.scheduler.get_stats()
+    }
+
+@app.get("/batching/adaptive")
+async def adaptive_batching_state():
+    """Get current batch size and linger with the latency targets and observations behind them."""
+    return batching_service.adaptive.get_state()
+
+@app.get("/batching/affinity")
+async def affinity_packing_stats():
+    """Reference and story hit rates of affinity packing next to plain FIFO packing, with held-back tasks."""
+    if batching_service.packer is None:
+        return {"enabled": False}
+    return {"enabled": True, "task_types": batching_service.packer.get_stats()}
+
+@app.get("/admission")
+async def admission_state():
+    """Backlog, GPU throughput and estimated wait per priority behind admission decisions."""
+    return await admission.get_state()
+
+@app.get("/cache/results")
+async def result_cache_stats():
+    """Hit, miss and single-flight merge counts of the GPU result cache."""
+    if batching_service.result_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **await batching_service.result_cache.get_stats()}
+
+@app.get("/gpu/instances")
+async def gpu_instances():
+    """Get connection state and live queue depth of each ComfyUI instance."""
+    return gpu_worker.comfyui.get_instances() if gpu_worker.comfyui is not None else []
+
+@app.get("/artifacts/{artifact_id}")
+async def get_artifact(artifact_id: str):
+    """Stream a generated artifact by its content address ("sha256:<digest>")."""
+    path = artifact_store.path_for(artifact_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Artifact not found")
+    return FileResponse(path)
+
+@app.get("/stories/{story_id}")
+async def get_story(story_id: str):
+    """Task counts of a story by type and state."""
+    progress = await batching_service.progress.get(story_id)
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Story not found")
+    return progress
+
+@app.delete("/stories/{story_id}")
+async def cancel_story(story_id: str):
+    """
+    Cancel a story.
+    
+    Its queued tasks never reach the GPU: they are dropped when a batch picks
+    them up, tasks still waiting on dependencies are discarded and ComfyUI
+    prompts running only its tasks are interrupted. Only stories whose tasks
+    have been enqueued are known: stories queued with /submit_story or /submit_stories are
+    tracked under their request_id once a worker has split them. A finished
+    story can't be cancelled.
+    """
+    progress = await batching_service.progress.get(story_id)
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Story not found")
+    if progress["status"] == "done":
+        raise HTTPException(status_code=409, detail="Story already finished")
+    if progress["status"] == "cancelled":
+        return {"story_id": story_id, "status": "cancelled", "tasks_cancelled": 0}
+    
+    tasks_cancelled = await batching_service.cancel_story(story_id)
+    return {"story_id": story_id, "status": "cancelled", "tasks_cancelled": tasks_cancelled}
+
+@app.get("/stories/{story_id}/events")
+async def story_events(story_id: str):
+    """
+    Stream a story's progress as server-sent events.
+    
+    Sends a "progress" event with the same body as GET /stories/{story_id}
+    now and after every change, and a final "done" event once every task of
+    the story has finished (or "cancelled" once it is cancelled). Watchers share the process's single Redis
+    subscription, so an open stream costs no polling.
+    """
+    if await batching_service.progress.get(story_id) is None:
+        raise HTTPException(status_code=404, detail="Story not found")
+    
+    async def events():
+        async for progress in batching_service.progress.watch(story_id, settings.STORY_EVENTS_HEARTBEAT):
+            if progress is None:
+                yield ": keepalive\n\n"
+                continue
+            event = progress["status"] if progress["status"] in batching_service.progress.FINAL else "progress"
+            yield f"event: {event}\nid: {progress['version']}\ndata: {json.dumps(progress)}\n\n"
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/stories/{story_id}/video")
+async def get_story_video(story_id: str):
+    """Composition progress of a story's video; the playlist is playable once a segment is published."""
+    return await video_composer.get_status(story_id)
+
+@app.get("/stories/{story_id}/video/{filename}")
+async def get_story_video_file(story_id: str, filename: str):
+    """Serve a story's HLS playlist or one of its segments."""
+    if os.path.basename(story_id) != story_id or os.path.basename(filename) != filename:
+        raise HTTPException(status_code=404, detail="Video file not found")
+    if not (filename == "index.m3u8" or filename.endswith(".ts")):
+        raise HTTPException(status_code=404, detail="Video file not found")
+    path = os.path.join(video_composer.story_dir(story_id), filename)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Video file not found")
+    media_type = "application/vnd.apple.mpegurl" if filename.endswith(".m3u8") else "video/mp2t"
+    return FileResponse(path, media_type=media_type, headers={"Cache-Control": "no-cache"})
+
+@app.get("/autoscaler")
+async def autoscaler_status():
+    """Get the current pool size and the autoscaler's recent decisions."""
+    return autoscaler.get_status()
 
 @app.post("/scale_workers/{new_count}")
 async def scale_workers(new_count: int):
@@ -72,15 +321,26 @@ async def scale_workers(new_count: int):
 
 @app.on_event("startup")
 async def startup_event():
-    """Start the batching service and worker pool on application startup."""
-    batching_service = BatchingService()
+    """Start the batching service, callback dispatcher and worker pool on application startup."""
+    await callback_dispatcher.start()
+    await artifact_store.start()
+    await gpu_worker.start()
     asyncio.create_task(batching_service.start())
     await worker_pool.start()
+    if settings.AUTOSCALE_ENABLED:
+        await autoscaler.start()
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    """Stop the worker pool on application shutdown."""
+    """Stop the worker pool, flush callbacks and release GPU and Redis connections on application shutdown."""
+    await autoscaler.stop()
     await worker_pool.stop()
+    await video_composer.stop()
+    await batching_service.progress.stop()
+    await callback_dispatcher.stop()
+    await artifact_store.stop()
+    await gpu_worker.close()
+    await close_redis()
 
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True) 
\ No newline at end of file
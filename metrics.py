@@ -0,0 +1,247 @@
+import bisect
+import math
+from typing import List, Dict, Optional, Sequence, Tuple
+
+# Metrics are kept per process in plain counters and rendered in the
+# Prometheus text exposition format by GET /metrics. Updating a metric is a
+# dict lookup and an addition, cheap enough for per-task use on hot paths.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+LONG_LATENCY_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+def _escape(value: str) -> str:
+    """Escape a label value for the text format."""
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    """Render a label set, e.g. {task_type="scene",le="0.5"}."""
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    """Render a sample value."""
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class _Metric:
+    """A named metric family with children per label set."""
+    
+    kind = ""
+    suffix = ""
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children: Dict[Tuple[str, ...], object] = {}
+        REGISTRY.append(self)
+        if not self.labelnames:
+            self.children[()] = self._new_child()
+    
+    def _new_child(self):
+        raise NotImplementedError
+    
+    def labels(self, *values: str):
+        """Child for a label set, in labelnames order."""
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"Metric {self.name} expects labels {self.labelnames}, got {values}")
+            child = self.children[values] = self._new_child()
+        return child
+    
+    def render(self) -> List[str]:
+        name = self.name + self.suffix
+        lines = [f"# HELP {name} {self.documentation}", f"# TYPE {name} {self.kind}"]
+        for values, child in self.children.items():
+            lines.extend(self._render_child(values, child))
+        return lines
+
+class _Value:
+    """A single counter or gauge sample."""
+    
+    __slots__ = ("value",)
+    
+    def __init__(self):
+        self.value = 0.0
+    
+    def inc(self, amount: float = 1):
+        self.value += amount
+    
+    def set(self, value: float):
+        self.value = value
+
+class _SharedValue:
+    """A counter or gauge sample kept in a multiprocessing.Value, updated by several processes."""
+    
+    __slots__ = ("shared",)
+    
+    def __init__(self, shared):
+        self.shared = shared
+    
+    @property
+    def value(self) -> float:
+        return self.shared.value
+    
+    def inc(self, amount: float = 1):
+        with self.shared.get_lock():
+            self.shared.value += amount
+    
+    def set(self, value: float):
+        self.shared.value = value
+
+def share(metric: "_Metric", shared):
+    """
+    Keep an unlabelled counter or gauge in shared memory.
+    
+    A parent process calls this with a multiprocessing.Value("d") it hands to
+    its children, which call it with the same Value; their updates then show
+    up in the parent's /metrics.
+    """
+    child = metric.children[()]
+    if isinstance(child, _Value):
+        with shared.get_lock():
+            shared.value += child.value
+    metric.children[()] = _SharedValue(shared)
+
+class Counter(_Metric):
+    """Monotonically increasing total."""
+    
+    kind = "counter"
+    suffix = "_total"
+    
+    def _new_child(self) -> _Value:
+        return _Value()
+    
+    def inc(self, amount: float = 1):
+        self.children[()].inc(amount)
+    
+    def _render_child(self, values: Tuple[str, ...], child: _Value) -> List[str]:
+        return [f"{self.name}_total{_format_labels(self.labelnames, values)} {_format_value(child.value)}"]
+
+class Gauge(_Metric):
+    """Value that can go up and down, usually set when scraped."""
+    
+    kind = "gauge"
+    
+    def _new_child(self) -> _Value:
+        return _Value()
+    
+    def inc(self, amount: float = 1):
+        self.children[()].inc(amount)
+    
+    def set(self, value: float):
+        self.children[()].set(value)
+    
+    def _render_child(self, values: Tuple[str, ...], child: _Value) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"]
+
+class _Buckets:
+    """Observations of one histogram child."""
+    
+    __slots__ = ("bounds", "counts", "sum", "count")
+    
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets."""
+    
+    kind = "histogram"
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+    
+    def _new_child(self) -> _Buckets:
+        return _Buckets(self.buckets)
+    
+    def observe(self, value: float):
+        self.children[()].observe(value)
+    
+    def _render_child(self, values: Tuple[str, ...], child: _Buckets) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), child.counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, values, ("le", _format_value(bound)))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+        lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+REGISTRY: List[_Metric] = []
+
+def render() -> str:
+    """All metrics of this process in the Prometheus text format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# Batching
+QUEUE_WAIT = Histogram(
+    "storee_queue_wait_seconds", "Time tasks spent queued before joining a batch",
+    ["task_type", "priority"], LONG_LATENCY_BUCKETS
+)
+BATCH_FORMATION = Histogram(
+    "storee_batch_formation_seconds", "Time from a batch's first task to its flush", ["task_type"]
+)
+BATCH_FILL_RATIO = Histogram(
+    "storee_batch_fill_ratio", "Batch size relative to the target size at flush", ["task_type"], RATIO_BUCKETS
+)
+BATCH_FLUSHES = Counter(
+    "storee_batch_flushes", "Batches flushed, by whether they were full or the linger window ran out",
+    ["task_type", "reason"]
+)
+BATCH_TASKS = Counter(
+    "storee_batch_tasks", "Tasks processed, by whether they ran on the GPU, were cached or merged, were dropped as cancelled or failed with expired metadata",
+    ["task_type", "source"]
+)
+BATCH_AFFINITY_HITS = Counter(
+    "storee_batch_affinity_hits",
+    "Tasks batched with an earlier task sharing their reference image or story, as packed and as FIFO would have",
+    ["task_type", "key", "packing"]
+)
+QUEUE_DEPTH = Gauge("storee_queue_depth", "Tasks waiting per queue", ["task_type", "priority"])
+
+# GPU
+GPU_BATCH_LATENCY = Histogram(
+    "storee_gpu_batch_seconds", "GPU batch request latency", ["task_type"], LATENCY_BUCKETS
+)
+GPU_BATCHES_IN_FLIGHT = Gauge("storee_gpu_batches_in_flight", "GPU batch requests currently running")
+GPU_CIRCUIT_OPEN = Gauge("storee_gpu_circuit_open", "1 while the GPU circuit breaker rejects requests")
+
+# Callbacks
+CALLBACK_LATENCY = Histogram(
+    "storee_callback_latency_seconds", "Time from a result to its callback being delivered", buckets=LATENCY_BUCKETS
+)
+CALLBACK_FAILURES = Counter("storee_callback_failures", "Callback deliveries that failed and were rescheduled")
+
+# Stories and workers
+ADMISSIONS = Counter(
+    "storee_admissions", "Submitted stories by admission decision (admitted, deferred, overloaded, rate_limited)",
+    ["priority", "outcome"]
+)
+STORY_END_TO_END = Histogram(
+    "storee_story_end_to_end_seconds", "Time from a story's first tasks being queued to all of its tasks being finished",
+    buckets=LONG_LATENCY_BUCKETS
+)
+WORKER_BUSY_SECONDS = Counter(
+    "storee_worker_busy_seconds", "Time story workers spent processing stories, including those in worker processes"
+)
+WORKERS = Gauge("storee_workers", "Story workers, by state", ["state"])
+WORKER_UTILIZATION = Gauge("storee_worker_utilization", "Share of story workers currently processing a story")
@@ -0,0 +1,85 @@
+import redis.asyncio as redis
+import json
+import uuid
+from typing import Optional, Dict, Any, List
+from datetime import datetime
+
+from config import settings
+from redis_pool import get_redis_client
+from batching.scheduler import WeightedFairScheduler
+from batching.queue_backend import ListQueueBackend
+
+class StoryQueue:
+    def __init__(self, redis_client: Optional[redis.Redis] = None):
+        self.redis = redis_client or get_redis_client()
+        self.paid_queue = "story_queue:paid"
+        self.free_queue = "story_queue:free"
+        # Paid stories are served at the premium weight, never to the exclusion of free ones
+        self.scheduler = WeightedFairScheduler(
+            ListQueueBackend(self.redis),
+            queues={"paid": self.paid_queue, "free": self.free_queue},
+            weights={"paid": settings.PRIORITY_RATIO["premium"], "free": settings.PRIORITY_RATIO["free"]},
+            max_wait=settings.SCHEDULER_MAX_WAIT
+        )
+        
+    def _build_request(self, user_id: str, prompt: str, priority: str, callback_url: Optional[str] = None) -> Dict[str, Any]:
+        """Build a story request record."""
+        return {
+            "user_id": user_id,
+            "prompt": prompt,
+            "priority": priority,
+            "callback_url": callback_url,
+            "request_id": str(uuid.uuid4()),
+            "timestamp": datetime.utcnow().timestamp()
+        }
+    
+    def _queue_key(self, priority: str) -> str:
+        """Get the queue key for a priority level."""
+        return self.paid_queue if priority in ("paid", "premium") else self.free_queue
+        
+    async def enqueue_story(self, user_id: str, prompt: str, priority: str = "free", callback_url: Optional[str] = None) -> str:
+        """Add a new story request to the queue."""
+        story_request = self._build_request(user_id, prompt, priority, callback_url)
+        await self.redis.lpush(self._queue_key(priority), json.dumps(story_request))
+        return story_request["request_id"]
+    
+    async def enqueue_stories(self, stories: List[Dict[str, Any]]) -> List[str]:
+        """
+        Add many story requests in a single pipelined round-trip.
+        
+        Args:
+            stories: List of dictionaries with user_id, prompt and optional priority and callback_url
+            
+        Returns:
+            Request IDs in the same order as the input stories
+        """
+        by_queue: Dict[str, List[str]] = {}
+        request_ids = []
+        for story in stories:
+            priority = story.get("priority", "free")
+            story_request = self._build_request(story["user_id"], story["prompt"], priority, story.get("callback_url"))
+            by_queue.setdefault(self._queue_key(priority), []).append(json.dumps(story_request))
+            request_ids.append(story_request["request_id"])
+        
+        if by_queue:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for queue_key, payloads in by_queue.items():
+                    pipe.lpush(queue_key, *payloads)
+                await pipe.execute()
+        return request_ids
+    
+    async def get_next_story(self) -> Optional[Dict[str, Any]]:
+        """Get the next story request, weighting paid over free users by PRIORITY_RATIO."""
+        stories = await self.scheduler.pop(1)
+        return stories[0] if stories else None
+    
+    async def get_queue_lengths(self) -> Dict[str, int]:
+        """Get the current length of both queues."""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.llen(self.paid_queue)
+            pipe.llen(self.free_queue)
+            paid, free = await pipe.execute()
+        return {
+            "paid": paid,
+            "free": free
+        }
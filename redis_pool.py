@@ -0,0 +1,47 @@
+import logging
+from typing import Optional
+import redis.asyncio as redis
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+_pool: Optional[redis.BlockingConnectionPool] = None
+_client: Optional[redis.Redis] = None
+
+def get_redis_pool() -> redis.BlockingConnectionPool:
+    """Get the process-wide Redis connection pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        _pool = redis.BlockingConnectionPool(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            password=settings.REDIS_PASSWORD or None,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT,
+            decode_responses=True
+        )
+        logger.info(f"Created Redis connection pool ({settings.REDIS_MAX_CONNECTIONS} max connections)")
+    return _pool
+
+def get_redis_client() -> redis.Redis:
+    """Get the shared async Redis client backed by the process-wide pool."""
+    global _client
+    if _client is None:
+        _client = redis.Redis(connection_pool=get_redis_pool())
+    return _client
+
+def set_redis_client(client: redis.Redis):
+    """Use the given client as the shared one, e.g. an in-process stand-in in benchmarks; call before building services."""
+    global _client
+    _client = client
+
+async def close_redis():
+    """Close the shared client and disconnect every pooled connection."""
+    global _pool, _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+    if _pool is not None:
+        await _pool.disconnect()
+        _pool = None
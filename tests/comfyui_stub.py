@@ -0,0 +1,148 @@
+import asyncio
+import json
+import uuid
+from typing import Dict, Any, List, Optional
+from aiohttp import web
+
+from config import settings
+
+class StubComfyUI:
+    """
+    In-process stand-in for a ComfyUI server, for testing the ComfyUI backend.
+    
+    Serves the parts of the ComfyUI API the backend uses: /prompt, /history,
+    /view, /interrupt, /queue, /system_stats and the /ws event socket. Every
+    SaveImage node of a submitted graph produces WORKFLOW_MAX_BATCH_SIZE
+    images. Prompts finish after delay seconds, or only when finish() is
+    called while hold is set.
+    """
+    
+    def __init__(self, delay: float = 0.01):
+        self.delay = delay
+        self.hold = False
+        # Report prompts as finished over the socket before answering /prompt
+        self.finish_before_response = False
+        # Refuse websocket connections, as a server that is down would
+        self.refuse_sockets = False
+        self.prompts: Dict[str, Dict[str, Any]] = {}
+        self.history: Dict[str, Dict[str, Any]] = {}
+        self.executing: Optional[str] = None
+        self.interrupted: List[str] = []
+        self.deleted: List[str] = []
+        self.sockets: Dict[str, web.WebSocketResponse] = {}
+        self.connected = asyncio.Event()
+        self.runner: Optional[web.AppRunner] = None
+        self.url = ""
+        
+        self.app = web.Application()
+        self.app.router.add_get("/ws", self._ws)
+        self.app.router.add_post("/prompt", self._prompt)
+        self.app.router.add_get("/history/{prompt_id}", self._history)
+        self.app.router.add_get("/view", self._view)
+        self.app.router.add_post("/interrupt", self._interrupt)
+        self.app.router.add_post("/queue", self._queue)
+        self.app.router.add_get("/system_stats", self._system_stats)
+    
+    async def start(self) -> str:
+        """Listen on a free local port and return the base URL."""
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self.url
+    
+    async def close(self):
+        """Close client sockets and stop the server."""
+        await self.drop_sockets()
+        if self.runner is not None:
+            await self.runner.cleanup()
+    
+    async def drop_sockets(self):
+        """Close every client's websocket, as a ComfyUI restart or network blip would."""
+        sockets = list(self.sockets.values())
+        self.sockets.clear()
+        self.connected.clear()
+        for ws in sockets:
+            await ws.close()
+    
+    async def send(self, event_type: str, data: Dict[str, Any]):
+        """Push an event to every connected client."""
+        for ws in list(self.sockets.values()):
+            await ws.send_str(json.dumps({"type": event_type, "data": data}))
+    
+    async def report_queue(self, queue_remaining: int):
+        """Push a status event with the given queue depth."""
+        await self.send("status", {"status": {"exec_info": {"queue_remaining": queue_remaining}}})
+    
+    async def start_executing(self, prompt_id: str):
+        """Report a prompt as executing."""
+        self.executing = prompt_id
+        await self.send("executing", {"node": "3", "prompt_id": prompt_id})
+    
+    async def finish(self, prompt_id: str):
+        """Record a prompt's outputs and report its end over the socket."""
+        graph = self.prompts[prompt_id]
+        outputs = {
+            node_id: {"images": [
+                {"filename": f"{prompt_id}_{node_id}_{index}.png", "subfolder": "", "type": "output"}
+                for index in range(settings.WORKFLOW_MAX_BATCH_SIZE)
+            ]}
+            for node_id, node in graph.items() if node["class_type"] == "SaveImage"
+        }
+        self.history[prompt_id] = {"status": {"completed": True}, "outputs": outputs}
+        if self.executing == prompt_id:
+            self.executing = None
+        await self.send("executing", {"node": None, "prompt_id": prompt_id})
+    
+    async def _run(self, prompt_id: str):
+        """Execute a prompt after the configured delay."""
+        await self.start_executing(prompt_id)
+        await asyncio.sleep(self.delay)
+        await self.finish(prompt_id)
+    
+    async def _ws(self, request: web.Request) -> web.StreamResponse:
+        if self.refuse_sockets:
+            return web.Response(status=503)
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets[request.query["clientId"]] = ws
+        self.connected.set()
+        async for _ in ws:
+            pass
+        return ws
+    
+    async def _prompt(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        prompt_id = str(uuid.uuid4())
+        self.prompts[prompt_id] = body["prompt"]
+        if self.finish_before_response:
+            await self.finish(prompt_id)
+        elif not self.hold:
+            asyncio.get_running_loop().create_task(self._run(prompt_id))
+        return web.json_response({"prompt_id": prompt_id, "number": len(self.prompts)})
+    
+    async def _history(self, request: web.Request) -> web.Response:
+        prompt_id = request.match_info["prompt_id"]
+        entry = self.history.get(prompt_id)
+        return web.json_response({prompt_id: entry} if entry else {})
+    
+    async def _view(self, request: web.Request) -> web.Response:
+        return web.Response(body=f"image {request.query['filename']}".encode(), content_type="image/png")
+    
+    async def _interrupt(self, request: web.Request) -> web.Response:
+        prompt_id = self.executing
+        if prompt_id is not None:
+            self.interrupted.append(prompt_id)
+            self.executing = None
+            await self.send("execution_interrupted", {"prompt_id": prompt_id})
+        return web.Response()
+    
+    async def _queue(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.deleted.extend(body.get("delete", []))
+        return web.Response()
+    
+    async def _system_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"system": {}, "devices": []})
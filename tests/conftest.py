@@ -0,0 +1,30 @@
+import json
+
+import fakeredis.aioredis
+import httpx
+import pytest
+
+from gpu_workers.callback_dispatcher import CallbackDispatcher
+
+@pytest.fixture
+async def redis_client():
+    """An in-process Redis stand-in with Lua scripting."""
+    client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    yield client
+    await client.aclose()
+
+@pytest.fixture
+async def dispatcher(redis_client):
+    """A dispatcher whose HTTP requests go to the test's handler."""
+    dispatcher = CallbackDispatcher(redis_client)
+    dispatcher.requests = []
+    dispatcher.status_code = 200
+    
+    def handler(request: httpx.Request) -> httpx.Response:
+        dispatcher.requests.append((str(request.url), json.loads(request.content)))
+        return httpx.Response(dispatcher.status_code)
+    
+    await dispatcher.client.aclose()
+    dispatcher.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    yield dispatcher
+    await dispatcher.stop()
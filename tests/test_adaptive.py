@@ -0,0 +1,70 @@
+import pytest
+
+from batching.adaptive import AdaptiveBatchController
+from config import settings
+
+@pytest.fixture
+def controller(monkeypatch):
+    monkeypatch.setattr(settings, "ADAPTIVE_BATCHING", True)
+    monkeypatch.setattr(settings, "BATCH_MIN_SIZE", 1)
+    monkeypatch.setattr(settings, "BATCH_MAX_SIZE", 16)
+    monkeypatch.setattr(settings, "BATCH_TIMEOUT", 5)
+    monkeypatch.setattr(settings, "ADAPTIVE_LINGER_FRACTION", 0.1)
+    monkeypatch.setattr(settings, "TARGET_P95_LATENCY", {"premium": 10.0, "free": 100.0})
+    return AdaptiveBatchController(["scene"])
+
+def observe(controller, sizes_and_latencies, priority="free", waited=0.0):
+    """Feed processed batches of the given sizes and GPU latencies."""
+    for size, latency in sizes_and_latencies:
+        batch = [{"priority": priority, "timestamp": 1000.0 - waited} for _ in range(size)]
+        controller.observe_batch("scene", batch, latency, dequeued_at=1000.0)
+
+def test_shallow_queue_takes_only_what_is_waiting(controller):
+    controller.update("scene", {"premium": 0, "free": 3})
+    assert controller.batch_size("scene") == 3
+    
+    controller.update("scene", {"premium": 0, "free": 40})
+    assert controller.batch_size("scene") == 16
+
+def test_gpu_cost_is_fitted_from_batches(controller):
+    observe(controller, [(2, 3.0), (4, 5.0), (8, 9.0)])
+    
+    state = controller.states["scene"]
+    assert state.fixed_cost == pytest.approx(1.0)
+    assert state.per_item_cost == pytest.approx(1.0)
+
+def test_size_is_capped_by_tightest_queued_target(controller):
+    observe(controller, [(2, 3.0), (4, 5.0)])
+    
+    # Premium work is waiting: a batch must finish within 10s, so at most 9 items
+    controller.update("scene", {"premium": 5, "free": 40})
+    assert controller.batch_size("scene") == 9
+    
+    controller.update("scene", {"premium": 0, "free": 40})
+    assert controller.batch_size("scene") == 16
+
+def test_overloaded_queue_gets_full_batches(controller):
+    observe(controller, [(2, 3.0), (4, 5.0)], priority="premium", waited=20.0)
+    
+    controller.update("scene", {"premium": 5, "free": 0})
+    
+    assert controller.batch_size("scene") == 16
+    assert controller.linger("scene") == 0.0
+
+def test_linger_is_a_fraction_of_the_slack(controller):
+    observe(controller, [(2, 3.0), (4, 5.0)])
+    
+    controller.update("scene", {"premium": 0, "free": 3})
+    # 100s target - 4s predicted for 3 items, 10% of it, capped at BATCH_TIMEOUT
+    assert controller.linger("scene") == 5.0
+    
+    controller.update("scene", {"premium": 2, "free": 0})
+    assert controller.linger("scene") == pytest.approx(0.7)
+
+def test_disabled_controller_uses_static_settings(controller, monkeypatch):
+    monkeypatch.setattr(settings, "ADAPTIVE_BATCHING", False)
+    monkeypatch.setattr(settings, "BATCH_SIZE", 7)
+    
+    controller.update("scene", {"premium": 0, "free": 1})
+    
+    assert (controller.batch_size("scene"), controller.linger("scene")) == (7, 5.0)
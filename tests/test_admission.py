@@ -0,0 +1,75 @@
+import time
+
+import pytest
+
+from batching.admission import AdmissionController, ThroughputMeter
+from batching.queue_backend import ListQueueBackend
+from config import settings
+from queues.task_queue import StoryQueue
+
+@pytest.fixture
+def admission(redis_client):
+    return AdmissionController(ListQueueBackend(redis_client), StoryQueue(redis_client), redis_client=redis_client)
+
+async def finished_last_bucket(redis_client, tasks: int):
+    """Record tasks as finished during the last complete throughput bucket."""
+    bucket = int(time.time() // ThroughputMeter.BUCKET_SECONDS) - 1
+    await redis_client.set(f"{ThroughputMeter.PREFIX}:{bucket}", tasks)
+
+async def test_user_is_rate_limited_after_their_burst(admission):
+    for _ in range(settings.ADMISSION_USER_BURST["free"]):
+        assert (await admission.admit([("u1", "free")]))["admitted"]
+    
+    decision = await admission.admit([("u1", "free")])
+    
+    assert (decision["admitted"], decision["reason"]) == (False, "Rate limit exceeded")
+    assert decision["retry_after"] > 0
+    assert (await admission.admit([("u2", "free")]))["admitted"]
+
+async def test_submission_larger_than_the_burst_can_never_pass(admission):
+    decision = await admission.admit([("u1", "free")] * (settings.ADMISSION_USER_BURST["free"] + 1))
+    
+    assert decision["admitted"] is False
+    assert decision["retry_after"] is None
+
+async def test_full_queue_rejects_without_charging(admission, redis_client, monkeypatch):
+    monkeypatch.setitem(settings.ADMISSION_MAX_QUEUE_DEPTH, "free", 30)
+    await admission.story_queue.enqueue_story("u0", "queued story")
+    
+    decision = await admission.admit([("u1", "free")])
+    
+    assert decision["admitted"] is False
+    assert decision["reason"].startswith("The free queue is full (25 tasks waiting)")
+    assert decision["retry_after"] == settings.ADMISSION_RETRY_AFTER
+    assert not await redis_client.exists("admission:user:free:u1")
+
+async def test_story_that_would_miss_its_target_is_rejected(admission, redis_client, monkeypatch):
+    monkeypatch.setitem(settings.TARGET_P95_LATENCY, "free", 10)
+    # One task a second over the throughput window
+    await finished_last_bucket(redis_client, settings.ADMISSION_THROUGHPUT_WINDOW)
+    
+    decision = await admission.admit([("u1", "free")])
+    
+    assert decision["admitted"] is False
+    assert decision["retry_after"] == pytest.approx(settings.ADMISSION_TASKS_PER_STORY - 10)
+
+async def test_late_premium_story_is_deferred(admission, redis_client, monkeypatch):
+    monkeypatch.setattr(settings, "ADMISSION_DEFER", True)
+    monkeypatch.setitem(settings.TARGET_P95_LATENCY, "premium", 10)
+    await finished_last_bucket(redis_client, settings.ADMISSION_THROUGHPUT_WINDOW)
+    
+    decision = await admission.admit([("u1", "premium")])
+    
+    assert decision == {"admitted": True, "priorities": ["free"]}
+
+async def test_admitted_stories_count_toward_the_next_estimate(admission, redis_client, monkeypatch):
+    monkeypatch.setattr(settings, "ADMISSION_ESTIMATE_TTL", 60)
+    monkeypatch.setitem(settings.TARGET_P95_LATENCY, "free", 2 * settings.ADMISSION_TASKS_PER_STORY)
+    await finished_last_bucket(redis_client, settings.ADMISSION_THROUGHPUT_WINDOW)
+    
+    assert (await admission.admit([("u1", "free")]))["admitted"]
+    assert (await admission.admit([("u2", "free")]))["admitted"]
+    assert not (await admission.admit([("u3", "free")]))["admitted"]
+    
+    state = await admission.get_state()
+    assert state["priorities"]["free"]["backlog"] == 2 * settings.ADMISSION_TASKS_PER_STORY
@@ -0,0 +1,82 @@
+import logging
+
+from batching.affinity import AffinityPacker
+from batching.batching_service import BatchingService
+from config import settings
+
+def make_task(name: str, story_id: str, reference_image: str = None):
+    task = {"task_id": name, "story_id": story_id}
+    if reference_image:
+        task["reference_image"] = reference_image
+    return task
+
+def ids(tasks):
+    return [task["task_id"] for task in tasks]
+
+def test_few_candidates_make_one_batch():
+    packer = AffinityPacker(["scene"])
+    candidates = [make_task("a", "s1"), make_task("b", "s2")]
+    
+    assert packer.pack("scene", candidates, 3) == candidates
+    assert packer.take_held("scene") == []
+
+def test_tasks_sharing_a_reference_are_packed_together():
+    packer = AffinityPacker(["scene"])
+    candidates = [
+        make_task("a", "s1", "knight.png"),
+        make_task("b", "s2", "dragon.png"),
+        make_task("c", "s3", "knight.png"),
+        make_task("d", "s2")
+    ]
+    
+    assert ids(packer.pack("scene", candidates, 2)) == ["a", "c"]
+    assert ids(packer.take_held("scene")) == ["b", "d"]
+
+def test_story_is_preferred_over_the_oldest_task():
+    packer = AffinityPacker(["scene"])
+    candidates = [make_task("a", "s1"), make_task("b", "s2"), make_task("c", "s1")]
+    
+    assert ids(packer.pack("scene", candidates, 2)) == ["a", "c"]
+
+def held_and_new(packer):
+    """Hold b and d back behind a story s1 batch, then queue more s2 tasks after them."""
+    packer.pack("scene", [make_task("a", "s1"), make_task("b", "s2"), make_task("c", "s1"), make_task("d", "s4")], 2)
+    return packer.take_held("scene") + [make_task("e", "s2"), make_task("f", "s2")]
+
+def test_held_tasks_wait_for_a_better_batch():
+    packer = AffinityPacker(["scene"])
+    candidates = held_and_new(packer)
+    
+    assert ids(packer.pack("scene", candidates, 2)) == ["b", "e"]
+    assert ids(packer.take_held("scene")) == ["d", "f"]
+
+def test_overdue_tasks_go_first(monkeypatch):
+    monkeypatch.setattr(settings, "AFFINITY_MAX_DELAY", 0)
+    packer = AffinityPacker(["scene"])
+    candidates = held_and_new(packer)
+    
+    assert ids(packer.pack("scene", candidates, 2)) == ["b", "d"]
+    assert packer.get_stats()["scene"]["forced"] == 2
+
+def test_stats_compare_with_fifo_packing():
+    packer = AffinityPacker(["scene"])
+    candidates = [
+        make_task("a", "s1", "knight.png"),
+        make_task("b", "s2", "dragon.png"),
+        make_task("c", "s3", "knight.png")
+    ]
+    
+    packer.pack("scene", candidates, 2)
+    stats = packer.get_stats()["scene"]
+    
+    assert (stats["batches"], stats["tasks"], stats["held"], stats["held_back"]) == (1, 2, 1, 1)
+    assert (stats["reference_hit_rate"], stats["fifo_reference_hit_rate"]) == (0.5, 0)
+
+def test_packing_needs_the_stream_backend(redis_client, monkeypatch, caplog):
+    monkeypatch.setattr(settings, "QUEUE_BACKEND", "list")
+    with caplog.at_level(logging.WARNING):
+        assert BatchingService(redis_client).packer is None
+    assert "Affinity packing needs QUEUE_BACKEND=stream" in caplog.text
+    
+    monkeypatch.setattr(settings, "QUEUE_BACKEND", "stream")
+    assert BatchingService(redis_client).packer is not None
@@ -0,0 +1,98 @@
+import json
+import os
+import time
+
+import httpx
+import pytest
+
+from config import settings
+from gpu_workers.artifact_store import ArtifactStore
+from gpu_workers.worker_interface import GPUWorkerInterface
+
+@pytest.fixture
+def store(redis_client, tmp_path):
+    return ArtifactStore(redis_client, str(tmp_path / "artifacts"))
+
+def write(path, content: bytes) -> str:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+    return str(path)
+
+async def chunks(*parts: bytes):
+    for part in parts:
+        yield part
+
+async def test_identical_outputs_are_stored_once(store, redis_client, tmp_path):
+    first = await store.put_file(write(tmp_path / "a.png", b"pixels"))
+    second = await store.put_file(write(tmp_path / "b.PNG", b"pixels"))
+    
+    assert first == second
+    assert first["artifact"].startswith("sha256:") and first["media_type"] == "image/png"
+    assert not os.path.exists(tmp_path / "a.png")
+    assert int(await redis_client.get(store.TOTAL_KEY)) == 6
+    assert store.path_for(first["artifact"]) == first["path"]
+
+async def test_streamed_content_matches_its_file_twin(store, tmp_path):
+    streamed = await store.put_stream(chunks(b"pix", b"els"), ".png")
+    stored = await store.put_file(write(tmp_path / "a.png", b"pixels"), move=False)
+    
+    assert streamed == stored
+    assert b"".join(store.iter_chunks(streamed, chunk_size=4)) == b"pixels"
+    with store.open_mmap(streamed) as mapped:
+        assert mapped[:] == b"pixels"
+
+async def test_references_outside_the_store_are_rejected(store, tmp_path):
+    reference = await store.put_stream(chunks(b"pixels"), ".png")
+    
+    with pytest.raises(ValueError):
+        store.resolve({**reference, "path": str(tmp_path / "elsewhere.png")})
+    assert store.path_for("sha256:../../etc") is None
+
+async def test_place_links_the_artifact(store, tmp_path):
+    reference = await store.put_stream(chunks(b"pixels"), ".png")
+    
+    store.place(reference, str(tmp_path / "characters" / "hero.png"))
+    
+    assert os.path.samefile(tmp_path / "characters" / "hero.png", reference["path"])
+
+async def test_gc_drops_expired_then_least_recently_used(store, redis_client, monkeypatch):
+    old = await store.put_stream(chunks(b"old"), ".png")
+    older = await store.put_stream(chunks(b"older"), ".png")
+    newest = await store.put_stream(chunks(b"newest"), ".png")
+    now = time.time()
+    await redis_client.zadd(store.LRU_KEY, {
+        os.path.relpath(reference["path"], store.root): used_at
+        for reference, used_at in ((old, 0), (older, now - 60), (newest, now))
+    })
+    monkeypatch.setattr(settings, "ARTIFACT_MAX_AGE", 3600)
+    monkeypatch.setattr(settings, "ARTIFACT_MAX_BYTES", 6)
+    
+    assert await store.gc() == 2
+    
+    assert [os.path.exists(reference["path"]) for reference in (old, older, newest)] == [False, False, True]
+    assert int(await redis_client.get(store.TOTAL_KEY)) == 6
+
+async def test_only_outputs_in_the_batch_directory_are_ingested(store, dispatcher, tmp_path):
+    outside = write(tmp_path / "precious.png", b"keep me")
+    
+    def handler(request: httpx.Request) -> httpx.Response:
+        output_dir = json.loads(request.content)["output_dir"]
+        write(os.path.join(output_dir, "t1.png"), b"pixels")
+        return httpx.Response(200, json={"task_results": [
+            {"status": "completed", "path": "t1.png"},
+            {"status": "completed", "path": outside}
+        ]})
+    
+    gpu_worker = GPUWorkerInterface(callback_dispatcher=dispatcher, artifact_store=store)
+    await gpu_worker.client.aclose()
+    gpu_worker.client = httpx.AsyncClient(base_url="http://gpu", transport=httpx.MockTransport(handler))
+    try:
+        ingested, rejected = (await gpu_worker._post_batch([{"task_id": "t1"}, {"task_id": "t2"}]))["task_results"]
+    finally:
+        await gpu_worker.close()
+    
+    assert os.path.exists(ingested["artifact"]["path"])
+    assert rejected["status"] == "failed"
+    assert os.path.exists(outside)
+    assert not os.path.exists(store.incoming_dir) or os.listdir(store.incoming_dir) == []
@@ -0,0 +1,82 @@
+import pytest
+
+from config import settings
+from queues.task_queue import StoryQueue
+from workers.autoscaler import WorkerAutoscaler
+
+class RecordingPool:
+    """A worker pool that only records the sizes it was scaled to."""
+    
+    def __init__(self, workers: int, latencies=()):
+        self.workers = workers
+        self.latencies = list(latencies)
+        self.scaled = []
+    
+    def get_active_workers(self) -> int:
+        return self.workers
+    
+    def get_story_latencies(self):
+        return self.latencies
+    
+    async def scale_workers(self, new_count: int):
+        self.scaled.append(new_count)
+        self.workers = new_count
+
+@pytest.fixture(autouse=True)
+def autoscale_settings(monkeypatch):
+    monkeypatch.setattr(settings, "AUTOSCALE_MIN_WORKERS", 1)
+    monkeypatch.setattr(settings, "AUTOSCALE_MAX_WORKERS", 10)
+    monkeypatch.setattr(settings, "AUTOSCALE_TARGET_DRAIN_TIME", 10)
+    monkeypatch.setattr(settings, "AUTOSCALE_DEFAULT_LATENCY", 5)
+    monkeypatch.setattr(settings, "AUTOSCALE_DOWN_RATIO", 0.7)
+    monkeypatch.setattr(settings, "AUTOSCALE_UP_COOLDOWN", 0)
+    monkeypatch.setattr(settings, "AUTOSCALE_DOWN_COOLDOWN", 0)
+
+async def backlog(redis_client, count: int) -> StoryQueue:
+    queue = StoryQueue(redis_client)
+    if count:
+        await queue.enqueue_stories([{"user_id": "u", "prompt": f"story {index}"} for index in range(count)])
+    return queue
+
+async def test_scales_up_to_drain_backlog_in_time(redis_client):
+    pool = RecordingPool(workers=2, latencies=[2.0, 4.0])
+    autoscaler = WorkerAutoscaler(pool, await backlog(redis_client, 20))
+    
+    decision = await autoscaler.evaluate()
+    
+    # 20 stories x 3s within 10s needs 6 workers
+    assert (decision["action"], decision["desired_workers"]) == ("scale_up", 6)
+    assert pool.scaled == [6]
+
+async def test_desired_size_is_clamped_to_max(redis_client):
+    pool = RecordingPool(workers=2)
+    autoscaler = WorkerAutoscaler(pool, await backlog(redis_client, 100))
+    
+    assert (await autoscaler.evaluate())["desired_workers"] == 10
+
+async def test_small_drop_is_held_by_hysteresis(redis_client):
+    pool = RecordingPool(workers=5)
+    autoscaler = WorkerAutoscaler(pool, await backlog(redis_client, 8))
+    
+    # 8 stories x 5s needs 4 workers, not below 70% of 5
+    assert (await autoscaler.evaluate())["action"] == "hold"
+    assert pool.scaled == []
+
+async def test_idle_pool_scales_down_to_min(redis_client):
+    pool = RecordingPool(workers=5)
+    autoscaler = WorkerAutoscaler(pool, await backlog(redis_client, 0))
+    
+    assert (await autoscaler.evaluate())["action"] == "scale_down"
+    assert pool.scaled == [1]
+
+async def test_changes_wait_for_cooldown(redis_client, monkeypatch):
+    monkeypatch.setattr(settings, "AUTOSCALE_UP_COOLDOWN", 60)
+    pool = RecordingPool(workers=1)
+    queue = await backlog(redis_client, 10)
+    autoscaler = WorkerAutoscaler(pool, queue)
+    assert (await autoscaler.evaluate())["action"] == "scale_up"
+    
+    await queue.enqueue_stories([{"user_id": "u", "prompt": "more"} for _ in range(10)])
+    
+    assert (await autoscaler.evaluate())["action"] == "hold_cooldown"
+    assert pool.scaled == [5]
@@ -0,0 +1,42 @@
+import json
+import time
+
+import pytest
+
+from batching.batching_service import BatchingService
+from config import settings
+
+QUEUE = settings.QUEUE_NAMES["scene"]["free"]
+
+@pytest.fixture
+def service(redis_client, monkeypatch):
+    monkeypatch.setattr(settings, "ADAPTIVE_BATCHING", False)
+    monkeypatch.setattr(settings, "BATCH_SIZE", 3)
+    monkeypatch.setattr(settings, "BATCH_TIMEOUT", 0.2)
+    monkeypatch.setattr(settings, "BATCH_BLOCK_TIMEOUT", 0.2)
+    return BatchingService(redis_client)
+
+async def push(redis_client, count: int):
+    """Queue tasks the way add_task does, oldest first."""
+    for index in range(count):
+        await redis_client.lpush(QUEUE, json.dumps({"task_id": f"task-{index}"}))
+
+async def test_queued_tasks_are_drained_oldest_first_up_to_batch_size(service, redis_client):
+    await push(redis_client, 5)
+    
+    batch = await service._form_batch("scene")
+    
+    assert [task["task_id"] for task in batch] == ["task-0", "task-1", "task-2"]
+    assert await redis_client.llen(QUEUE) == 2
+
+async def test_short_batch_lingers_for_batch_timeout(service, redis_client):
+    await push(redis_client, 1)
+    
+    started = time.monotonic()
+    batch = await service._form_batch("scene")
+    
+    assert [task["task_id"] for task in batch] == ["task-0"]
+    assert time.monotonic() - started >= settings.BATCH_TIMEOUT
+
+async def test_idle_queue_returns_an_empty_batch(service):
+    assert await service._form_batch("scene") == []
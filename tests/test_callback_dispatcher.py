@@ -0,0 +1,88 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from config import settings
+from gpu_workers.callback_dispatcher import CallbackDispatcher
+from gpu_workers.worker_interface import GPUWorkerInterface
+
+@pytest.fixture(autouse=True)
+def fast_settings(monkeypatch):
+    monkeypatch.setattr(settings, "CALLBACK_COALESCE_WINDOW", 0.01)
+    monkeypatch.setattr(settings, "CALLBACK_MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(settings, "CALLBACK_RETRY_INTERVAL", 0.01)
+
+async def settled(dispatcher: CallbackDispatcher):
+    """Wait until buffered callbacks were sent."""
+    async with asyncio.timeout(5):
+        while dispatcher.buffers or dispatcher.flush_tasks or dispatcher.deliveries:
+            await asyncio.sleep(0.01)
+
+async def test_callbacks_to_one_url_are_coalesced(dispatcher, redis_client):
+    await dispatcher.dispatch([
+        ("http://client/a", {"task_id": "t1"}),
+        ("http://client/a", {"task_id": "t2"}),
+        ("http://client/b", {"task_id": "t3"})
+    ])
+    await settled(dispatcher)
+    
+    assert sorted(dispatcher.requests, key=lambda request: request[0]) == [
+        ("http://client/a", {"tasks": [{"task_id": "t1"}, {"task_id": "t2"}]}),
+        ("http://client/b", {"task_id": "t3"})
+    ]
+    assert await redis_client.zcard(dispatcher.OUTBOX_KEY) == 0
+
+async def test_failed_deliveries_back_off_then_dead_letter(dispatcher, redis_client):
+    dispatcher.status_code = 503
+    await dispatcher.dispatch([("http://client/a", {"task_id": "t1"})])
+    await settled(dispatcher)
+    
+    (member, due), = await redis_client.zrange(dispatcher.OUTBOX_KEY, 0, -1, withscores=True)
+    assert json.loads(member)["attempt"] == 1
+    assert due > time.time()
+    
+    # The retry loop picks the entry up once it is due and gives up after the last attempt
+    await redis_client.zadd(dispatcher.OUTBOX_KEY, {member: time.time() - 1})
+    await dispatcher.start()
+    async with asyncio.timeout(5):
+        while not await redis_client.llen(dispatcher.DEAD_LETTER_KEY):
+            await asyncio.sleep(0.01)
+    assert await redis_client.zcard(dispatcher.OUTBOX_KEY) == 0
+    dead = json.loads(await redis_client.lindex(dispatcher.DEAD_LETTER_KEY, 0))
+    assert (dead["payload"], dead["attempt"]) == ({"task_id": "t1"}, 2)
+
+async def test_claim_leases_only_due_entries(dispatcher, redis_client):
+    now = time.time()
+    await redis_client.zadd(dispatcher.OUTBOX_KEY, {"due": now - 1, "later": now + 60})
+    
+    due = await dispatcher.claim_script(keys=[dispatcher.OUTBOX_KEY], args=[now, now + 30, 10])
+    
+    assert due == ["due"]
+    assert await redis_client.zscore(dispatcher.OUTBOX_KEY, "due") == pytest.approx(now + 30)
+    assert await dispatcher.claim_script(keys=[dispatcher.OUTBOX_KEY], args=[now, now + 30, 10]) == []
+
+async def test_entry_claimed_elsewhere_is_not_sent_again(dispatcher, redis_client):
+    await dispatcher.dispatch([("http://client/a", {"task_id": "t1"})])
+    member, = dispatcher.leases
+    # Another dispatcher took the entry over after the lease ran out
+    await redis_client.zadd(dispatcher.OUTBOX_KEY, {member: time.time() + 120})
+    
+    await settled(dispatcher)
+    
+    assert dispatcher.requests == []
+    assert await redis_client.zcard(dispatcher.OUTBOX_KEY) == 1
+
+async def test_callbacks_carry_each_task_status(dispatcher):
+    gpu_worker = GPUWorkerInterface(callback_dispatcher=dispatcher)
+    batch = [{"task_id": f"t{index}", "callback_url": "http://client/a"} for index in range(3)]
+    
+    await gpu_worker._send_callbacks(batch, {"task_results": [{"status": "completed"}, {"status": "failed", "error": "OOM"}]})
+    await settled(dispatcher)
+    await gpu_worker.close()
+    
+    (_, body), = dispatcher.requests
+    assert [(task["task_id"], task["status"]) for task in body["tasks"]] == [
+        ("t0", "completed"), ("t1", "failed"), ("t2", "failed")
+    ]
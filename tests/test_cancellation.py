@@ -0,0 +1,166 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from batching.batching_service import BatchingService
+from batching.cancellation import StoryCancellation
+from batching.queue_backend import RAW
+from batching.task_codec import TaskCodec
+from config import settings
+from gpu_workers.worker_interface import GPUWorkerInterface
+from ingestion.task_splitter import TaskSplitter
+
+@pytest.fixture(autouse=True)
+def fast_settings(monkeypatch):
+    monkeypatch.setattr(settings, "CALLBACK_COALESCE_WINDOW", 0.01)
+    monkeypatch.setattr(settings, "COMPOSER_ENABLED", False)
+
+@pytest.fixture
+async def service(redis_client, dispatcher):
+    """A batching service whose GPU requests are recorded in gpu_worker.posted and all complete."""
+    gpu_worker = GPUWorkerInterface(callback_dispatcher=dispatcher)
+    gpu_worker.posted = []
+    
+    def handler(request: httpx.Request) -> httpx.Response:
+        tasks = json.loads(request.content)["tasks"]
+        gpu_worker.posted.extend(task["task_id"] for task in tasks)
+        return httpx.Response(200, json={"task_results": [{"status": "completed"} for _ in tasks]})
+    
+    await gpu_worker.client.aclose()
+    gpu_worker.client = httpx.AsyncClient(base_url="http://gpu", transport=httpx.MockTransport(handler))
+    yield BatchingService(redis_client, gpu_worker=gpu_worker)
+    await gpu_worker.close()
+
+def make_task(task_id: str, task_type: str, story_id: str = "story-1", depends_on=()):
+    return {
+        "task_id": task_id,
+        "task_type": task_type,
+        "priority": "free",
+        "user_id": "u1",
+        "story_id": story_id,
+        "scene_idx": 0,
+        "prompt": f"Generate {task_id}",
+        "callback_url": "http://client/cb",
+        "depends_on": list(depends_on)
+    }
+
+STORY = [
+    make_task("00000000-0000-0000-0000-000000000001", "character"),
+    make_task("00000000-0000-0000-0000-000000000002", "scene", depends_on=["00000000-0000-0000-0000-000000000001"]),
+    make_task("00000000-0000-0000-0000-000000000003", "clip", depends_on=["00000000-0000-0000-0000-000000000002"])
+]
+
+async def queued(redis_client, task_type: str):
+    codec = TaskCodec(redis_client)
+    payloads = await redis_client.execute_command("LRANGE", settings.QUEUE_NAMES[task_type]["free"], 0, -1, **RAW)
+    return [codec.decode(payload) for payload in reversed(payloads)]
+
+async def cancel(redis_client, cancellation: StoryCancellation, story_id: str) -> int:
+    async with redis_client.pipeline(transaction=True) as pipe:
+        await cancellation.cancel(pipe, story_id)
+        (unfinished,) = await pipe.execute()
+    return unfinished
+
+async def test_cancel_counts_unfinished_tasks(service, redis_client):
+    await service.add_tasks([dict(task) for task in STORY])
+    await service.process_batch("character", await queued(redis_client, "character"))
+    
+    assert await service.cancel_story("story-1") == 2
+    
+    assert (await service.progress.get("story-1"))["status"] == "cancelled"
+    assert await redis_client.exists(service.cancellation.cancelled_key("story-1"))
+    assert not await redis_client.exists(service.cancellation.tasks_key("story-1"))
+    # The clip was parked in the task graph, which is gone
+    await service.process_batch("scene", await queued(redis_client, "scene"))
+    assert await queued(redis_client, "clip") == []
+
+async def test_queued_tasks_of_a_cancelled_story_are_dropped(service, redis_client, dispatcher, monkeypatch):
+    other = make_task("00000000-0000-0000-0000-000000000004", "character", story_id="story-2")
+    await service.add_tasks([dict(task) for task in STORY] + [dict(other)])
+    unpinned = []
+    
+    async def unpin(tasks):
+        unpinned.extend(task["task_id"] for task in tasks)
+    monkeypatch.setattr(service.character_cache, "unpin", unpin)
+    await service.cancel_story("story-1")
+    
+    await service.process_batch("character", await queued(redis_client, "character"))
+    await dispatcher.stop()
+    
+    assert service.gpu_worker.posted == [other["task_id"]]
+    assert unpinned == [STORY[0]["task_id"]]
+    assert [body["task_id"] for _, body in dispatcher.requests] == [other["task_id"]]
+    assert await queued(redis_client, "scene") == []
+
+async def test_cancelled_story_gets_no_new_tasks(service, redis_client):
+    await service.cancel_story("story-1")
+    
+    await service.add_tasks([dict(task) for task in STORY])
+    
+    assert await queued(redis_client, "character") == []
+
+async def test_split_remembers_cancelled_stories(redis_client):
+    cancellation = StoryCancellation(redis_client)
+    tasks = [make_task("a", "scene"), make_task("b", "scene", story_id="story-2"), make_task("c", "scene")]
+    await cancel(redis_client, cancellation, "story-1")
+    
+    kept, dropped = await cancellation.split(tasks)
+    assert ([task["task_id"] for task in kept], [task["task_id"] for task in dropped]) == (["b"], ["a", "c"])
+    
+    # Known cancellations are not looked up again
+    await redis_client.delete(cancellation.cancelled_key("story-1"))
+    _, dropped = await cancellation.split(tasks)
+    assert len(dropped) == 2
+
+async def test_cancel_script_returns_tracked_tasks_once(redis_client):
+    cancellation = StoryCancellation(redis_client)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        cancellation.track(pipe, [make_task("a", "scene"), make_task("b", "clip"), make_task("c", "clip")])
+        await pipe.execute()
+    await cancellation.untrack([make_task("c", "clip")])
+    
+    assert await cancel(redis_client, cancellation, "story-1") == 2
+    assert await cancel(redis_client, cancellation, "story-1") == 0
+    assert await redis_client.ttl(cancellation.cancelled_key("story-1")) == settings.STORY_CANCEL_TTL
+
+async def test_cancellations_reach_other_processes(redis_client):
+    listener = StoryCancellation(redis_client)
+    heard = []
+    
+    async def on_cancel(story_id: str):
+        heard.append(story_id)
+    
+    listening = asyncio.create_task(listener.listen(on_cancel))
+    try:
+        async with asyncio.timeout(5):
+            # Let the subscription start before the cancellation is published
+            await asyncio.sleep(0.1)
+            await cancel(redis_client, StoryCancellation(redis_client), "story-1")
+            while not heard:
+                await asyncio.sleep(0.01)
+    finally:
+        listening.cancel()
+        await asyncio.gather(listening, return_exceptions=True)
+    
+    assert heard == ["story-1"]
+    assert "story-1" in listener.cancelled
+
+async def test_cut_off_stream_cancels_its_story(redis_client, monkeypatch):
+    monkeypatch.setattr(settings, "STORY_STREAM_ENQUEUE_SCENES", 1)
+    service = BatchingService(redis_client)
+    
+    async def cut_off():
+        yield b"A knight rides out at dawn.\n\nA dragon circles the tower.\n\n"
+        raise ConnectionError("client went away")
+    
+    with pytest.raises(ConnectionError):
+        await TaskSplitter(service).process_story_stream(
+            {"user_id": "u1", "priority": "free", "story_id": "story-1", "callback_url": "http://cb"}, cut_off()
+        )
+    
+    assert (await service.progress.get("story-1"))["status"] == "cancelled"
+    # The group enqueued before the cut is dropped when it is batched
+    _, dropped = await service.cancellation.split(await queued(redis_client, "character"))
+    assert len(dropped) == 1
@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+from config import settings
+from ingestion.character_cache import CharacterReferenceCache
+
+@pytest.fixture
+def cache(redis_client, monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "CHARACTER_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(settings, "CHARACTER_CACHE_MAX_BYTES", 250)
+    return CharacterReferenceCache(redis_client)
+
+def write_reference(cache: CharacterReferenceCache, name: str, size: int = 100) -> dict:
+    """Write a reference file as a finished character task would and return the task."""
+    cache_key = cache.cache_key("story-1", name)
+    with open(cache.reference_path(cache_key), "wb") as f:
+        f.write(b"x" * size)
+    return {"task_type": "character", "cache_key": cache_key}
+
+def scene_using(task: dict) -> dict:
+    return {"task_type": "scene", "reference_image": f"/refs/{task['cache_key']}.png"}
+
+async def test_registered_references_are_cache_hits(cache, redis_client):
+    task = write_reference(cache, "Alice")
+    
+    assert await cache.register_results([task, {"task_type": "scene", "cache_key": "ignored"}]) == 1
+    
+    assert await cache.lookup([task["cache_key"], "missing"]) == {task["cache_key"]: True, "missing": False}
+    assert int(await redis_client.get(cache.TOTAL_KEY)) == 100
+
+async def test_registering_a_reference_again_replaces_its_size(cache, redis_client):
+    task = write_reference(cache, "Alice")
+    await cache.register_results([task])
+    write_reference(cache, "Alice", size=40)
+    
+    await cache.register_results([task])
+    
+    assert int(await redis_client.get(cache.TOTAL_KEY)) == 40
+
+async def test_least_recently_used_references_are_evicted(cache, redis_client):
+    tasks = [write_reference(cache, name) for name in ("Alice", "Bob")]
+    await cache.register_results(tasks[:1])
+    await cache.register_results(tasks[1:])
+    # A lookup makes Alice the most recently used
+    await cache.lookup([tasks[0]["cache_key"]])
+    
+    await cache.register_results([write_reference(cache, "Carol")])
+    
+    assert not os.path.exists(cache.reference_path(tasks[1]["cache_key"]))
+    assert await cache.lookup([tasks[0]["cache_key"], tasks[1]["cache_key"]]) == {
+        tasks[0]["cache_key"]: True, tasks[1]["cache_key"]: False
+    }
+    assert int(await redis_client.get(cache.TOTAL_KEY)) == 200
+
+async def test_pinned_references_survive_eviction_until_unpinned(cache, redis_client):
+    alice = write_reference(cache, "Alice")
+    await cache.register_results([alice])
+    async with redis_client.pipeline(transaction=True) as pipe:
+        cache.pin(pipe, [scene_using(alice), scene_using(alice)])
+        await pipe.execute()
+    
+    await cache.register_results([write_reference(cache, "Bob"), write_reference(cache, "Carol")])
+    assert os.path.exists(cache.reference_path(alice["cache_key"]))
+    
+    await cache.unpin([scene_using(alice)])
+    assert await redis_client.hget(cache.PINS_KEY, alice["cache_key"]) == "1"
+    await cache.unpin([scene_using(alice)])
+    assert not await redis_client.hexists(cache.PINS_KEY, alice["cache_key"])
+    
+    await cache.register_results([write_reference(cache, "Dave")])
+    assert not os.path.exists(cache.reference_path(alice["cache_key"]))
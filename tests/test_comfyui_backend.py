@@ -0,0 +1,186 @@
+import asyncio
+import json
+import os
+import uuid
+
+import fakeredis.aioredis
+import httpx
+import pytest
+
+from config import settings
+from gpu_workers.artifact_store import ArtifactStore
+from gpu_workers.comfyui_backend import ComfyUIBackend
+from gpu_workers.worker_interface import GPUWorkerInterface
+from tests.comfyui_stub import StubComfyUI
+
+async def wait_until(predicate, timeout: float = 5):
+    """Poll until predicate() is true."""
+    async def poll():
+        while not predicate():
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(poll(), timeout)
+
+def make_task(prompt: str = "a knight at dawn", story_id: str = "story-1"):
+    return {
+        "task_id": str(uuid.uuid4()),
+        "task_type": "scene",
+        "priority": "free",
+        "story_id": story_id,
+        "prompt": prompt
+    }
+
+@pytest.fixture(autouse=True)
+def fast_settings(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "COMFYUI_RECONNECT_BACKOFF", 0.05)
+    monkeypatch.setattr(settings, "COMFYUI_PROMPT_TIMEOUT", 5)
+    # Nothing on the shared volume: outputs are streamed from /view
+    monkeypatch.setattr(settings, "COMFYUI_OUTPUT_DIR", str(tmp_path / "comfyui-output"))
+
+@pytest.fixture
+async def stubs():
+    servers = [StubComfyUI(), StubComfyUI()]
+    for server in servers:
+        await server.start()
+    yield servers
+    for server in servers:
+        await server.close()
+
+@pytest.fixture
+async def make_backend(tmp_path):
+    backends = []
+    
+    async def make(servers):
+        store = ArtifactStore(fakeredis.aioredis.FakeRedis(decode_responses=True), str(tmp_path / "artifacts"))
+        backend = ComfyUIBackend(urls=[server.url for server in servers], artifact_store=store)
+        await backend.start()
+        backends.append(backend)
+        await wait_until(lambda: all(instance.connected for instance in backend.instances))
+        return backend
+    
+    yield make
+    for backend in backends:
+        await backend.close()
+
+async def test_process_batch_returns_an_artifact_per_task(stubs, make_backend):
+    backend = await make_backend(stubs[:1])
+    batch = [make_task(), make_task(), make_task("a dragon over the sea")]
+    
+    results = await backend.process_batch(batch)
+    
+    task_results = results["task_results"]
+    assert [result["status"] for result in task_results] == ["completed"] * 3
+    assert all(os.path.exists(result["artifact"]["path"]) for result in task_results)
+    # Tasks sharing settings are compiled into one graph
+    assert len(stubs[0].prompts) == 1
+    assert len({result["prompt_id"] for result in task_results}) == 1
+
+async def test_prompt_finished_before_submit_returns_is_claimed(stubs, make_backend):
+    backend = await make_backend(stubs[:1])
+    instance = backend.instances[0]
+    stubs[0].finish_before_response = True
+    
+    prompt_id = await instance.submit({"1": {"class_type": "SaveImage", "inputs": {}}})
+    outputs = await instance.wait(prompt_id)
+    
+    assert outputs == stubs[0].history[prompt_id]["outputs"]
+    assert not instance.unclaimed
+
+async def test_prompt_finished_while_disconnected_is_recovered_from_history(stubs, make_backend):
+    backend = await make_backend(stubs[:1])
+    instance = backend.instances[0]
+    stubs[0].hold = True
+    prompt_id = await instance.submit({"1": {"class_type": "SaveImage", "inputs": {}}})
+    
+    # The prompt finishes while the socket is down, so its event is lost
+    stubs[0].refuse_sockets = True
+    await stubs[0].drop_sockets()
+    await wait_until(lambda: not instance.connected)
+    await stubs[0].finish(prompt_id)
+    stubs[0].refuse_sockets = False
+    
+    outputs = await instance.wait(prompt_id)
+    
+    assert instance.connected
+    assert outputs == stubs[0].history[prompt_id]["outputs"]
+
+async def test_graphs_go_to_the_least_loaded_instance(stubs, make_backend):
+    backend = await make_backend(stubs)
+    await stubs[0].report_queue(5)
+    await wait_until(lambda: backend.instances[0].queue_remaining == 5)
+    
+    results = await backend.process_batch([make_task()])
+    
+    assert results["task_results"][0]["instance"] == stubs[1].url
+    assert not stubs[0].prompts and len(stubs[1].prompts) == 1
+
+async def test_disconnected_instances_get_no_graphs(stubs, make_backend):
+    backend = await make_backend(stubs)
+    stubs[1].refuse_sockets = True
+    await stubs[1].drop_sockets()
+    await wait_until(lambda: not backend.instances[1].connected)
+    # The connected instance is busier but still preferred
+    await stubs[0].report_queue(5)
+    await wait_until(lambda: backend.instances[0].queue_remaining == 5)
+    
+    results = await backend.process_batch([make_task()])
+    
+    assert results["task_results"][0]["instance"] == stubs[0].url
+
+async def test_tasks_without_a_workflow_go_to_the_generic_service(stubs, dispatcher, redis_client, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "GPU_BACKEND", "comfyui")
+    monkeypatch.setattr(settings, "COMFYUI_URLS", [stubs[0].url])
+    store = ArtifactStore(redis_client, str(tmp_path / "artifacts"))
+    gpu_worker = GPUWorkerInterface(callback_dispatcher=dispatcher, artifact_store=store)
+    posted = []
+    
+    def handler(request: httpx.Request) -> httpx.Response:
+        tasks = json.loads(request.content)["tasks"]
+        posted.extend(task["task_id"] for task in tasks)
+        return httpx.Response(200, json={"task_results": [{"status": "completed", "video": "clip.mp4"} for _ in tasks]})
+    
+    await gpu_worker.client.aclose()
+    gpu_worker.client = httpx.AsyncClient(base_url="http://gpu", transport=httpx.MockTransport(handler))
+    await gpu_worker.comfyui.start()
+    try:
+        await wait_until(lambda: gpu_worker.comfyui.instances[0].connected)
+        scene, clip = make_task(), {**make_task(), "task_type": "clip"}
+        
+        results = await gpu_worker._run_batch([clip, scene])
+    finally:
+        await gpu_worker.close()
+    
+    clip_result, scene_result = results["task_results"]
+    assert (clip_result["video"], scene_result["status"]) == ("clip.mp4", "completed")
+    assert posted == [clip["task_id"]]
+    assert len(stubs[0].prompts) == 1
+
+async def test_interrupting_a_running_prompt_cancels_its_tasks(stubs, make_backend):
+    backend = await make_backend(stubs[:1])
+    stubs[0].hold = True
+    batch = asyncio.create_task(backend.process_batch([make_task(story_id="story-1")]))
+    await wait_until(lambda: backend.running)
+    prompt_id = next(iter(backend.running))
+    await stubs[0].start_executing(prompt_id)
+    await wait_until(lambda: backend.instances[0].executing == prompt_id)
+    
+    assert await backend.interrupt({"story-2"}) == 0
+    assert await backend.interrupt({"story-1"}) == 1
+    results = await batch
+    
+    assert results["task_results"][0]["status"] == "cancelled"
+    assert stubs[0].interrupted == [prompt_id]
+    assert not stubs[0].deleted
+
+async def test_interrupting_a_queued_prompt_deletes_it(stubs, make_backend):
+    backend = await make_backend(stubs[:1])
+    stubs[0].hold = True
+    batch = asyncio.create_task(backend.process_batch([make_task(story_id="story-1")]))
+    await wait_until(lambda: backend.running)
+    prompt_id = next(iter(backend.running))
+    
+    assert await backend.interrupt({"story-1"}) == 1
+    results = await batch
+    
+    assert results["task_results"][0]["status"] == "cancelled"
+    assert stubs[0].deleted == [prompt_id]
+    assert not stubs[0].interrupted
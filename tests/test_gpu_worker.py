@@ -0,0 +1,112 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from batching.batching_service import BatchingService
+from config import settings
+from gpu_workers.circuit_breaker import CircuitBreaker
+from gpu_workers.worker_interface import GPUWorkerInterface
+
+@pytest.fixture(autouse=True)
+def fast_settings(monkeypatch):
+    monkeypatch.setattr(settings, "CALLBACK_COALESCE_WINDOW", 0.01)
+
+@pytest.fixture
+async def gpu_worker(dispatcher):
+    """A GPU client whose requests are answered with the test's status codes."""
+    gpu_worker = GPUWorkerInterface(callback_dispatcher=dispatcher)
+    gpu_worker.status_code = 200
+    
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/process_batch":
+            tasks = json.loads(request.content)["tasks"]
+            return httpx.Response(gpu_worker.status_code, json={"task_results": [{"status": "completed"} for _ in tasks]})
+        return httpx.Response(gpu_worker.status_code)
+    
+    await gpu_worker.client.aclose()
+    gpu_worker.client = httpx.AsyncClient(base_url="http://gpu", transport=httpx.MockTransport(handler))
+    yield gpu_worker
+    await gpu_worker.close()
+
+def make_batch(size: int):
+    return [
+        {
+            "task_id": f"t{index}", "task_type": "scene", "priority": "free", "story_id": "story-1",
+            "prompt": "A knight", "timestamp": 0.0, "callback_url": "http://client/a"
+        }
+        for index in range(size)
+    ]
+
+async def delivered(dispatcher):
+    """Wait for the first callback request and return its tasks."""
+    async with asyncio.timeout(5):
+        while not dispatcher.requests:
+            await asyncio.sleep(0.01)
+    (_, body), = dispatcher.requests
+    return body["tasks"]
+
+def test_breaker_opens_at_threshold_and_admits_one_trial():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    
+    # Past the reset timeout only one caller gets the trial
+    assert breaker.try_acquire()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.try_acquire()
+    breaker.release()
+    assert breaker.try_acquire()
+    
+    # A failed trial reopens the breaker straight away
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+async def test_acquire_raises_while_open():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    breaker.record_failure()
+    
+    with pytest.raises(ConnectionError):
+        await breaker.acquire()
+
+async def test_healthy_probe_keeps_request_failures(gpu_worker):
+    gpu_worker.circuit_breaker.record_failure()
+    
+    assert await gpu_worker.check_health()
+    assert gpu_worker.circuit_breaker.failures == 1
+
+async def test_healthy_probe_closes_open_breaker(gpu_worker):
+    gpu_worker.circuit_breaker.trip()
+    
+    assert await gpu_worker.check_health()
+    assert gpu_worker.circuit_breaker.state == CircuitBreaker.CLOSED
+    assert gpu_worker.circuit_breaker.failures == 0
+
+async def test_probe_failures_count_but_client_errors_do_not(gpu_worker):
+    gpu_worker.status_code = 503
+    assert not await gpu_worker.check_health()
+    assert gpu_worker.circuit_breaker.failures == 1
+    
+    gpu_worker.status_code = 404
+    assert not await gpu_worker.check_health()
+    assert gpu_worker.circuit_breaker.failures == 1
+
+async def test_rejected_batch_does_not_count_as_failure(gpu_worker):
+    gpu_worker.status_code = 422
+    
+    with pytest.raises(httpx.HTTPStatusError):
+        await gpu_worker.process_batch(make_batch(2))
+    assert gpu_worker.circuit_breaker.failures == 0
+
+async def test_failed_batch_sends_failed_callbacks(gpu_worker, dispatcher, redis_client):
+    gpu_worker.status_code = 500
+    service = BatchingService(redis_client, gpu_worker=gpu_worker)
+    
+    await service.process_batch("scene", make_batch(2))
+    
+    tasks = await delivered(dispatcher)
+    assert [(task["task_id"], task["status"]) for task in tasks] == [("t0", "failed"), ("t1", "failed")]
+    assert gpu_worker.circuit_breaker.failures == 1
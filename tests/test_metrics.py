@@ -0,0 +1,70 @@
+import multiprocessing
+
+import pytest
+
+import metrics
+
+@pytest.fixture
+def registered():
+    """Metrics created by a test, dropped from the registry afterwards."""
+    created = []
+    yield created
+    for metric in created:
+        metrics.REGISTRY.remove(metric)
+
+def test_counter_renders_a_total_per_label_set(registered):
+    counter = metrics.Counter("test_tasks", "Tasks", ["task_type"])
+    registered.append(counter)
+    
+    counter.labels("scene").inc()
+    counter.labels("scene").inc(2)
+    counter.labels('say "hi"\n').inc()
+    
+    assert counter.render() == [
+        "# HELP test_tasks_total Tasks",
+        "# TYPE test_tasks_total counter",
+        'test_tasks_total{task_type="scene"} 3',
+        'test_tasks_total{task_type="say \\"hi\\"\\n"} 1'
+    ]
+    assert "test_tasks_total" in metrics.render()
+
+def test_histogram_buckets_are_cumulative(registered):
+    histogram = metrics.Histogram("test_latency", "Latency", buckets=(0.1, 1))
+    registered.append(histogram)
+    
+    for value in (0.05, 0.1, 0.5, 5):
+        histogram.observe(value)
+    
+    assert histogram.render()[2:] == [
+        'test_latency_bucket{le="0.1"} 2',
+        'test_latency_bucket{le="1"} 3',
+        'test_latency_bucket{le="+Inf"} 4',
+        "test_latency_sum 5.65",
+        "test_latency_count 4"
+    ]
+
+def test_wrong_label_count_is_rejected(registered):
+    gauge = metrics.Gauge("test_depth", "Depth", ["task_type", "priority"])
+    registered.append(gauge)
+    
+    with pytest.raises(ValueError):
+        gauge.labels("scene")
+
+def _add_busy_time(shared):
+    metrics.share(metrics.WORKER_BUSY_SECONDS, shared)
+    metrics.WORKER_BUSY_SECONDS.inc(2.5)
+
+def test_shared_counter_adds_up_other_processes(registered):
+    counter = metrics.Counter("test_busy", "Busy")
+    registered.append(counter)
+    counter.inc(1)
+    context = multiprocessing.get_context("spawn")
+    shared = context.Value("d", 0.0)
+    
+    # Time counted before sharing is kept
+    metrics.share(counter, shared)
+    process = context.Process(target=_add_busy_time, args=(shared,))
+    process.start()
+    process.join(30)
+    
+    assert counter.render()[-1] == "test_busy_total 3.5"
@@ -0,0 +1,62 @@
+import asyncio
+import signal
+import time
+
+import pytest
+
+from config import settings
+from workers.process_pool import ProcessWorkerPool
+
+@pytest.fixture(autouse=True)
+def fast_settings(monkeypatch):
+    # Spawned worker processes read their settings from the environment
+    for name, value in {"WORKER_SUPERVISE_INTERVAL": "0.1", "WORKER_DRAIN_TIMEOUT": "1", "WORKER_RESTART_BACKOFF": "0.1"}.items():
+        monkeypatch.setenv(name, value)
+        monkeypatch.setattr(settings, name, float(value))
+
+def _ignore_sigterm():
+    """A worker process stuck in work that never looks at its stop event."""
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    time.sleep(60)
+
+async def wait_for(condition, timeout: float = 30):
+    async with asyncio.timeout(timeout):
+        while not condition():
+            await asyncio.sleep(0.05)
+
+async def test_stop_drains_worker_processes():
+    pool = ProcessWorkerPool(num_processes=1, workers_per_process=1)
+    await pool.start()
+    process, = pool.processes.values()
+    await wait_for(process.is_alive)
+    
+    await pool.stop()
+    
+    assert pool.processes == {}
+    assert process.exitcode == 0
+
+async def test_crashed_process_is_restarted():
+    pool = ProcessWorkerPool(num_processes=1, workers_per_process=1)
+    await pool.start()
+    try:
+        crashed = pool.processes["process-1"]
+        await wait_for(crashed.is_alive)
+        crashed.kill()
+        
+        await wait_for(lambda: pool.processes["process-1"] is not crashed and pool.processes["process-1"].is_alive())
+        assert pool.restarts == {"process-1": 1}
+    finally:
+        await pool.stop()
+
+async def test_process_ignoring_sigterm_is_killed(monkeypatch):
+    monkeypatch.setattr(settings, "WORKER_DRAIN_TIMEOUT", 0)
+    pool = ProcessWorkerPool(num_processes=0)
+    process = pool.context.Process(target=_ignore_sigterm)
+    process.start()
+    pool.processes["stuck"] = process
+    pool.stop_events["stuck"] = pool.context.Event()
+    await wait_for(process.is_alive)
+    
+    await pool.stop()
+    
+    assert process.exitcode == -signal.SIGKILL
@@ -0,0 +1,135 @@
+import os
+import uuid
+
+import pytest
+
+from batching.result_cache import ResultCache
+from config import settings
+from gpu_workers.artifact_store import ArtifactStore
+
+@pytest.fixture
+def cache(redis_client, tmp_path):
+    return ResultCache(redis_client, ArtifactStore(redis_client, str(tmp_path / "artifacts")))
+
+def make_task(**fields):
+    task = {"task_id": str(uuid.uuid4()), "task_type": "scene", "prompt": "A dragon circles the tower."}
+    task.update(fields)
+    return task
+
+async def completed(cache, tmp_path, content: bytes):
+    path = tmp_path / f"{uuid.uuid4()}.png"
+    path.write_bytes(content)
+    return {"status": "completed", "artifact": await cache.artifact_store.put_file(str(path))}
+
+def test_key_for_leaves_the_task_unchanged(cache):
+    task = make_task()
+    
+    key, seed = cache.key_for(task)
+    
+    assert "seed" not in task
+    assert cache.key_for(make_task()) == (key, seed)
+    assert cache.key_for(make_task(seed=seed)) == (key, seed)
+    assert cache.key_for(make_task(seed=seed + 1))[0] != key
+
+async def test_claim_assigns_derived_seeds(cache):
+    first, second = make_task(), make_task(seed=7)
+    
+    await cache.claim([first, second])
+    
+    assert first["seed"] == cache.key_for(make_task())[1]
+    assert second["seed"] == 7
+
+async def test_finished_result_is_a_hit(cache, tmp_path):
+    result = await completed(cache, tmp_path, b"pixels")
+    hits, duplicates, parked, (key,) = await cache.claim([make_task()])
+    assert (hits, duplicates, parked) == ({}, {}, [])
+    
+    assert await cache.finish(key, result) == []
+    hits, _, _, _ = await cache.claim([make_task()])
+    
+    assert hits == {0: {**result, "cached": True}}
+    assert (await cache.get_stats())["entries"] == 1
+
+async def test_duplicates_in_a_batch_share_their_first_occurrence(cache):
+    hits, duplicates, parked, keys = await cache.claim([make_task(), make_task(prompt="other"), make_task()])
+    
+    assert (hits, duplicates, parked) == ({}, {2: 0}, [])
+    assert keys[0] == keys[2] != keys[1]
+
+async def test_identical_task_elsewhere_waits_for_the_running_one(cache, tmp_path):
+    _, _, _, (key,) = await cache.claim([make_task()])
+    waiting = make_task()
+    
+    _, _, parked, _ = await cache.claim([waiting])
+    assert parked == [0]
+    
+    result = await completed(cache, tmp_path, b"pixels")
+    (released,) = await cache.finish(key, result)
+    assert released["task_id"] == waiting["task_id"]
+    hits, _, _, _ = await cache.claim([make_task()])
+    assert 0 in hits
+
+async def test_failed_run_releases_waiters_without_caching(cache):
+    _, _, _, (key,) = await cache.claim([make_task()])
+    await cache.claim([make_task()])
+    
+    released = await cache.finish(key, {"status": "failed", "error": "boom"})
+    
+    assert len(released) == 1
+    hits, _, parked, _ = await cache.claim([make_task()])
+    assert (hits, parked) == ({}, [])
+
+async def test_redelivered_task_reclaims_its_own_key(cache):
+    task = make_task()
+    await cache.claim([task])
+    
+    hits, duplicates, parked, _ = await cache.claim([dict(task)])
+    
+    assert (hits, duplicates, parked) == ({}, {}, [])
+
+async def test_result_whose_artifact_is_gone_is_dropped(cache, tmp_path):
+    result = await completed(cache, tmp_path, b"pixels")
+    _, _, _, (key,) = await cache.claim([make_task()])
+    await cache.finish(key, result)
+    os.unlink(result["artifact"]["path"])
+    
+    hits, _, parked, _ = await cache.claim([make_task()])
+    
+    assert (hits, parked) == ({}, [])
+    assert (await cache.get_stats())["entries"] == 0
+
+async def test_clips_are_keyed_by_their_scene_output(cache, tmp_path):
+    scenes = [make_task(), make_task(), make_task()]
+    await cache.record_outputs(scenes, {"task_results": [
+        await completed(cache, tmp_path, b"castle"),
+        await completed(cache, tmp_path, b"forest"),
+        await completed(cache, tmp_path, b"castle")
+    ]})
+    clips = [make_task(task_type="clip", prompt="Animate", depends_on=[scene["task_id"]]) for scene in scenes]
+    
+    _, duplicates, _, keys = await cache.claim(clips)
+    
+    # Identical scene images make identical clips; different ones never share
+    assert keys[0] == keys[2] != keys[1]
+    assert duplicates == {2: 0}
+    assert clips[0]["seed"] != clips[1]["seed"]
+
+async def test_clip_of_an_unknown_scene_output_is_not_shared(cache):
+    clips = [make_task(task_type="clip", prompt="Animate", depends_on=[str(uuid.uuid4())]) for _ in range(2)]
+    
+    _, duplicates, _, keys = await cache.claim(clips)
+    
+    assert keys[0] != keys[1]
+    assert duplicates == {}
+
+async def test_least_recently_used_results_are_evicted(cache, redis_client, tmp_path, monkeypatch):
+    _, _, _, (first,) = await cache.claim([make_task(prompt="first")])
+    await cache.finish(first, await completed(cache, tmp_path, b"first"))
+    # Room for exactly one entry
+    monkeypatch.setattr(settings, "RESULT_CACHE_MAX_BYTES", int(await redis_client.get(cache.TOTAL_KEY)))
+    
+    _, _, _, (second,) = await cache.claim([make_task(prompt="second")])
+    await cache.finish(second, await completed(cache, tmp_path, b"other"))
+    
+    hits, _, _, _ = await cache.claim([make_task(prompt="first"), make_task(prompt="second")])
+    assert list(hits) == [1]
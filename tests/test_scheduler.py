@@ -0,0 +1,61 @@
+import json
+from datetime import datetime
+
+from batching.queue_backend import ListQueueBackend
+from batching.scheduler import WeightedFairScheduler
+
+QUEUES = {"premium": "scene_queue:premium", "free": "scene_queue:free"}
+WEIGHTS = {"premium": 3, "free": 1}
+
+def make_scheduler(redis_client=None, max_wait: float = 0) -> WeightedFairScheduler:
+    return WeightedFairScheduler(ListQueueBackend(redis_client), QUEUES, WEIGHTS, max_wait=max_wait)
+
+def test_contended_slots_follow_the_priority_ratio():
+    scheduler = make_scheduler()
+    served = {"premium": 0, "free": 0}
+    
+    for _ in range(100):
+        allocation = scheduler.allocate(4, {"premium": 50, "free": 50}, [])
+        assert sum(allocation.values()) == 4
+        for priority, count in allocation.items():
+            served[priority] += count
+    
+    assert served == {"premium": 300, "free": 100}
+
+def test_idle_priority_leaves_its_slots_to_the_others():
+    scheduler = make_scheduler()
+    
+    assert scheduler.allocate(8, {"premium": 0, "free": 20}, []) == {"premium": 0, "free": 8}
+    # No credit was banked while premium was idle
+    assert scheduler.deficits["premium"] == 0
+
+def test_overdue_priority_is_served_first():
+    scheduler = make_scheduler(max_wait=10)
+    
+    allocation = scheduler.allocate(4, {"premium": 50, "free": 50}, ["free"])
+    
+    # An even share of the batch goes to the overdue priority before weighted sharing
+    assert allocation["free"] >= 2
+    assert scheduler.aged["free"] == 2
+
+async def test_pop_splits_a_batch_between_queues(redis_client):
+    scheduler = make_scheduler(redis_client)
+    now = datetime.utcnow().timestamp()
+    for priority, queue in QUEUES.items():
+        await redis_client.lpush(queue, *[json.dumps({"task_id": f"{priority}-{i}", "timestamp": now}) for i in range(10)])
+    
+    tasks = await scheduler.pop(8)
+    
+    priorities = [task["task_id"].split("-")[0] for task in tasks]
+    assert (priorities.count("premium"), priorities.count("free")) == (6, 2)
+    assert scheduler.get_stats()["premium"]["served"] == 6
+
+async def test_wait_for_task_records_the_served_priority(redis_client):
+    scheduler = make_scheduler(redis_client)
+    await redis_client.lpush(QUEUES["free"], json.dumps({"task_id": "free-0", "timestamp": datetime.utcnow().timestamp()}))
+    
+    task, = await scheduler.wait_for_task(0.1)
+    
+    assert task["task_id"] == "free-0"
+    assert scheduler.get_stats()["free"]["served"] == 1
+    assert await scheduler.wait_for_task(0.1) == []
@@ -0,0 +1,150 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from batching.batching_service import BatchingService
+from batching.queue_backend import RAW
+from batching.task_codec import TaskCodec
+from config import settings
+from gpu_workers.worker_interface import GPUWorkerInterface
+
+@pytest.fixture(autouse=True)
+def fast_settings(monkeypatch):
+    monkeypatch.setattr(settings, "CALLBACK_COALESCE_WINDOW", 0.01)
+    monkeypatch.setattr(settings, "COMPOSER_ENABLED", False)
+
+@pytest.fixture
+async def service(redis_client, dispatcher):
+    """A batching service whose GPU requests get the results in gpu_worker.results."""
+    gpu_worker = GPUWorkerInterface(callback_dispatcher=dispatcher)
+    gpu_worker.results = None
+    
+    def handler(request: httpx.Request) -> httpx.Response:
+        if gpu_worker.results is None:
+            return httpx.Response(500)
+        tasks = json.loads(request.content)["tasks"]
+        return httpx.Response(200, json={"task_results": gpu_worker.results[:len(tasks)]})
+    
+    await gpu_worker.client.aclose()
+    gpu_worker.client = httpx.AsyncClient(base_url="http://gpu", transport=httpx.MockTransport(handler))
+    yield BatchingService(redis_client, gpu_worker=gpu_worker)
+    await gpu_worker.close()
+
+def make_task(task_id: str, task_type: str, depends_on=()):
+    return {
+        "task_id": task_id,
+        "task_type": task_type,
+        "priority": "free",
+        "user_id": "u1",
+        "story_id": "story-1",
+        "scene_idx": 0,
+        "prompt": f"Generate {task_id}",
+        "callback_url": "http://client/cb",
+        "depends_on": list(depends_on)
+    }
+
+STORY = [
+    make_task("00000000-0000-0000-0000-000000000001", "character"),
+    make_task("00000000-0000-0000-0000-000000000002", "scene", ["00000000-0000-0000-0000-000000000001"]),
+    make_task("00000000-0000-0000-0000-000000000003", "clip", ["00000000-0000-0000-0000-000000000002"])
+]
+
+async def queued(redis_client, task_type: str):
+    codec = TaskCodec(redis_client)
+    payloads = await redis_client.execute_command("LRANGE", settings.QUEUE_NAMES[task_type]["free"], 0, -1, **RAW)
+    return [codec.decode(payload) for payload in reversed(payloads)]
+
+async def callbacks(dispatcher, count: int):
+    """Wait for count task callbacks and return their (task_id, status)."""
+    def sent():
+        # A lone callback is posted on its own, coalesced ones as {"tasks": [...]}
+        return [task for _, body in dispatcher.requests for task in body.get("tasks", [body])]
+    
+    async with asyncio.timeout(5):
+        while len(sent()) < count:
+            await asyncio.sleep(0.01)
+    return sorted((task["task_id"], task["status"]) for task in sent())
+
+async def test_progress_counts_tasks_until_the_story_is_done(service, redis_client):
+    await service.add_tasks([dict(task) for task in STORY])
+    progress = await service.progress.get("story-1")
+    assert (progress["status"], progress["totals"]["pending"]) == ("queued", 3)
+    
+    service.gpu_worker.results = [{"status": "completed"}]
+    await service.process_batch("character", await queued(redis_client, "character"))
+    await service.process_batch("scene", await queued(redis_client, "scene"))
+    progress = await service.progress.get("story-1")
+    assert progress["status"] == "running"
+    assert progress["tasks"]["scene"] == {"total": 1, "completed": 1, "failed": 0, "pending": 0}
+    
+    service.gpu_worker.results = [{"status": "failed", "error": "out of memory"}]
+    await service.process_batch("clip", await queued(redis_client, "clip"))
+    progress = await service.progress.get("story-1")
+    assert progress["status"] == "done"
+    assert (progress["totals"]["completed"], progress["totals"]["failed"]) == (2, 1)
+    assert "finished_at" in await redis_client.hgetall(service.progress.key("story-1"))
+
+async def test_failed_batch_fails_its_dependents(service, redis_client, dispatcher):
+    await service.add_tasks([dict(task) for task in STORY])
+    
+    await service.process_batch("character", await queued(redis_client, "character"))
+    
+    assert await queued(redis_client, "scene") == []
+    progress = await service.progress.get("story-1")
+    assert progress["status"] == "done"
+    assert progress["totals"]["failed"] == 3
+    assert await callbacks(dispatcher, 3) == [(task["task_id"], "failed") for task in STORY]
+
+async def test_failed_result_fails_its_dependents(service, redis_client, dispatcher):
+    await service.add_tasks([dict(task) for task in STORY])
+    service.gpu_worker.results = [{"status": "completed"}]
+    await service.process_batch("character", await queued(redis_client, "character"))
+    
+    service.gpu_worker.results = [{"status": "failed", "error": "nsfw"}]
+    await service.process_batch("scene", await queued(redis_client, "scene"))
+    
+    assert await queued(redis_client, "clip") == []
+    assert (await service.progress.get("story-1"))["tasks"]["clip"]["failed"] == 1
+    assert (await callbacks(dispatcher, 3))[2] == (STORY[2]["task_id"], "failed")
+
+async def test_settled_batch_is_not_requeued(service, redis_client, monkeypatch):
+    await service.add_tasks([dict(task) for task in STORY])
+    character, = await queued(redis_client, "character")
+    await redis_client.delete(settings.QUEUE_NAMES["character"]["free"])
+    service.gpu_worker.results = [{"status": "completed"}]
+    
+    async def lost_ack(tasks):
+        # The GPU service goes down while the batch is being acknowledged
+        monkeypatch.setattr(service.gpu_worker.circuit_breaker, "allow_request", lambda: False)
+        raise ConnectionError("connection lost")
+    monkeypatch.setattr(service.queue_backend, "ack", lost_ack)
+    
+    await service.process_batch("character", [character])
+    
+    assert await queued(redis_client, "character") == []
+    assert len(await queued(redis_client, "scene")) == 1
+
+async def test_watchers_follow_the_story_until_done(service, redis_client):
+    await service.add_tasks([dict(STORY[0])])
+    seen = []
+    
+    async def watch():
+        async for progress in service.progress.watch("story-1", idle_timeout=5):
+            seen.append(progress["status"])
+    
+    watcher = asyncio.create_task(watch())
+    try:
+        async with asyncio.timeout(5):
+            while not seen:
+                await asyncio.sleep(0.01)
+            # Let the shared subscription start before the update is published
+            await asyncio.sleep(0.1)
+            await service.progress.record([STORY[0]], {"task_results": [{"status": "completed"}]})
+            await watcher
+    finally:
+        watcher.cancel()
+        await service.progress.stop()
+    
+    assert seen == ["queued", "done"]
@@ -0,0 +1,30 @@
+from queues.task_queue import StoryQueue
+
+async def test_enqueue_stories_returns_ids_in_input_order(redis_client):
+    queue = StoryQueue(redis_client)
+    
+    request_ids = await queue.enqueue_stories([
+        {"user_id": "u1", "prompt": "first", "priority": "paid", "callback_url": "http://cb/1"},
+        {"user_id": "u2", "prompt": "second"},
+        {"user_id": "u3", "prompt": "third", "priority": "paid"}
+    ])
+    
+    assert len(set(request_ids)) == 3
+    assert await queue.get_queue_lengths() == {"paid": 2, "free": 1}
+    story = await queue.get_next_story()
+    assert (story["request_id"], story["prompt"], story["callback_url"]) == (request_ids[0], "first", "http://cb/1")
+
+async def test_paid_stories_are_served_before_free_ones(redis_client):
+    queue = StoryQueue(redis_client)
+    free_id = await queue.enqueue_story("u1", "free story")
+    paid_id = await queue.enqueue_story("u2", "paid story", priority="paid")
+    
+    assert (await queue.get_next_story())["request_id"] == paid_id
+    assert (await queue.get_next_story())["request_id"] == free_id
+    assert await queue.get_next_story() is None
+
+async def test_empty_bulk_submission_queues_nothing(redis_client):
+    queue = StoryQueue(redis_client)
+    
+    assert await queue.enqueue_stories([]) == []
+    assert await redis_client.dbsize() == 0
@@ -0,0 +1,100 @@
+import asyncio
+import json
+
+import pytest
+
+from batching.batching_service import BatchingService
+from batching.queue_backend import StreamQueueBackend
+from config import settings
+from gpu_workers.worker_interface import GPUWorkerInterface
+
+QUEUE = settings.QUEUE_NAMES["scene"]["free"]
+STREAM = StreamQueueBackend.stream_key(QUEUE)
+
+@pytest.fixture(autouse=True)
+def fast_settings(monkeypatch):
+    monkeypatch.setattr(settings, "STREAM_CLAIM_IDLE", 0)
+    monkeypatch.setattr(settings, "STREAM_MAX_DELIVERIES", 2)
+    monkeypatch.setattr(settings, "CALLBACK_COALESCE_WINDOW", 0.01)
+
+async def make_backend(redis_client, consumer: str) -> StreamQueueBackend:
+    backend = StreamQueueBackend(redis_client, consumer=consumer)
+    await backend.setup([QUEUE])
+    return backend
+
+async def push(redis_client, backend: StreamQueueBackend, count: int):
+    async with redis_client.pipeline(transaction=False) as pipe:
+        backend.push(pipe, QUEUE, [
+            json.dumps({"task_id": f"task-{index}", "task_type": "scene", "priority": "free", "callback_url": "http://client/a"})
+            for index in range(count)
+        ])
+        await pipe.execute()
+
+async def deliver(backend: StreamQueueBackend, count: int):
+    """Read tasks as the given consumer and let them go idle."""
+    await backend.pop({QUEUE: count})
+    await asyncio.sleep(0.01)
+
+async def test_popped_tasks_stay_pending_until_acknowledged(redis_client):
+    backend = await make_backend(redis_client, "a")
+    await push(redis_client, backend, 3)
+    
+    popped = (await backend.pop({QUEUE: 2}))[QUEUE]
+    depths, oldest = await backend.inspect([QUEUE])
+    
+    assert [task["task_id"] for task in popped] == ["task-0", "task-1"]
+    assert depths == {QUEUE: 1}
+    assert oldest[QUEUE] is not None
+    
+    await backend.ack(popped)
+    assert await redis_client.xlen(STREAM) == 1
+    assert (await redis_client.xpending(STREAM, settings.STREAM_GROUP))["pending"] == 0
+
+async def test_abandoned_tasks_are_claimed_by_another_consumer(redis_client):
+    crashed = await make_backend(redis_client, "a")
+    survivor = await make_backend(redis_client, "b")
+    await push(redis_client, crashed, 2)
+    await deliver(crashed, 2)
+    
+    claimed, dead = await survivor.reclaim([QUEUE])
+    
+    assert [task["task_id"] for task in claimed] == ["task-0", "task-1"]
+    assert dead == []
+    pending = await redis_client.xpending_range(STREAM, settings.STREAM_GROUP, min="-", max="+", count=10)
+    assert {entry["consumer"] for entry in pending} == {"b"}
+
+async def test_exhausted_tasks_are_dead_lettered(redis_client):
+    backend = await make_backend(redis_client, "a")
+    await push(redis_client, backend, 1)
+    await deliver(backend, 1)
+    await backend.reclaim([QUEUE])
+    await asyncio.sleep(0.01)
+    
+    claimed, dead = await backend.reclaim([QUEUE])
+    
+    assert claimed == []
+    assert [task["task_id"] for task in dead] == ["task-0"]
+    assert await redis_client.xlen(STREAM) == 0
+    (_, fields), = await redis_client.xrange(settings.STREAM_DEAD_LETTER)
+    assert (fields["stream"], json.loads(fields["task"])["task_id"]) == (STREAM, "task-0")
+
+async def test_dead_lettered_tasks_get_failed_callbacks(redis_client, dispatcher, monkeypatch):
+    monkeypatch.setattr(settings, "QUEUE_BACKEND", "stream")
+    monkeypatch.setattr(settings, "STREAM_CLAIM_INTERVAL", 0)
+    service = BatchingService(redis_client, gpu_worker=GPUWorkerInterface(callback_dispatcher=dispatcher))
+    await service.queue_backend.setup(list(settings.QUEUE_NAMES["scene"].values()))
+    await push(redis_client, service.queue_backend, 1)
+    await deliver(service.queue_backend, 1)
+    await service.queue_backend.reclaim([QUEUE])
+    
+    loop = asyncio.create_task(service.reclaim_loop("scene"))
+    try:
+        async with asyncio.timeout(5):
+            while not dispatcher.requests:
+                await asyncio.sleep(0.01)
+    finally:
+        loop.cancel()
+        await service.gpu_worker.close()
+    
+    (_, body), = dispatcher.requests
+    assert (body["task_id"], body["status"]) == ("task-0", "failed")
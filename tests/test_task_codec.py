@@ -0,0 +1,108 @@
+import json
+import uuid
+
+import pytest
+
+from batching.task_codec import _HEADERS, VERSION, TaskCodec
+
+def make_task(**fields):
+    task = {
+        "task_id": str(uuid.uuid4()),
+        "task_type": "scene",
+        "priority": "premium",
+        "story_id": "story-1",
+        "scene_idx": 3,
+        "depends_on": [str(uuid.uuid4()), str(uuid.uuid4())],
+        "prompt": "A dragon circles the tower. 🐉",
+        "timestamp": 1700000000.123456,
+        "user_id": "user-1",
+        "callback_url": "http://client/cb",
+        "style": {"palette": "dusk"}
+    }
+    task.update(fields)
+    return task
+
+async def test_round_trip_restores_every_field(redis_client):
+    codec = TaskCodec(redis_client)
+    task = make_task()
+    
+    async with redis_client.pipeline(transaction=True) as pipe:
+        codec.stage_metadata(pipe, [task])
+        await pipe.execute()
+    payload = codec.encode(task)
+    (inflated,), orphaned = await codec.inflate([codec.decode(payload)])
+    
+    assert payload[0] == VERSION
+    assert orphaned == []
+    assert inflated == {key: value for key, value in task.items() if key != "meta_id"}
+
+def test_story_fields_are_not_in_the_payload(redis_client):
+    codec = TaskCodec(redis_client)
+    
+    payload = codec.encode(make_task())
+    
+    assert b"http://client/cb" not in payload
+    assert len(payload) < len(json.dumps(make_task()))
+
+def test_timestamp_is_read_without_decoding(redis_client):
+    codec = TaskCodec(redis_client)
+    
+    assert codec.timestamp(codec.encode(make_task())) == pytest.approx(1700000000.123456)
+
+def test_unmodified_task_keeps_its_payload(redis_client):
+    codec = TaskCodec(redis_client)
+    payload = codec.encode(make_task())
+    task = codec.decode(payload)
+    
+    # Tags like the stream position don't change the payload, real fields do
+    task["_stream_id"] = "1-0"
+    assert codec.encode(task) is payload
+    task["scene_idx"] = 4
+    assert codec.decode(codec.encode(task))["scene_idx"] == 4
+
+def test_scene_idx_holds_book_length_stories(redis_client):
+    codec = TaskCodec(redis_client)
+    
+    assert codec.decode(codec.encode(make_task(scene_idx=70000)))["scene_idx"] == 70000
+
+def test_version_1_payloads_are_decoded(redis_client):
+    codec = TaskCodec(redis_client)
+    task = make_task()
+    payload = codec.encode(task)
+    
+    # Version 1 differs only in its 16-bit scene_idx
+    fields = _HEADERS[VERSION].unpack_from(payload)
+    legacy = _HEADERS[1].pack(1, *fields[1:]) + payload[_HEADERS[VERSION].size:]
+    decoded = codec.decode(legacy)
+    
+    assert {key: decoded[key] for key in ("task_id", "scene_idx", "depends_on", "story_id", "prompt")} == {
+        key: task[key] for key in ("task_id", "scene_idx", "depends_on", "story_id", "prompt")
+    }
+    assert decoded["style"] == task["style"]
+    assert codec.timestamp(legacy) == pytest.approx(task["timestamp"])
+
+def test_legacy_json_tasks_are_accepted(redis_client):
+    codec = TaskCodec(redis_client)
+    task = {"task_id": "t1", "timestamp": 12.5}
+    
+    assert codec.decode(json.dumps(task)) == task
+    assert codec.timestamp(json.dumps(task)) == 12.5
+
+def test_unknown_version_is_rejected(redis_client):
+    payload = bytes([VERSION + 1]) + TaskCodec(redis_client).encode(make_task())[1:]
+    
+    with pytest.raises(ValueError):
+        TaskCodec(redis_client).decode(payload)
+
+async def test_expired_metadata_is_reported(redis_client):
+    codec = TaskCodec(redis_client)
+    task = make_task()
+    async with redis_client.pipeline(transaction=True) as pipe:
+        codec.stage_metadata(pipe, [task])
+        await pipe.execute()
+    await redis_client.delete(codec.meta_key(task["meta_id"]))
+    
+    (inflated,), orphaned = await codec.inflate([codec.decode(codec.encode(task))])
+    
+    assert orphaned == [0]
+    assert "callback_url" not in inflated
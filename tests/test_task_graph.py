@@ -0,0 +1,87 @@
+import uuid
+
+from batching.batching_service import BatchingService
+from batching.queue_backend import RAW
+from batching.task_codec import TaskCodec
+from batching.task_graph import TaskGraph
+from config import settings
+
+def task_id(name: str) -> str:
+    """A stable task ID for a readable name."""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, name))
+
+def make_task(name: str, task_type: str, depends_on=()):
+    return {
+        "task_id": task_id(name),
+        "task_type": task_type,
+        "priority": "free",
+        "story_id": "story-1",
+        "depends_on": [task_id(parent) for parent in depends_on]
+    }
+
+async def queued_ids(redis_client, task_type: str):
+    """Names of the tasks in a queue, oldest first."""
+    codec = TaskCodec(redis_client)
+    names = {task_id(name): name for name in ("char", "a", "b", "scene", "clip")}
+    payloads = await redis_client.execute_command("LRANGE", settings.QUEUE_NAMES[task_type]["free"], 0, -1, **RAW)
+    return [names[codec.decode(payload)["task_id"]] for payload in reversed(payloads)]
+
+async def test_completing_a_task_releases_its_dependents(redis_client):
+    service = BatchingService(redis_client)
+    await service.add_tasks([
+        make_task("char", "character"),
+        make_task("scene", "scene", ["char"]),
+        make_task("clip", "clip", ["scene"])
+    ])
+    assert await queued_ids(redis_client, "character") == ["char"]
+    
+    assert await service.task_graph.complete([make_task("char", "character")]) == 1
+    assert await queued_ids(redis_client, "scene") == ["scene"]
+    assert await queued_ids(redis_client, "clip") == []
+    
+    assert await service.task_graph.complete([make_task("scene", "scene")]) == 1
+    assert await queued_ids(redis_client, "clip") == ["clip"]
+
+async def test_task_waits_for_all_of_its_dependencies(redis_client):
+    service = BatchingService(redis_client)
+    await service.add_tasks([
+        make_task("a", "character"),
+        make_task("b", "character"),
+        make_task("scene", "scene", ["a", "b"])
+    ])
+    
+    assert await service.task_graph.complete([make_task("a", "character")]) == 0
+    assert await queued_ids(redis_client, "scene") == []
+    assert await service.task_graph.complete([make_task("b", "character")]) == 1
+    assert await queued_ids(redis_client, "scene") == ["scene"]
+
+async def test_released_tasks_leave_no_graph_state(redis_client):
+    service = BatchingService(redis_client)
+    await service.add_tasks([make_task("char", "character"), make_task("scene", "scene", ["char"])])
+    
+    await service.task_graph.complete([make_task("char", "character")])
+    
+    for key in TaskGraph._keys("story-1"):
+        assert not await redis_client.exists(key)
+    # Completing a task twice releases nothing more
+    assert await service.task_graph.complete([make_task("char", "character")]) == 0
+
+async def test_failing_a_task_removes_its_dependents(redis_client):
+    service = BatchingService(redis_client)
+    await service.add_tasks([
+        make_task("a", "character"),
+        make_task("b", "character"),
+        make_task("scene", "scene", ["a", "b"]),
+        make_task("clip", "clip", ["scene"])
+    ])
+    
+    dependent, = await service.task_graph.fail([make_task("a", "character")])
+    assert (dependent["task_id"], dependent["task_type"]) == (task_id("scene"), "scene")
+    # The scene's other parent finishing no longer releases it
+    assert await service.task_graph.complete([make_task("b", "character")]) == 0
+    assert await queued_ids(redis_client, "scene") == []
+    
+    dependent, = await service.task_graph.fail([dependent])
+    assert dependent["task_id"] == task_id("clip")
+    for key in TaskGraph._keys("story-1"):
+        assert await redis_client.hlen(key) == 0
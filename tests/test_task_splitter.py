@@ -0,0 +1,125 @@
+import uuid
+
+from batching.batching_service import BatchingService
+from batching.queue_backend import RAW
+from batching.task_codec import TaskCodec
+from config import settings
+from ingestion.task_splitter import TaskSplitter, iter_paragraphs
+
+STORY = "A knight rides out at dawn.\n\nA dragon circles the tower.\n\n"
+
+async def queued(redis_client, task_type: str, priority: str = "free"):
+    """Tasks in a queue with their story-level fields, oldest first."""
+    codec = TaskCodec(redis_client)
+    payloads = await redis_client.execute_command("LRANGE", settings.QUEUE_NAMES[task_type][priority], 0, -1, **RAW)
+    tasks, _ = await codec.inflate([codec.decode(payload) for payload in reversed(payloads)])
+    return tasks
+
+async def chunks(text: str, size: int):
+    data = text.encode()
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+async def test_story_is_split_into_a_task_chain_per_scene(redis_client):
+    splitter = TaskSplitter(BatchingService(redis_client))
+    
+    result = await splitter.process_story({
+        "user_id": "u1",
+        "priority": "free",
+        "story_id": "story-1",
+        "content": STORY,
+        "callback_url": "http://cb"
+    })
+    
+    assert result["story_id"] == "story-1"
+    # Neither scene names a character, so both share the protagonist's reference
+    assert len(result["task_ids"]) == 5
+    characters = await queued(redis_client, "character")
+    assert [task["scene_idx"] for task in characters] == [0]
+    assert {task["story_id"] for task in characters} == {"story-1"}
+    # Scenes and clips wait in the story's task graph for their dependencies
+    assert await queued(redis_client, "scene") == []
+    assert await queued(redis_client, "clip") == []
+
+async def test_add_tasks_stamps_one_enqueue_time(redis_client):
+    service = BatchingService(redis_client)
+    tasks = [
+        {"task_id": str(uuid.uuid4()), "task_type": "character", "priority": "premium", "story_id": "story-1"},
+        {"task_id": str(uuid.uuid4()), "task_type": "clip", "priority": "free", "story_id": "story-1"}
+    ]
+    
+    await service.add_tasks(tasks)
+    
+    character, = await queued(redis_client, "character", "premium")
+    clip, = await queued(redis_client, "clip", "free")
+    assert character["timestamp"] == clip["timestamp"]
+
+async def test_cached_character_is_not_generated_again(redis_client, monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "CHARACTER_CACHE_DIR", str(tmp_path))
+    splitter = TaskSplitter(BatchingService(redis_client))
+    cache_key = splitter.character_cache.cache_key("story-1", "Character reference of the protagonist")
+    with open(splitter.character_cache.reference_path(cache_key), "wb") as f:
+        f.write(b"png")
+    await splitter.character_cache.register_results([{"task_type": "character", "cache_key": cache_key}])
+    
+    result = await splitter.process_story({
+        "user_id": "u1",
+        "priority": "free",
+        "story_id": "story-1",
+        "content": STORY,
+        "callback_url": "http://cb"
+    })
+    
+    assert len(result["task_ids"]) == 4
+    assert await queued(redis_client, "character") == []
+    # With the reference already on disk, scenes are runnable straight away
+    assert [task["scene_idx"] for task in await queued(redis_client, "scene")] == [0, 1]
+
+async def test_scene_waits_for_every_character_it_names(redis_client):
+    service = BatchingService(redis_client)
+    splitter = TaskSplitter(service)
+    
+    await splitter.process_story({
+        "user_id": "u1",
+        "priority": "free",
+        "story_id": "story-1",
+        "content": "At dawn Alice meets Bob by the river.",
+        "callback_url": "http://cb"
+    })
+    
+    alice, bob = await queued(redis_client, "character")
+    assert (alice["prompt"], bob["prompt"]) == ("Character reference of Alice", "Character reference of Bob")
+    assert await service.task_graph.complete([alice]) == 0
+    assert await queued(redis_client, "scene") == []
+    assert await service.task_graph.complete([bob]) == 1
+    scene, = await queued(redis_client, "scene")
+    assert scene["reference_image"] == splitter.character_cache.reference_path(alice["cache_key"])
+
+async def test_paragraphs_survive_any_chunking():
+    text = "Café au lait.\r\n\r\nA dragon 🐉 circles.\n \nThe end"
+    
+    for size in (1, 2, 3, 7, 100):
+        assert [paragraph async for paragraph in iter_paragraphs(chunks(text, size))] == [
+            "Café au lait.", "A dragon 🐉 circles.", "The end"
+        ]
+
+async def test_overlong_paragraph_is_cut_at_whitespace(monkeypatch):
+    monkeypatch.setattr(settings, "STORY_STREAM_MAX_PARAGRAPH", 10)
+    
+    assert [paragraph async for paragraph in iter_paragraphs(chunks("one two three four", 4))] == ["one two", "three", "four"]
+
+async def test_streamed_story_is_enqueued_in_groups(redis_client, monkeypatch):
+    monkeypatch.setattr(settings, "STORY_STREAM_ENQUEUE_SCENES", 1)
+    service = BatchingService(redis_client)
+    splitter = TaskSplitter(service)
+    
+    result = await splitter.process_story_stream(
+        {"user_id": "u1", "priority": "free", "story_id": "story-1", "callback_url": "http://cb"},
+        chunks(STORY + "Later the knight returns.", 5)
+    )
+    
+    assert (result["scene_count"], result["task_count"]) == (3, 7)
+    # Every scene features the protagonist, whose one character task gates them all
+    character, = await queued(redis_client, "character")
+    assert await service.task_graph.complete([character]) == 3
+    assert [task["scene_idx"] for task in await queued(redis_client, "scene")] == [0, 1, 2]
@@ -0,0 +1,98 @@
+import os
+import sys
+
+import pytest
+
+from composer.video_composer import VideoComposer
+from config import settings
+from gpu_workers.artifact_store import ArtifactStore
+
+# ffmpeg writes a placeholder to its output file; ffprobe reports a fixed duration
+FAKE_FFMPEG = """import sys
+if sys.argv[0].endswith("ffprobe"):
+    print("2.5")
+else:
+    with open(sys.argv[-1], "wb") as f:
+        f.write(b"segment")
+"""
+
+@pytest.fixture
+async def composer(redis_client, dispatcher, tmp_path, monkeypatch):
+    for tool in ("ffmpeg", "ffprobe"):
+        path = tmp_path / "bin" / tool
+        os.makedirs(path.parent, exist_ok=True)
+        path.write_text(f"#!{sys.executable}\n{FAKE_FFMPEG}")
+        path.chmod(0o755)
+    monkeypatch.setattr(settings, "FFMPEG_PATH", str(tmp_path / "bin" / "ffmpeg"))
+    monkeypatch.setattr(settings, "FFPROBE_PATH", str(tmp_path / "bin" / "ffprobe"))
+    monkeypatch.setattr(settings, "COMPOSER_DIR", str(tmp_path / "videos"))
+    store = ArtifactStore(redis_client, str(tmp_path / "artifacts"))
+    return VideoComposer(redis_client, artifact_store=store, callback_dispatcher=dispatcher)
+
+async def stage(composer, redis_client, scenes: int):
+    tasks = [
+        {"task_type": "clip", "story_id": "story", "scene_idx": scene_idx, "callback_url": "http://client/cb"}
+        for scene_idx in range(scenes)
+    ]
+    async with redis_client.pipeline(transaction=True) as pipe:
+        composer.stage_scenes(pipe, tasks)
+        await pipe.execute()
+    return tasks
+
+async def complete(composer, task, failed: bool = False):
+    if failed:
+        result = {"status": "failed", "error": "boom"}
+    else:
+        clip = os.path.join(os.path.dirname(composer.artifact_store.root), "clips", f"clip_{task['scene_idx']}.mp4")
+        os.makedirs(os.path.dirname(clip), exist_ok=True)
+        with open(clip, "wb") as f:
+            f.write(f"clip {task['scene_idx']}".encode())
+        result = {"status": "completed", "artifact": await composer.artifact_store.put_file(clip)}
+    composer.on_clips_completed([task], {"task_results": [result]})
+    await composer.stop()
+
+def playlist(composer) -> str:
+    with open(composer.playlist_path("story")) as f:
+        return f.read()
+
+async def test_scenes_are_published_in_order(composer, redis_client):
+    tasks = await stage(composer, redis_client, 3)
+    
+    await complete(composer, tasks[1])
+    assert (await composer.get_status("story"))["scenes_published"] == 0
+    assert not os.path.exists(composer.playlist_path("story"))
+    
+    await complete(composer, tasks[0])
+    status = await composer.get_status("story")
+    assert (status["scenes_published"], status["playlist"]) == (2, composer.playlist_path("story"))
+    assert "#EXT-X-PLAYLIST-TYPE:EVENT" in playlist(composer)
+    assert "scene_00000.ts" in playlist(composer) and "scene_00001.ts" in playlist(composer)
+    assert "#EXT-X-ENDLIST" not in playlist(composer)
+
+async def test_finished_story_gets_its_video(composer, redis_client, dispatcher):
+    tasks = await stage(composer, redis_client, 2)
+    
+    await complete(composer, tasks[0])
+    await complete(composer, tasks[1])
+    await dispatcher.stop()
+    
+    assert "#EXT-X-PLAYLIST-TYPE:VOD" in playlist(composer)
+    assert playlist(composer).rstrip().endswith("#EXT-X-ENDLIST")
+    (url, body), = dispatcher.requests
+    assert (url, body["story_id"], body["status"]) == ("http://client/cb", "story", "video_ready")
+    assert os.path.exists(composer.artifact_store.resolve(body["video"]))
+
+async def test_failed_clips_are_skipped(composer, redis_client):
+    tasks = await stage(composer, redis_client, 2)
+    
+    await complete(composer, tasks[0], failed=True)
+    await complete(composer, tasks[1])
+    
+    assert "scene_00000.ts" not in playlist(composer)
+    assert "scene_00001.ts" in playlist(composer)
+    assert (await composer.get_status("story"))["scenes_published"] == 2
+
+def test_story_dir_refuses_paths(composer):
+    for story_id in ("../x", "a/b", "..", ""):
+        with pytest.raises(ValueError):
+            composer.story_dir(story_id)
@@ -0,0 +1,62 @@
+import json
+import os
+
+import pytest
+
+from config import settings
+from gpu_workers.workflow_templates import WorkflowRegistry, WorkflowTemplate
+
+WORKFLOW = os.path.join(settings.WORKFLOW_DIR, "mv_adapter_workflow.json")
+
+@pytest.fixture
+def template():
+    return WorkflowTemplate.load(WORKFLOW)
+
+def make_task(task_id: str, prompt: str = "a knight", **fields):
+    return {"task_id": task_id, "task_type": "scene", "prompt": prompt, **fields}
+
+def nodes_of(graph, class_type: str):
+    return [node for node in graph.values() if node["class_type"] == class_type]
+
+def test_substitution_points_are_found_from_the_sampler(template):
+    assert (template.sampler, template.positive, template.negative, template.latent) == ("6", "2", "3", "7")
+    assert template.references == ["1"]
+    assert set(template.shared_nodes) == {"4", "5"}
+    assert template.defaults["width"] == 1024
+
+def test_broken_workflows_are_rejected():
+    with open(WORKFLOW) as f:
+        graph = json.load(f)
+    graph["8"]["inputs"]["samples"] = ["99", 0]
+    with pytest.raises(ValueError, match="missing node"):
+        WorkflowTemplate("dangling", graph)
+    
+    graph["8"]["inputs"]["samples"] = ["6", 0]
+    graph["2"]["inputs"]["clip"] = ["8", 0]
+    with pytest.raises(ValueError, match="cycle"):
+        WorkflowTemplate("cyclic", graph)
+
+def test_identical_conditioning_shares_a_latent_batch(template, monkeypatch):
+    monkeypatch.setattr(settings, "WORKFLOW_MAX_BATCH_SIZE", 2)
+    
+    job = template.render([make_task("t1"), make_task("t2"), make_task("t3"), make_task("t4", "a dragon")])
+    graph = job["prompt"]
+    
+    # Loaders appear once, each branch of at most two images gets its own sampler
+    assert len(nodes_of(graph, "CheckpointLoaderSimple")) == 1
+    assert sorted(node["inputs"]["batch_size"] for node in nodes_of(graph, "EmptyLatentImage")) == [1, 1, 2]
+    prompts = [graph[f"2_{index}"]["inputs"]["text"] for index in range(1, 4)]
+    assert sorted(prompts) == ["a dragon", "a knight", "a knight"]
+    assert (job["outputs"]["t1"]["node"], job["outputs"]["t2"]["batch_index"]) == (job["outputs"]["t2"]["node"], 1)
+
+def test_registry_groups_by_settings_and_leaves_clips_to_the_gpu_service():
+    registry = WorkflowRegistry()
+    
+    jobs = registry.compile_batch([
+        make_task("t1"),
+        make_task("t2", width=512),
+        make_task("t3", "a dragon"),
+        {"task_id": "c1", "task_type": "clip", "prompt": "a knight"}
+    ])
+    
+    assert sorted(job["task_ids"] for job in jobs) == [["t1", "t3"], ["t2"]]
@@ -1,52 +1,58 @@
 import asyncio
 import logging
-from typing import Dict, Any, List
-from queue.task_queue import StoryQueue
-from batching.batch_controller import BatchController
+import time
+from collections import deque
+from typing import Dict, Any, Optional
+from queues.task_queue import StoryQueue
+from ingestion.task_splitter import TaskSplitter
+from batching.batching_service import BatchingService
+import metrics
 
 logger = logging.getLogger(__name__)
 
 class AgenticWorker:
-    def __init__(self, worker_id: str, redis_url: str = "redis://localhost:6379"):
+    def __init__(self, worker_id: str, queue: StoryQueue, task_splitter: Optional[TaskSplitter] = None):
         self.worker_id = worker_id
-        self.queue = StoryQueue(redis_url)
-        self.batch_controller = BatchController()
+        self.queue = queue
+        # Workers of a pool share one splitter (and batching service)
+        self.task_splitter = task_splitter or TaskSplitter(BatchingService())
         self.is_running = False
+        self.busy = False
+        # Recent per-story processing times, read by the autoscaler
+        self.latencies: deque = deque(maxlen=100)
         
     async def process_story(self, story_request: Dict[str, Any]) -> None:
         """Process a single story request."""
+        started = time.monotonic()
+        self.busy = True
         try:
             logger.info(f"Worker {self.worker_id} processing story {story_request['request_id']}")
+            if not story_request.get("callback_url"):
+                logger.error(f"Story {story_request['request_id']} has no callback_url, dropping it")
+                return
             
-            # TODO: Replace with actual MMStoryAgent call
-            # For now, we'll create a mock story plan
-            story_plan = {
-                "scenes": [
-                    {
-                        "scene_id": i,
-                        "description": f"Scene {i} for story {story_request['request_id']}",
-                        "characters": ["character1", "character2"],
-                        "task_type": "image_generation"
-                    }
-                    for i in range(1, 13)  # 12 scenes per story
-                ]
-            }
-            
-            # Send each scene to the batch controller
-            for scene in story_plan["scenes"]:
-                await self.batch_controller.add_task(
-                    request_id=story_request["request_id"],
-                    scene_id=scene["scene_id"],
-                    task_type=scene["task_type"],
-                    character_ids=scene["characters"],
-                    scene_description=scene["description"]
-                )
+            # TODO: Plan scenes with MMStoryAgent; for now the text is split into scenes by paragraph
+            result = await self.task_splitter.process_story({
+                "user_id": story_request["user_id"],
+                "priority": "premium" if story_request["priority"] in ("paid", "premium") else "free",
+                # Stories queued as JSON are tracked under their request ID
+                "story_id": story_request["request_id"],
+                "content": story_request["prompt"],
+                "callback_url": story_request["callback_url"]
+            })
                 
-            logger.info(f"Worker {self.worker_id} completed story {story_request['request_id']}")
+            self.latencies.append(time.monotonic() - started)
+            logger.info(
+                f"Worker {self.worker_id} completed story {story_request['request_id']} "
+                f"({len(result['task_ids'])} tasks)"
+            )
             
         except Exception as e:
             logger.error(f"Error processing story {story_request['request_id']}: {str(e)}")
             # TODO: Implement retry logic or error handling
+        finally:
+            self.busy = False
+            metrics.WORKER_BUSY_SECONDS.inc(time.monotonic() - started)
             
     async def run(self):
         """Main worker loop."""
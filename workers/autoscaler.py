@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from typing import Dict, Any, Deque, Optional
+
+from config import settings
+from queues.task_queue import StoryQueue
+
+logger = logging.getLogger(__name__)
+
+class WorkerAutoscaler:
+    """
+    Sizes a worker pool from the story backlog.
+    
+    Every AUTOSCALE_INTERVAL seconds the autoscaler reads the story queue
+    depths and the pool's recent per-story processing time and computes the
+    number of workers needed to drain the backlog within
+    AUTOSCALE_TARGET_DRAIN_TIME, clamped to
+    [AUTOSCALE_MIN_WORKERS, AUTOSCALE_MAX_WORKERS]. To avoid flapping:
+    
+    - It scales up as soon as more workers are needed, but only scales down
+      once the desired size falls below AUTOSCALE_DOWN_RATIO of the pool.
+    - Scale-ups and scale-downs each have their own cooldown since the last
+      change.
+    
+    Works with any pool exposing get_active_workers(), get_story_latencies()
+    and scale_workers().
+    """
+    
+    def __init__(self, worker_pool, story_queue: StoryQueue):
+        self.worker_pool = worker_pool
+        self.story_queue = story_queue
+        self.min_workers = settings.AUTOSCALE_MIN_WORKERS
+        self.max_workers = settings.AUTOSCALE_MAX_WORKERS
+        self.decisions: Deque[Dict[str, Any]] = deque(maxlen=settings.AUTOSCALE_HISTORY)
+        self.last_scaled = 0.0
+        self.task: Optional[asyncio.Task] = None
+    
+    async def start(self):
+        """Start the autoscaling loop."""
+        if self.task is None:
+            self.task = asyncio.create_task(self._loop())
+    
+    async def stop(self):
+        """Stop the autoscaling loop."""
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+    
+    async def _loop(self):
+        """Periodically evaluate and apply a scaling decision."""
+        while True:
+            await asyncio.sleep(settings.AUTOSCALE_INTERVAL)
+            try:
+                await self.evaluate()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error in worker autoscaler: {str(e)}")
+    
+    def _story_latency(self) -> float:
+        """Mean recent per-story processing time, or the configured default before any are observed."""
+        latencies = self.worker_pool.get_story_latencies()
+        if not latencies:
+            return settings.AUTOSCALE_DEFAULT_LATENCY
+        return sum(latencies) / len(latencies)
+    
+    async def evaluate(self) -> Dict[str, Any]:
+        """
+        Decide on and apply the pool size for the current backlog.
+        
+        Returns:
+            The recorded decision
+        """
+        queue_lengths = await self.story_queue.get_queue_lengths()
+        backlog = sum(queue_lengths.values())
+        latency = self._story_latency()
+        current = self.worker_pool.get_active_workers()
+        
+        needed = math.ceil(backlog * latency / settings.AUTOSCALE_TARGET_DRAIN_TIME)
+        desired = max(self.min_workers, min(needed, self.max_workers))
+        since_last = time.monotonic() - self.last_scaled
+        
+        if desired > current:
+            if since_last >= settings.AUTOSCALE_UP_COOLDOWN:
+                action = "scale_up"
+            else:
+                action = "hold_cooldown"
+        elif desired < current and (desired < current * settings.AUTOSCALE_DOWN_RATIO or current > self.max_workers):
+            if since_last >= settings.AUTOSCALE_DOWN_COOLDOWN:
+                action = "scale_down"
+            else:
+                action = "hold_cooldown"
+        else:
+            action = "hold"
+        
+        decision = {
+            "timestamp": time.time(),
+            "queue_lengths": queue_lengths,
+            "story_latency": latency,
+            "current_workers": current,
+            "desired_workers": desired,
+            "action": action
+        }
+        self.decisions.append(decision)
+        
+        if action in ("scale_up", "scale_down"):
+            logger.info(
+                f"Autoscaler {action.replace('_', ' ')} from {current} to {desired} workers "
+                f"(backlog {backlog}, {latency:.2f}s per story)"
+            )
+            await self.worker_pool.scale_workers(desired)
+            self.last_scaled = time.monotonic()
+        return decision
+    
+    def get_status(self) -> Dict[str, Any]:
+        """Current pool size, bounds and recent decisions for inspection."""
+        return {
+            "enabled": self.task is not None,
+            "active_workers": self.worker_pool.get_active_workers(),
+            "min_workers": self.min_workers,
+            "max_workers": self.max_workers,
+            "decisions": list(self.decisions)
+        }
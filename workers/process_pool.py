@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import multiprocessing
+import signal
+from typing import List, Dict, Optional
+
+import metrics
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+def _run_worker_process(process_id: str, num_workers: int, stop_event, busy_seconds):
+    """Entry point of a worker process: run num_workers AgenticWorkers until told to stop."""
+    logging.basicConfig(level=logging.INFO)
+    # Busy time is added to the pool's shared total, which the parent's /metrics reports
+    metrics.share(metrics.WORKER_BUSY_SECONDS, busy_seconds)
+    # The parent owns shutdown: ignore Ctrl-C and treat SIGTERM as a drain request
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+    asyncio.run(_worker_process_main(process_id, num_workers, stop_event))
+
+async def _worker_process_main(process_id: str, num_workers: int, stop_event):
+    """Run a process's workers on one shared StoryQueue and drain them on stop."""
+    # Imported here so the parent process doesn't build Redis clients for its children
+    from queues.task_queue import StoryQueue
+    from workers.agentic_worker import AgenticWorker
+    from ingestion.task_splitter import TaskSplitter
+    from batching.batching_service import BatchingService
+    from redis_pool import close_redis
+    
+    story_queue = StoryQueue()
+    task_splitter = TaskSplitter(BatchingService())
+    workers = [AgenticWorker(f"{process_id}-worker-{i+1}", story_queue, task_splitter) for i in range(num_workers)]
+    tasks = [asyncio.create_task(worker.run()) for worker in workers]
+    logger.info(f"Worker process {process_id} started {num_workers} workers")
+    
+    while not stop_event.is_set():
+        await asyncio.sleep(settings.WORKER_SUPERVISE_INTERVAL)
+    
+    # Let in-flight stories finish, then cancel whatever is still running
+    for worker in workers:
+        await worker.stop()
+    done, pending = await asyncio.wait(tasks, timeout=settings.WORKER_DRAIN_TIMEOUT)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await close_redis()
+    logger.info(f"Worker process {process_id} drained ({len(pending)} workers cancelled)")
+
+class ProcessWorkerPool:
+    """
+    Runs AgenticWorkers in a pool of separate processes.
+    
+    Each of the pool's processes runs workers_per_process async workers with
+    its own event loop and Redis connection pool, so CPU-bound story planning
+    scales with cores and never competes with API request handling. A
+    supervisor task restarts processes that exit unexpectedly (with backoff),
+    and stop() asks every process to drain its in-flight stories before
+    terminating it.
+    """
+    
+    def __init__(self, num_processes: int = 2, workers_per_process: int = 5):
+        self.num_processes = num_processes
+        self.workers_per_process = workers_per_process
+        self.context = multiprocessing.get_context("spawn")
+        self.processes: Dict[str, multiprocessing.Process] = {}
+        self.stop_events: Dict[str, multiprocessing.Event] = {}
+        self.restarts: Dict[str, int] = {}
+        self.next_process_index = 0
+        self.supervisor_task: Optional[asyncio.Task] = None
+        self.is_running = False
+        # Busy seconds of every worker process, rendered as WORKER_BUSY_SECONDS
+        self.busy_seconds = self.context.Value("d", 0.0)
+        metrics.share(metrics.WORKER_BUSY_SECONDS, self.busy_seconds)
+    
+    def _spawn(self, process_id: Optional[str] = None) -> str:
+        """Start one worker process."""
+        if process_id is None:
+            self.next_process_index += 1
+            process_id = f"process-{self.next_process_index}"
+        
+        stop_event = self.context.Event()
+        process = self.context.Process(
+            target=_run_worker_process,
+            args=(process_id, self.workers_per_process, stop_event, self.busy_seconds),
+            name=f"storee-{process_id}",
+            daemon=False
+        )
+        process.start()
+        self.processes[process_id] = process
+        self.stop_events[process_id] = stop_event
+        logger.info(f"Started worker process {process_id} (pid {process.pid})")
+        return process_id
+    
+    async def _retire(self, process_id: str):
+        """Drain and stop one worker process."""
+        process = self.processes.pop(process_id)
+        # Hold the event until the process exits: dropping the last reference unlinks its
+        # semaphore, and a child that is still starting up then fails to unpickle it
+        stop_event = self.stop_events.pop(process_id)
+        stop_event.set()
+        self.restarts.pop(process_id, None)
+        
+        loop = asyncio.get_running_loop()
+        # Allow the drain plus a little time for the process to exit
+        await loop.run_in_executor(None, process.join, settings.WORKER_DRAIN_TIMEOUT + 5)
+        if process.is_alive():
+            logger.warning(f"Worker process {process_id} did not drain in time, terminating")
+            process.terminate()
+            await loop.run_in_executor(None, process.join, 5)
+        if process.is_alive():
+            # SIGTERM only sets the stop event, which a child stuck in CPU-bound work never checks
+            logger.warning(f"Worker process {process_id} ignored SIGTERM, killing")
+            process.kill()
+            await loop.run_in_executor(None, process.join)
+    
+    async def start(self):
+        """Start all worker processes and the supervisor."""
+        logger.info(
+            f"Starting process worker pool with {self.num_processes} processes "
+            f"x {self.workers_per_process} workers"
+        )
+        self.is_running = True
+        for _ in range(self.num_processes):
+            self._spawn()
+        self.supervisor_task = asyncio.create_task(self._supervise())
+    
+    async def _supervise(self):
+        """Restart worker processes that exited while the pool is running."""
+        while self.is_running:
+            await asyncio.sleep(settings.WORKER_SUPERVISE_INTERVAL)
+            for process_id, process in list(self.processes.items()):
+                if process.is_alive() or self.stop_events[process_id].is_set():
+                    continue
+                
+                restarts = self.restarts.get(process_id, 0)
+                logger.error(
+                    f"Worker process {process_id} exited with code {process.exitcode}, "
+                    f"restarting (restart #{restarts + 1})"
+                )
+                # Back off exponentially when a process keeps crashing
+                await asyncio.sleep(min(settings.WORKER_RESTART_BACKOFF * 2 ** restarts, settings.WORKER_RESTART_MAX_BACKOFF))
+                if not self.is_running or process_id not in self.processes:
+                    continue
+                self._spawn(process_id)
+                self.restarts[process_id] = restarts + 1
+    
+    async def stop(self):
+        """Drain and stop all worker processes."""
+        logger.info("Stopping process worker pool")
+        self.is_running = False
+        if self.supervisor_task is not None:
+            self.supervisor_task.cancel()
+            await asyncio.gather(self.supervisor_task, return_exceptions=True)
+            self.supervisor_task = None
+        
+        await asyncio.gather(*(self._retire(process_id) for process_id in list(self.processes)))
+        logger.info("Process worker pool stopped successfully")
+    
+    def get_active_workers(self) -> int:
+        """Get the number of workers in live processes."""
+        return sum(process.is_alive() for process in self.processes.values()) * self.workers_per_process
+    
+    def get_story_latencies(self) -> List[float]:
+        """Per-story processing times live in the worker processes and are not reported here."""
+        return []
+    
+    def get_busy_workers(self) -> Optional[int]:
+        """Busy workers live in the worker processes and are not reported here."""
+        return None
+    
+    async def scale_workers(self, new_count: int):
+        """Scale to the number of processes needed for new_count workers."""
+        target = max(1, -(-new_count // self.workers_per_process))
+        current = len(self.processes)
+        
+        if target > current:
+            for _ in range(target - current):
+                self._spawn()
+        elif target < current:
+            # Retire the newest processes first
+            to_retire = list(self.processes)[target:]
+            await asyncio.gather(*(self._retire(process_id) for process_id in to_retire))
+        
+        self.num_processes = target
+        logger.info(f"Scaled process worker pool from {current} to {target} processes")
@@ -1,29 +1,54 @@
 import asyncio
 import logging
-from typing import List, Dict
+from typing import List, Dict, Optional
+from config import settings
+from queues.task_queue import StoryQueue
 from workers.agentic_worker import AgenticWorker
+from ingestion.task_splitter import TaskSplitter
 
 logger = logging.getLogger(__name__)
 
 class WorkerPool:
-    def __init__(self, num_workers: int = 5, redis_url: str = "redis://localhost:6379"):
+    def __init__(
+        self,
+        num_workers: int = 5,
+        story_queue: Optional[StoryQueue] = None,
+        task_splitter: Optional[TaskSplitter] = None
+    ):
         self.num_workers = num_workers
-        self.redis_url = redis_url
+        # All workers share one StoryQueue and therefore one Redis connection pool
+        self.story_queue = story_queue or StoryQueue()
+        self.task_splitter = task_splitter
         self.workers: Dict[str, AgenticWorker] = {}
-        self.tasks: List[asyncio.Task] = []
+        self.tasks: Dict[str, asyncio.Task] = {}
+        # Worker IDs are never reused, even after scale-down
+        self.next_worker_index = 0
+        
+    def _add_worker(self) -> str:
+        """Create a worker and start it in the background."""
+        self.next_worker_index += 1
+        worker_id = f"worker-{self.next_worker_index}"
+        worker = AgenticWorker(worker_id, self.story_queue, self.task_splitter)
+        self.workers[worker_id] = worker
+        self.tasks[worker_id] = asyncio.create_task(worker.run())
+        return worker_id
+        
+    async def _remove_worker(self, worker_id: str):
+        """Stop a worker, let it finish its current story and reclaim its task."""
+        worker = self.workers.pop(worker_id)
+        task = self.tasks.pop(worker_id)
+        await worker.stop()
+        try:
+            await asyncio.wait_for(task, timeout=settings.WORKER_DRAIN_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            logger.warning(f"Worker {worker_id} did not drain in time and was cancelled")
         
     async def start(self):
         """Start all workers in the pool."""
         logger.info(f"Starting worker pool with {self.num_workers} workers")
         
-        for i in range(self.num_workers):
-            worker_id = f"worker-{i+1}"
-            worker = AgenticWorker(worker_id, self.redis_url)
-            self.workers[worker_id] = worker
-            
-            # Start worker in background
-            task = asyncio.create_task(worker.run())
-            self.tasks.append(task)
+        for _ in range(self.num_workers):
+            self._add_worker()
             
         logger.info("All workers started successfully")
         
@@ -36,11 +61,13 @@ class WorkerPool:
             await worker.stop()
             
         # Cancel all tasks
-        for task in self.tasks:
+        for task in self.tasks.values():
             task.cancel()
             
         # Wait for all tasks to complete
-        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        self.workers.clear()
+        self.tasks.clear()
         
         logger.info("Worker pool stopped successfully")
         
@@ -48,24 +75,27 @@ class WorkerPool:
         """Get the number of currently active workers."""
         return len(self.workers)
         
+    def get_story_latencies(self) -> List[float]:
+        """Get recent per-story processing times (seconds) across all workers."""
+        return [latency for worker in self.workers.values() for latency in worker.latencies]
+        
+    def get_busy_workers(self) -> Optional[int]:
+        """Get the number of workers currently processing a story."""
+        return sum(worker.busy for worker in self.workers.values())
+        
     async def scale_workers(self, new_count: int):
         """Scale the number of workers up or down."""
         current_count = len(self.workers)
         
         if new_count > current_count:
             # Add new workers
-            for i in range(current_count, new_count):
-                worker_id = f"worker-{i+1}"
-                worker = AgenticWorker(worker_id, self.redis_url)
-                self.workers[worker_id] = worker
-                task = asyncio.create_task(worker.run())
-                self.tasks.append(task)
+            for _ in range(current_count, new_count):
+                self._add_worker()
                 
         elif new_count < current_count:
-            # Remove excess workers
+            # Remove the newest workers and reclaim their tasks
             workers_to_remove = list(self.workers.keys())[new_count:]
-            for worker_id in workers_to_remove:
-                worker = self.workers.pop(worker_id)
-                await worker.stop()
+            await asyncio.gather(*(self._remove_worker(worker_id) for worker_id in workers_to_remove))
                 
-        logger.info(f"Scaled worker pool from {current_count} to {new_count} workers") 
\ No newline at end of file
+        self.num_workers = new_count
+        logger.info(f"Scaled worker pool from {current_count} to {new_count} workers")
\ No newline at end of file